@@ -12,7 +12,8 @@ import lava_dispatcher.config
 from lava_dispatcher.config import get_config, get_device_config, list_devices
 from lava_dispatcher.job import LavaTestJob, validate_job_data
 from lava_dispatcher.pipeline.action import JobError
-from lava_dispatcher.pipeline.log import YAMLLogger
+from lava_dispatcher.pipeline.log import YAMLLogger, LOG_CODECS
+from lava_dispatcher.pipeline.utils.constants import LOG_BATCH_SIZE
 from lava_dispatcher.pipeline.device import NewDevice
 from lava_dispatcher.pipeline.parser import JobParser
 
@@ -139,6 +140,18 @@ class dispatch(DispatcherCommand):
         parser.add_argument(
             "--slave-cert", default=None,
             help="Slave certificate file")
+        parser.add_argument(
+            "--log-format", default='yaml', choices=YAMLLogger.formats,
+            help="Format of each log record sent to the master")
+        parser.add_argument(
+            "--log-batch-size", default=LOG_BATCH_SIZE, type=int,
+            help="Maximum number of log records sent to the master in one message")
+        parser.add_argument(
+            "--log-compression", default=None, choices=sorted(LOG_CODECS.keys()),
+            help="Compress the batches of log records sent to the master")
+        parser.add_argument(
+            "--log-spool", default=None,
+            help="Directory in which to keep the log records until the master has received them")
         parser.add_argument(
             "job_file",
             metavar="JOB",
@@ -183,6 +196,11 @@ class dispatch(DispatcherCommand):
             # Pipeline always log as YAML so change the base logger.
             # Every calls to logging.getLogger will now return a YAMLLogger.
             logging.setLoggerClass(YAMLLogger)
+            logger = logging.getLogger('dispatcher')
+            logger.set_format(self.args.log_format)
+            logger.batch_size = self.args.log_batch_size
+            logger.compression = self.args.log_compression
+            logger.spool = self.args.log_spool
         else:
             FORMAT = '<LAVA_DISPATCHER>%(asctime)s %(levelname)s: %(message)s'
             DATEFMT = '%Y-%m-%d %I:%M:%S %p'
@@ -18,6 +18,7 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
+import os
 import re
 import logging
 import sys
@@ -26,16 +27,33 @@ import time
 import types
 import signal
 import datetime
+import threading
 import traceback
 import subprocess
 from collections import OrderedDict
 from contextlib import contextmanager
 
 from lava_dispatcher.pipeline.log import YAMLLogger
-from lava_dispatcher.pipeline.utils.constants import OVERRIDE_CLAMP_DURATION, ACTION_TIMEOUT
+from lava_dispatcher.pipeline.utils.constants import (
+    ACTION_TIMEOUT,
+    CONCURRENT_ACTIONS,
+    DAG_SCHEDULER,
+    OVERRIDE_CLAMP_DURATION,
+)
 
 if sys.version > '3':
     from functools import reduce  # pylint: disable=redefined-builtin
+    import queue  # pylint: disable=import-error
+    monotonic = time.monotonic  # pylint: disable=invalid-name,no-member
+else:
+    import Queue as queue  # pylint: disable=import-error
+
+    def monotonic():
+        """
+        Elapsed real time since an arbitrary point in the past,
+        unaffected by changes to the system clock.
+        """
+        return os.times()[4]
 
 
 class InfrastructureError(Exception):
@@ -219,8 +237,11 @@ class Pipeline(object):  # pylint: disable=too-many-instance-attributes
         return reduce(lambda a, b: a + b, sub_action_errors)
 
     def validate_actions(self):
-        for action in self.actions:
-            action.validate()
+        for group in self._action_groups():
+            if len(group) > 1:
+                self._validate_concurrent_actions(group)
+            else:
+                group[0].validate()
 
         # If this is the root pipeline, raise the errors
         if self.parent is None and self.errors:
@@ -244,6 +265,9 @@ class Pipeline(object):  # pylint: disable=too-many-instance-attributes
             if child.internal_pipeline:
                 child.internal_pipeline.pipeline_cleanup()
         # exit out of the pipeline & run the Finalize action to close the connection and poweroff the device
+        # the finalize action needs to run, even if the job deadline has expired.
+        if getattr(self.job, 'deadline', None):
+            self.job.deadline.cancel()
         for child in self.job.pipeline.actions:
             # rely on the action name here - use isinstance if pipeline moves into a dedicated module.
             if child.name == 'finalize':
@@ -291,27 +315,207 @@ class Pipeline(object):  # pylint: disable=too-many-instance-attributes
                 }
             )
 
-    def run_actions(self, connection, args=None):  # pylint: disable=too-many-branches,too-many-statements,too-many-locals
+    @property
+    def concurrency(self):
+        """
+        Maximum number of concurrent actions to run at the same time.
+        Override: set concurrent_actions in the device dictionary.
+        """
+        if self.job and self.job.device:
+            return self.job.device.get('concurrent_actions', CONCURRENT_ACTIONS)
+        return CONCURRENT_ACTIONS
 
-        def cancelling_handler(*args):  # pylint: disable=unused-argument
-            """
-            Catches KeyboardInterrupt or SIGTERM from anywhere below the top level
-            pipeline and allow cleanup actions to happen on all actions,
-            not just the ones directly related to the currently running action.
-            """
-            self.cleanup_actions(None, "Cancelled")
-            signal.signal(signal.SIGINT, signal.default_int_handler)
-            raise KeyboardInterrupt
+    @property
+    def dag(self):
+        """
+        Whether actions which declare the context keys they read and write
+        are scheduled according to those dependencies instead of one at a time.
+        Override: set dag_scheduler in the device dictionary.
+        """
+        if self.job and self.job.device:
+            return self.job.device.get('dag_scheduler', DAG_SCHEDULER)
+        return DAG_SCHEDULER
 
-        timeout_start = time.time()
+    def _action_groups(self, dag=False):
+        """
+        Groups consecutive actions which can run at the same time: actions
+        which declare themselves as concurrent, e.g. downloads, and, if dag
+        is set, actions which declare the context keys they read and write.
+        Actions in the top level pipeline always run one at a time.
+        """
+        group = []
         for action in self.actions:
-            if self.job and self.job.timeout and time.time() > timeout_start + self.job.timeout.duration:
+            if self.parent and (action.concurrent or (dag and action.declared)) and \
+                    self.concurrency > 1:
+                group.append(action)
+                continue
+            if group:
+                yield group
+                group = []
+            yield [action]
+        if group:
+            yield group
+
+    @staticmethod
+    def _depends(earlier, later):
+        """
+        Whether the later action needs to wait for the earlier action.
+        Context keys are dotted paths, a key overlaps with the keys beneath it.
+        """
+        def overlap(keys, others):
+            for key in keys:
+                for other in others:
+                    if key == other or key.startswith(other + '.') or other.startswith(key + '.'):
+                        return True
+            return False
+
+        if earlier.declared and later.declared:
+            return (overlap(earlier.writes, later.reads + later.writes) or
+                    overlap(earlier.reads, later.writes))
+        return not (earlier.concurrent and later.concurrent)
+
+    def _run_concurrent_actions(self, actions, connection, args=None):  # pylint: disable=too-many-locals
+        """
+        Runs a group of concurrent actions using a bounded pool of threads.
+        An action only starts once all the earlier actions in the group on
+        which it depends have completed. Each action runs within the deadline
+        of this thread and the main thread also enforces the timeout of each
+        action whilst waiting for the pool. Concurrent actions cannot replace the connection.
+        No more actions are started after a failure or a timeout. Once every
+        worker has stopped, the failed actions are cleaned up in this thread
+        and errors are raised in pipeline order.
+        """
+        depends = {}
+        for index, action in enumerate(actions):
+            depends[action.level] = [earlier.level for earlier in actions[:index]
+                                     if self._depends(earlier, action)]
+        pending = list(actions)
+        done = set()
+        started = {}
+        failures = {}
+        ready = threading.Condition()
+        parent = DeadlineManager.current()
+
+        def next_action():
+            with ready:
+                while pending and not failures:
+                    for action in pending:
+                        if all([level in done for level in depends[action.level]]):
+                            pending.remove(action)
+                            started[action.level] = time.time()
+                            return action
+                    ready.wait(1)
+                return None
+
+        def worker():
+            while True:
+                action = next_action()
+                if action is None:
+                    return
+                try:
+                    with DeadlineManager.adopt(parent):
+                        self._run_action(action, connection, args, cleanup=False)
+                except BaseException as exc:  # pylint: disable=broad-except
+                    with ready:
+                        failures.setdefault(action.level, exc)
+                finally:
+                    with ready:
+                        del started[action.level]
+                        done.add(action.level)
+                        ready.notify_all()
+
+        threads = []
+        for _ in range(min(self.concurrency, len(actions))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # the deadline of a timed out action also stops its worker,
+            # so wait for every worker before touching the context again.
+            while thread.is_alive():
+                thread.join(0.1)
+                now = time.time()
+                with ready:
+                    for action in actions:
+                        start = started.get(action.level, None)
+                        if start is not None and action.level not in failures and \
+                                now > start + action.timeout.duration:
+                            msg = "%s timed out after %s seconds" % (action.name, int(action.timeout.duration))
+                            action.errors = msg
+                            failures[action.level] = JobError(msg)
+                            ready.notify_all()
+        failed = [action for action in actions if action.level in failures]
+        if not failed:
+            return
+        self._diagnose(connection)
+        for action in failed:
+            action.cleanup()
+        exc = failures[failed[0].level]
+        if isinstance(exc, RuntimeError):
+            self.cleanup_actions(connection, None)
+        raise exc
+
+    def _validate_concurrent_actions(self, actions):
+        """
+        Validation of concurrent actions is often I/O bound (HTTP HEAD
+        requests, ssh stat calls), so validate the group using a bounded
+        pool of threads. Errors are collected by each action, so the
+        errors of the pipeline retain the pipeline order. Exceptions are
+        raised in pipeline order once all the actions have been validated.
+        """
+        pending = queue.Queue()
+        for action in actions:
+            pending.put(action)
+        failures = {}
+
+        def worker():
+            while True:
+                try:
+                    action = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    action.validate()
+                except BaseException as exc:  # pylint: disable=broad-except
+                    failures[action.level] = exc
+
+        threads = []
+        for _ in range(min(self.concurrency, len(actions))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+        for action in actions:
+            if action.level in failures:
+                raise failures[action.level]
+
+    def run_actions(self, connection, args=None):
+        if self.parent is None and self.job and self.job.timeout:
+            # the job deadline contains the deadline of every action
+            name = self.job.parameters.get('job_name', '?')
+            with DeadlineManager.deadline("Job '%s'" % name, self.job.timeout.duration) as deadline:
+                self.job.deadline = deadline
+                return self._run_actions(connection, args)
+        return self._run_actions(connection, args)
+
+    def _run_actions(self, connection, args=None):
+        dag = any([action.declared for action in self.actions]) and self.dag
+        for group in self._action_groups(dag):
+            action = group[0]
+            deadline = getattr(self.job, 'deadline', None)
+            if deadline and deadline.expired:
                 # affects all pipelines, including internal
                 # the action which overran the timeout has been allowed to complete.
                 name = self.job.parameters.get('job_name', '?')
                 msg = "Job '%s' timed out after %s seconds" % (name, int(self.job.timeout.duration))
                 action.logger.error(msg)
                 action.errors = msg
+                # allow the finalize action to run after the job deadline.
+                deadline.cancel()
                 final = self.job.pipeline.actions[-1]
                 if final.name == "finalize":
                     final.run(connection, None)
@@ -321,75 +525,101 @@ class Pipeline(object):  # pylint: disable=too-many-instance-attributes
                     raise RuntimeError(msg)
                 raise JobError(msg)
 
-            # Begin the action
-            # TODO: this shouldn't be needed
-            # The ci-test does not set the default logging class
-            if isinstance(action.logger, YAMLLogger):
-                action.logger.setMetadata(action.level, action.name)
-            # Add action start timestamp to the log message
-            msg = 'start: %s %s (max %ds)' % (action.level,
-                                              action.name,
-                                              action.timeout.duration)
-            if self.parent is None:
-                action.logger.info(msg)
+            if len(group) > 1:
+                self._run_concurrent_actions(group, connection, args)
             else:
-                action.logger.debug(msg)
-            start = time.time()
+                connection = self._run_action(action, connection, args)
+        return connection
+
+    def _run_action(self, action, connection, args=None, cleanup=True):  # pylint: disable=too-many-branches,too-many-statements
+        """
+        Runs a single action within its timeout. Unless cleanup is False,
+        e.g. for concurrent actions which are cleaned up by the thread
+        running the pool, a failed action is cleaned up before the error
+        is raised.
+        """
+
+        def cancelling_handler(*args):  # pylint: disable=unused-argument
+            """
+            Catches KeyboardInterrupt or SIGTERM from anywhere below the top level
+            pipeline and allow cleanup actions to happen on all actions,
+            not just the ones directly related to the currently running action.
+            """
+            self.cleanup_actions(None, "Cancelled")
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            raise KeyboardInterrupt
+
+        # Begin the action
+        # TODO: this shouldn't be needed
+        # The ci-test does not set the default logging class
+        if isinstance(action.logger, YAMLLogger):
+            action.logger.setMetadata(action.level, action.name)
+        # Add action start timestamp to the log message
+        msg = 'start: %s %s (max %ds)' % (action.level,
+                                          action.name,
+                                          action.timeout.duration)
+        if self.parent is None:
+            action.logger.info(msg)
+        else:
+            action.logger.debug(msg)
+        start = time.time()
+        try:
+            if not self.parent:
+                signal.signal(signal.SIGINT, cancelling_handler)
+                signal.signal(signal.SIGTERM, cancelling_handler)
             try:
-                if not self.parent:
-                    signal.signal(signal.SIGINT, cancelling_handler)
-                    signal.signal(signal.SIGTERM, cancelling_handler)
-                try:
-                    with action.timeout.action_timeout():
-                        new_connection = action.run(connection, args)
-                # overly broad exceptions will cause issues with RetryActions
-                # always ensure the unit tests continue to pass with changes here.
-                except (ValueError, KeyError, NameError, SyntaxError, OSError,
-                        TypeError, RuntimeError, AttributeError):
-                    action.elapsed_time = time.time() - start
-                    msg = re.sub('\s+', ' ', ''.join(traceback.format_exc().split('\n')))
-                    action.logger.exception(traceback.format_exc())
-                    action.errors = msg
+                with action.timeout.action_timeout():
+                    new_connection = action.run(connection, args)
+            # overly broad exceptions will cause issues with RetryActions
+            # always ensure the unit tests continue to pass with changes here.
+            except (ValueError, KeyError, NameError, SyntaxError, OSError,
+                    TypeError, RuntimeError, AttributeError):
+                action.elapsed_time = time.time() - start
+                msg = re.sub('\s+', ' ', ''.join(traceback.format_exc().split('\n')))
+                action.logger.exception(traceback.format_exc())
+                action.errors = msg
+                if cleanup:
                     action.cleanup()
                     self.cleanup_actions(connection, None)
-                    # report action errors so that the last part of the message is the most relevant.
-                    raise RuntimeError(action.errors)
-                except KeyboardInterrupt:
-                    raise KeyboardInterrupt
-                action.elapsed_time = time.time() - start
-                # Add action end timestamp to the log message
-                msg = "%s duration: %.02f" % (action.name,
-                                              action.elapsed_time)
-                if self.parent is None:
-                    action.logger.info(msg)
-                else:
-                    action.logger.debug(msg)
-                self._log_action_results(action)
-                if new_connection:
-                    connection = new_connection
+                # report action errors so that the last part of the message is the most relevant.
+                raise RuntimeError(action.errors)
             except KeyboardInterrupt:
-                action.elapsed_time = time.time() - start
-                self.cleanup_actions(connection, "Cancelled")
-                sys.exit(1)
-            except (JobError, InfrastructureError) as exc:
-                if sys.version > '3':
-                    exc_message = str(exc)
-                else:
-                    exc_message = exc.message
-                action.errors = exc_message
-                action.elapsed_time = time.time() - start
-                # set results including retries
-                if "boot-result" not in action.data:
-                    action.data['boot-result'] = 'failed'
-                self._log_action_results(action)
-                action.logger.exception(str(exc))
+                raise KeyboardInterrupt
+            action.elapsed_time = time.time() - start
+            # Add action end timestamp to the log message
+            msg = "%s duration: %.02f" % (action.name,
+                                          action.elapsed_time)
+            if self.parent is None:
+                action.logger.info(msg)
+            else:
+                action.logger.debug(msg)
+            self._log_action_results(action)
+            if new_connection:
+                connection = new_connection
+        except KeyboardInterrupt:
+            action.elapsed_time = time.time() - start
+            self.cleanup_actions(connection, "Cancelled")
+            sys.exit(1)
+        except (JobError, InfrastructureError) as exc:
+            if sys.version > '3':
+                exc_message = str(exc)
+            else:
+                exc_message = exc.message
+            action.errors = exc_message
+            action.elapsed_time = time.time() - start
+            # set results including retries
+            if "boot-result" not in action.data:
+                action.data['boot-result'] = 'failed'
+            self._log_action_results(action)
+            action.logger.exception(str(exc))
+            if cleanup:
                 self._diagnose(connection)
                 action.cleanup()
-                # a RetryAction should not cleanup the pipeline until the last retry has failed
-                # but the failing action may be inside an internal pipeline of the retry
-                if not self.parent:  # top level pipeline, no retries left
-                    self.cleanup_actions(connection, exc_message)
-                raise exc
+            # a RetryAction should not cleanup the pipeline until the last retry has failed
+            # but the failing action may be inside an internal pipeline of the retry
+            if not self.parent:  # top level pipeline, no retries left
+                self.cleanup_actions(connection, exc_message)
+            raise exc
         return connection
 
     def prepare_actions(self):
@@ -429,8 +659,15 @@ class Action(object):  # pylint: disable=too-many-instance-attributes
         self.protocols = []  # list of protocol objects supported by this action, full list in job.protocols
         self.section = None
         self.connection_timeout = Timeout(self.name)
+        self.search_window = None  # default of the device, unless set in the parameters
         self.action_namespaces = []
         self.character_delay = 0
+        self.concurrent = False  # may run at the same time as adjacent concurrent actions
+        # context keys (dotted paths, e.g. 'download_action.kernel') read and
+        # written by run(), including any internal pipeline. Left as None,
+        # the action runs after all earlier actions and before all later ones.
+        self.reads = None
+        self.writes = None
 
     # public actions (i.e. those who can be referenced from a job file) must
     # declare a 'class-type' name so they can be looked up.
@@ -502,6 +739,15 @@ class Action(object):  # pylint: disable=too-many-instance-attributes
         if error:
             self.__errors__.append(error)
 
+    @property
+    def declared(self):
+        """
+        Actions which declare the context keys used in run() can be scheduled
+        alongside other actions when the DAG scheduler is enabled.
+        Declared actions must not replace the connection.
+        """
+        return self.reads is not None and self.writes is not None
+
     @property
     def valid(self):
         return len([x for x in self.errors if x]) == 0
@@ -556,6 +802,11 @@ class Action(object):  # pylint: disable=too-many-instance-attributes
                 self.timeout.duration = Timeout.parse(self.parameters['timeout'])
         if 'connection_timeout' in self.parameters:
             self.connection_timeout.duration = Timeout.parse(self.parameters['connection_timeout'])
+        if 'search_window' in self.parameters:
+            try:
+                self.search_window = int(self.parameters['search_window'])
+            except (TypeError, ValueError):
+                self.errors = "Invalid search_window: %s" % self.parameters['search_window']
 
         # only unit tests should have actions without a pointer to the job.
         if 'failure_retry' in self.parameters and 'repeat' in self.parameters:
@@ -649,7 +900,7 @@ class Action(object):  # pylint: disable=too-many-instance-attributes
         command_list.insert(0, 'nice')
         self.logger.info("%s", ' '.join(command_list))
         try:
-            log = subprocess.check_output(command_list, stderr=subprocess.STDOUT)
+            log = self._command_output(command_list)
             log = log.decode('utf-8')
         except subprocess.CalledProcessError as exc:
             if sys.version > '3':
@@ -684,6 +935,13 @@ class Action(object):  # pylint: disable=too-many-instance-attributes
             self.logger.debug('command output %s', log)
             return log
 
+    def _command_output(self, command_list):  # pylint: disable=no-self-use
+        """
+        subprocess.check_output, checking the current deadline whilst
+        the command runs. The command is killed if the deadline expires.
+        """
+        return DeadlineManager.check_output(command_list, stderr=subprocess.STDOUT)
+
     def call_protocols(self):
         """
         Actions which support using protocol calls from the job submission use this routine to execute those calls.
@@ -735,6 +993,7 @@ class Action(object):  # pylint: disable=too-many-instance-attributes
             return self.internal_pipeline.run_actions(connection, args)
         if connection:
             connection.timeout = self.connection_timeout
+            connection.search_window = self.search_window
         return connection
 
     def cleanup(self):
@@ -876,16 +1135,17 @@ class Timeout(object):
             return Timeout.default_duration()
         return duration.total_seconds()
 
-    def _timed_out(self, signum, frame):  # pylint: disable=unused-argument
-        raise JobError("%s timed out after %s seconds" % (self.name, int(self.duration)))
-
     @contextmanager
     def action_timeout(self):
-        signal.signal(signal.SIGALRM, self._timed_out)
-        signal.alarm(int(self.duration))
-        yield
-        # clear the timeout alarm, the action has returned
-        signal.alarm(0)
+        """
+        Sets a deadline for the action, nested within the deadline of the
+        job (or of the pipeline running concurrent actions). The deadline
+        is checked by the expect loops, downloads and commands run by the
+        action, then once more when the action returns.
+        """
+        with DeadlineManager.deadline(self.name, self.duration) as deadline:
+            yield deadline
+            deadline.check(nested=False)
 
     def modify(self, duration):
         """
@@ -895,3 +1155,165 @@ class Timeout(object):
         if self.protected:
             raise JobError("Trying to modify a protected timeout: %s.", self.name)
         self.duration = max(min(OVERRIDE_CLAMP_DURATION, duration), 1)  # FIXME: needs support in /etc/
+
+
+class Deadline(object):
+    """
+    A point in time, on a monotonic clock, by which an operation needs
+    to complete. Deadlines nest (job, action, connection) and checking a
+    deadline also checks each of the deadlines which contain it.
+    Deadlines do not use signals, so can be checked from any thread.
+    """
+    def __init__(self, name, duration, parent=None):
+        self.name = name
+        self.duration = duration
+        self.parent = parent
+        self.expires = monotonic() + duration
+        self.cancelled = False
+
+    def chain(self):
+        """ The deadlines which apply, outermost first. """
+        deadlines = []
+        deadline = self
+        while deadline:
+            deadlines.insert(0, deadline)
+            deadline = deadline.parent
+        return [item for item in deadlines if not item.cancelled]
+
+    def remaining(self):
+        """ Seconds until the first of the nested deadlines expires, or None """
+        now = monotonic()
+        remaining = [deadline.expires - now for deadline in self.chain()]
+        return max(min(remaining), 0) if remaining else None
+
+    def check(self, nested=True):
+        """
+        Raises JobError if this deadline, or any deadline which contains it,
+        has expired.
+        """
+        now = monotonic()
+        for deadline in self.chain() if nested else [self]:
+            if not deadline.cancelled and now >= deadline.expires:
+                raise JobError("%s timed out after %s seconds" % (
+                    deadline.name, int(deadline.duration)))
+
+    @property
+    def expired(self):
+        return not self.cancelled and monotonic() >= self.expires
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class DeadlineManager(object):
+    """
+    Tracks the deadlines which apply to the current thread. Worker threads
+    adopt the deadline of the thread which started them.
+    """
+    local = threading.local()
+
+    @classmethod
+    def _stack(cls):
+        if not hasattr(cls.local, 'stack'):
+            cls.local.stack = []
+        return cls.local.stack
+
+    @classmethod
+    def current(cls):
+        stack = cls._stack()
+        return stack[-1] if stack else None
+
+    @classmethod
+    @contextmanager
+    def deadline(cls, name, duration):
+        deadline = Deadline(name, duration, cls.current())
+        with cls.adopt(deadline):
+            yield deadline
+
+    @classmethod
+    @contextmanager
+    def adopt(cls, deadline):
+        if deadline is None:
+            yield
+            return
+        stack = cls._stack()
+        stack.append(deadline)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    @classmethod
+    def check(cls):
+        deadline = cls.current()
+        if deadline:
+            deadline.check()
+
+    @classmethod
+    def remaining(cls, timeout=None):
+        """
+        Limits a timeout (in seconds, None for no limit)
+        to the time remaining before the current deadline.
+        """
+        deadline = cls.current()
+        remaining = deadline.remaining() if deadline else None
+        if remaining is None:
+            return timeout
+        if timeout is None or timeout < 0:
+            return remaining
+        return min(timeout, remaining)
+
+    @classmethod
+    def clear(cls):
+        """
+        Cancels the innermost deadline, e.g. when an action hands over
+        to the connection timeout.
+        """
+        deadline = cls.current()
+        if deadline:
+            deadline.cancel()
+
+    @classmethod
+    def sleep(cls, duration):
+        """
+        time.sleep, raising JobError as soon as the current deadline expires.
+        """
+        end = monotonic() + duration
+        while True:
+            cls.check()
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.1))
+
+    @classmethod
+    def check_output(cls, args, **kwargs):
+        """
+        subprocess.check_output, checking the current deadline whilst the
+        command runs. The command (and any process it started) is killed
+        and JobError raised if the deadline expires.
+        """
+        # a new process group, so that the children of a shell are killed too.
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                preexec_fn=os.setsid, **kwargs)
+        output = []
+        reader = threading.Thread(target=lambda: output.append(proc.stdout.read()))
+        reader.daemon = True
+        reader.start()
+        try:
+            while reader.is_alive():
+                reader.join(0.1)
+                cls.check()
+        except JobError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            raise
+        proc.wait()
+        proc.stdout.close()
+        log = output[0] if output else b''
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args, output=log)
+        return log
@@ -19,6 +19,7 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 from lava_dispatcher.pipeline.action import Action
+from lava_dispatcher.pipeline.shell import ShellSession
 
 
 class ExportDeviceEnvironment(Action):
@@ -53,10 +54,22 @@ class ExportDeviceEnvironment(Action):
 
         shell_file = self.get_common_data('environment', 'shell_file')
 
-        for line in self.env:
-            connection.sendline(line, delay=self.character_delay)
-
+        commands = list(self.env)
         if shell_file:
-            connection.sendline('. %s' % shell_file, delay=self.character_delay)
+            commands.append('. %s' % shell_file)
+
+        if not isinstance(connection, ShellSession):
+            for line in commands:
+                connection.sendline(line, delay=self.character_delay)
+            return connection
+
+        # each command is confirmed by a marker, so the send latency is not needed
+        runner = connection.runner
+        first = len(runner.timings)
+        for line in commands:
+            if runner.execute(line, timeout=self.connection_timeout.duration,
+                              delay=self.character_delay):
+                self.logger.warning("%s failed with exit code %s", line, runner.match.group(1))
+        self.results = {'commands': runner.timings[first:]}
 
         return connection
@@ -192,7 +192,8 @@ class IsoRebootAction(Action):
             self.set_common_data('lava-test-shell', 'pre-command-list', shell_precommand_list)
 
         self.logger.info("Boot command: %s", ' '.join(self.sub_command))
-        shell = ShellCommand(' '.join(self.sub_command), self.timeout, logger=self.logger)
+        shell = ShellCommand(' '.join(self.sub_command), self.timeout, logger=self.logger,
+                             search_window=self.job.device.get('search_window', None))
         if shell.exitstatus:
             raise JobError("%s command exited %d: %s" % (self.sub_command, shell.exitstatus, shell.readlines()))
         self.logger.debug("started a shell command")
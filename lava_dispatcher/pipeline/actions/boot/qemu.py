@@ -188,7 +188,8 @@ class MonitorQemuAction(Action):
         """
         # initialise the first Connection object, a command line shell into the running QEMU.
         self.logger.info("Boot command: %s", ' '.join(self.sub_command))
-        shell = ShellCommand(' '.join(self.sub_command), self.timeout, logger=self.logger)
+        shell = ShellCommand(' '.join(self.sub_command), self.timeout, logger=self.logger,
+                             search_window=self.job.device.get('search_window', None))
         if shell.exitstatus:
             raise JobError("%s command exited %d: %s" % (self.sub_command, shell.exitstatus, shell.readlines()))
         self.logger.debug("started a shell command")
@@ -275,7 +276,8 @@ class CallQemuAction(Action):
             self.set_common_data('lava-test-shell', 'pre-command-list', shell_precommand_list)
 
         self.logger.info("Boot command: %s", ' '.join(self.sub_command))
-        shell = ShellCommand(' '.join(self.sub_command), self.timeout, logger=self.logger)
+        shell = ShellCommand(' '.join(self.sub_command), self.timeout, logger=self.logger,
+                             search_window=self.job.device.get('search_window', None))
         if shell.exitstatus:
             raise JobError("%s command exited %d: %s" % (self.sub_command, shell.exitstatus, shell.readlines()))
         self.logger.debug("started a shell command")
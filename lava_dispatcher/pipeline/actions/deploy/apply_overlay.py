@@ -18,11 +18,17 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
+import bz2
+import contextlib
+import gzip
+import lzma
 import os
 import shutil
 import subprocess
+import zlib
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     Pipeline,
     InfrastructureError,
     JobError
@@ -44,10 +50,11 @@ from lava_dispatcher.pipeline.utils.filesystem import (
 )
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
 from lava_dispatcher.pipeline.utils.compression import (
+    LZMA_ERROR,
     compress_file,
-    decompress_file,
     untar_file
 )
+from lava_dispatcher.pipeline.utils.cpio import CpioReader, CpioWriter
 from lava_dispatcher.pipeline.utils.strings import substitute
 from lava_dispatcher.pipeline.utils.network import dispatcher_ip
 
@@ -60,6 +67,8 @@ class ApplyOverlayGuest(Action):
         self.summary = "build a guest filesystem with the overlay"
         self.description = "prepare a qcow2 drive containing the overlay"
         self.guest_filename = 'lava-guest.qcow2'
+        self.reads = ['compress-overlay']
+        self.writes = ['common.guest']
 
     def validate(self):
         super(ApplyOverlayGuest, self).validate()
@@ -163,7 +172,7 @@ class ApplyOverlayTftp(Action):
             # need to mount the persistent NFS here.
             directory = mkdtemp(autoremove=False)
             try:
-                subprocess.check_output(['mount', '-t', 'nfs', nfs_url, directory])
+                DeadlineManager.check_output(['mount', '-t', 'nfs', nfs_url, directory])
             except subprocess.CalledProcessError as exc:
                 raise JobError(exc)
         elif self.parameters.get('ramdisk', None) is not None:
@@ -185,12 +194,12 @@ class ApplyOverlayTftp(Action):
             suffix = self.data['tftp-deploy'].get('suffix', '')
             self.set_common_data('file', 'overlay', os.path.join(suffix, os.path.basename(overlay_file)))
         if nfs_url:
-            subprocess.check_output(['umount', directory])
+            DeadlineManager.check_output(['umount', directory])
             os.rmdir(directory)  # fails if the umount fails
         if overlay_file:
             untar_file(overlay_file, directory)
             if nfs_url:
-                subprocess.check_output(['umount', directory])
+                DeadlineManager.check_output(['umount', directory])
                 os.rmdir(directory)  # fails if the umount fails
         return connection
 
@@ -321,17 +330,18 @@ class ExtractModules(Action):
 
 class ExtractRamdisk(Action):
     """
-    Removes the uboot header, if kernel-type is uboot
-    unzips the ramdisk and uncompresses the contents,
-    applies the overlay and then leaves the ramdisk open
-    for other actions to modify. Needs CompressRamdisk to
-    recreate the ramdisk with modifications.
+    Removes the uboot header, if kernel-type is uboot, and prepares
+    an empty directory for other actions to add files to the ramdisk.
+    The ramdisk itself is not unpacked: CompressRamdisk appends the
+    contents of the directory to the ramdisk as a second cpio archive.
+    The ramdisk is read to check that it is a cpio archive and to list
+    the directories which the second archive must not replace.
     """
     def __init__(self):
         super(ExtractRamdisk, self).__init__()
         self.name = "extract-overlay-ramdisk"
         self.summary = "extract the ramdisk"
-        self.description = "extract ramdisk to a temporary directory"
+        self.description = "prepare a directory of files to add to the ramdisk"
 
     def validate(self):
         super(ExtractRamdisk, self).validate()
@@ -353,26 +363,40 @@ class ExtractRamdisk(Action):
         ramdisk_compressed_data = os.path.join(ramdisk_dir, RAMDISK_FNAME + suffix)
         if self.parameters['ramdisk'].get('header', None) == 'u-boot':
             # TODO: 64 bytes is empirical - may need to be configurable in the future
-            cmd = ('dd if=%s of=%s ibs=64 skip=1' % (ramdisk, ramdisk_compressed_data)).split(' ')
             try:
-                self.run_command(cmd)
-            except:
+                with open(ramdisk, 'rb') as uboot, open(ramdisk_compressed_data, 'wb') as data:
+                    uboot.seek(64)
+                    shutil.copyfileobj(uboot, data)
+            except IOError:
                 raise RuntimeError('Unable to remove uboot header: %s' % ramdisk)
         else:
             # give the file a predictable name
             shutil.move(ramdisk, ramdisk_compressed_data)
-        ramdisk_data = decompress_file(ramdisk_compressed_data, compression)
-        pwd = os.getcwd()
-        os.chdir(extracted_ramdisk)
-        cmd = ('cpio -i -F %s' % ramdisk_data).split(' ')
-        if not self.run_command(cmd):
-            raise JobError('Unable to uncompress: %s - missing ramdisk-type?' % ramdisk_data)
-        os.chdir(pwd)
-        # tell other actions where the unpacked ramdisk can be found
+        # tell other actions where to put files to add to the ramdisk
         self.data[self.name]['extracted_ramdisk'] = extracted_ramdisk  # directory
-        self.data[self.name]['ramdisk_file'] = ramdisk_data  # filename
+        self.data[self.name]['ramdisk_file'] = ramdisk_compressed_data  # filename
+        self.data[self.name]['ramdisk_dirs'] = self._ramdisk_dirs(ramdisk_compressed_data, compression)
         return connection
 
+    def _ramdisk_dirs(self, ramdisk, compression):
+        """
+        Lists the directories, and symlinks, in each of the archives of the ramdisk.
+        Raises JobError if the ramdisk is not a (compressed) cpio archive.
+        """
+        openers = {None: open, 'gz': gzip.GzipFile, 'bz2': bz2.BZ2File, 'xz': lzma.LZMAFile}
+        if compression not in openers:
+            raise JobError("Unknown ramdisk compression '%s'" % compression)
+        dirs = set()
+        try:
+            with contextlib.closing(openers[compression](ramdisk, 'rb')) as data:
+                for entry in CpioReader(data, concatenated=True):
+                    if entry.isdir() or entry.issym():
+                        dirs.add(os.path.normpath(entry.name).lstrip('/'))
+        except (JobError, IOError, EOFError, LZMA_ERROR, zlib.error) as exc:
+            raise JobError('Unable to uncompress: %s - missing ramdisk-type? %s' % (ramdisk, exc))
+        self.logger.debug("Ramdisk %s contains %d directories and symlinks", ramdisk, len(dirs))
+        return sorted(dirs)
+
 
 class CompressRamdisk(Action):
     """
@@ -422,23 +446,26 @@ class CompressRamdisk(Action):
                 self.logger.info("Copying preseed file into ramdisk: %s", filename)
                 shutil.copy(self.data['download_action']['preseed']['file'], os.path.join(ramdisk_dir, filename))
                 self.set_common_data('file', 'preseed_local', filename)
-        pwd = os.getcwd()
-        os.chdir(ramdisk_dir)
-        self.logger.debug("Building ramdisk %s containing %s",
-                          ramdisk_data, ramdisk_dir)
-        cmd = "find . | cpio --create --format='newc' > %s" % ramdisk_data
-        try:
-            # safe to use shell=True here, no external arguments
-            log = subprocess.check_output(cmd, shell=True)
-        except OSError as exc:
-            raise RuntimeError('Unable to create cpio filesystem: %s' % exc)
-        # lazy-logging would mean that the quoting of cmd causes invalid YAML
-        self.logger.debug("%s\n%s" % (cmd, log))  # pylint: disable=logging-not-lazy
 
-        # we need to compress the ramdisk with the same method is was submitted with
-        compression = self.parameters['ramdisk'].get('compression', None)
-        final_file = compress_file(ramdisk_data, compression)
-        os.chdir(pwd)
+        # The kernel unpacks each concatenated (and separately compressed)
+        # cpio archive in turn, so the additions are appended to the original
+        # ramdisk, using the same compression, instead of rebuilding it.
+        # Directories of the original ramdisk are left as they are.
+        overlay_data = os.path.join(os.path.dirname(ramdisk_dir), 'overlay.cpio')
+        with open(overlay_data, 'wb') as overlay:
+            writer = CpioWriter(overlay)
+            count = writer.add_tree(
+                ramdisk_dir, self.data['extract-overlay-ramdisk'].get('ramdisk_dirs', None))
+            writer.close()
+        self.logger.debug("Appending %d entries from %s to ramdisk %s",
+                          count, ramdisk_dir, ramdisk_data)
+        if count:
+            compression = self.parameters['ramdisk'].get('compression', None)
+            overlay_data = compress_file(overlay_data, compression)
+            with open(overlay_data, 'rb') as overlay, open(ramdisk_data, 'ab') as ramdisk:
+                shutil.copyfileobj(overlay, ramdisk)
+        os.unlink(overlay_data)
+        final_file = ramdisk_data
         tftp_dir = os.path.dirname(self.data['download_action']['ramdisk']['file'])
 
         if self.add_header == 'u-boot':
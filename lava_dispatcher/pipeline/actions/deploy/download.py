@@ -29,28 +29,40 @@ import shutil
 import time
 import hashlib
 import requests
+import select
 import subprocess
 import bz2
 import contextlib
 import lzma
+import threading
 import zlib
+from collections import OrderedDict
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     JobError,
     Pipeline,
 )
+from lava_dispatcher.pipeline.device import deploy_parameters
 from lava_dispatcher.pipeline.logical import RetryAction
+from lava_dispatcher.pipeline.utils.cache import DownloadCache
 from lava_dispatcher.pipeline.utils.constants import (
+    DOWNLOAD_QUEUE_DEPTH,
     FILE_DOWNLOAD_CHUNK_SIZE,
     HTTP_DOWNLOAD_CHUNK_SIZE,
+    HTTP_DOWNLOAD_CONNECTIONS,
+    HTTP_DOWNLOAD_SEGMENT_SIZE,
     HTTP_DOWNLOAD_TIMEOUT,
     SCP_DOWNLOAD_CHUNK_SIZE,
 )
+from lava_dispatcher.pipeline.utils.compression import LZMA_ERROR
 
 if sys.version_info[0] == 2:
     import urlparse as lavaurl
+    import Queue as queue  # pylint: disable=import-error
 elif sys.version_info[0] == 3:
     import urllib.parse as lavaurl  # pylint: disable=no-name-in-module,import-error
+    import queue  # pylint: disable=import-error
 
 # pylint: disable=logging-not-lazy
 
@@ -59,6 +71,65 @@ elif sys.version_info[0] == 3:
 # FIXME: create a download3.py which uses urllib.urlparse
 
 
+class DownloadStage(threading.Thread):
+    """
+    One step of a pipelined download (checksum, decompression or write),
+    running in its own thread and reading from a bounded queue. The output
+    of the step, if any, is passed to the next stage. None marks the end of
+    the content. After an error, the stage stops and put() discards the
+    rest of the content, so that the download thread never blocks.
+    """
+
+    def __init__(self, name, func, output=None):
+        super(DownloadStage, self).__init__(name="download-%s" % name)
+        self.daemon = True
+        self.func = func
+        self.output = output
+        self.queue = queue.Queue(DOWNLOAD_QUEUE_DEPTH)
+        self.error = None
+        self.size = 0
+        self.busy = 0.0
+
+    def put(self, buff):
+        # a timeout allows signals, like the action timeout, to be handled
+        # and stops waiting for room once the stage is no longer reading.
+        while self.is_alive() and not self.error:
+            try:
+                self.queue.put(buff, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def wait(self):
+        while self.is_alive():
+            self.join(1)
+
+    def run(self):
+        try:
+            while True:
+                buff = self.queue.get()
+                if buff is None:
+                    break
+                start = time.time()
+                try:
+                    result = self.func(buff)
+                except Exception as exc:  # pylint: disable=broad-except
+                    self.error = exc
+                    break
+                self.busy += time.time() - start
+                self.size += len(buff)
+                if self.output and result:
+                    self.output.put(result)
+        finally:
+            if self.output:
+                self.output.put(None)
+
+    def throughput(self):
+        size = self.size / (1024 * 1024.0)
+        return "%s: %dMB in %0.2fs (%0.2fMB/s)" % (
+            self.name, size, self.busy, size / self.busy if self.busy else 0)
+
+
 class DownloaderAction(RetryAction):
     """
     The retry pipeline for downloads.
@@ -71,6 +142,9 @@ class DownloaderAction(RetryAction):
         self.summary = "download-retry"
         self.key = key  # the key in the parameters of what to download
         self.path = path  # where to download
+        self.concurrent = True  # adjacent downloads are fetched at the same time
+        self.reads = ['tftp-deploy.suffix', 'deploy-iso-installer.suffix']
+        self.writes = ['download_action.%s' % key, 'common.file.%s' % key]
 
     def populate(self, parameters):
         self.internal_pipeline = Pipeline(parent=self, job=self.job, parameters=parameters)
@@ -112,10 +186,20 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
         self.key = key
         self.path = path
         self.size = -1
+        # only files which no later action modifies in place are hardlinked
+        # from the cache, e.g. disk images written by the VM are copied
+        self.cache_link_keys = ['kernel', 'dtb', 'modules', 'nfsrootfs']
 
     def reader(self):
         raise NotImplementedError
 
+    def _writes_file(self):
+        """
+        True if the reader writes the downloaded file itself,
+        so that the content is not written a second time.
+        """
+        return False
+
     def cleanup(self):
         nested_tmp_dir = os.path.join(self.path, self.key)
         self.logger.debug("%s cleanup", self.name)
@@ -139,17 +223,30 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
             filename = os.path.join(path, '.'.join(parts[:-1]))
         return filename, suffix
 
+    def _remote(self):
+        if 'images' in self.parameters and self.key in self.parameters['images']:
+            return self.parameters['images'][self.key]
+        return self.parameters[self.key]
+
+    def _compression(self):
+        if 'images' in self.parameters and self.key in self.parameters['images']:
+            return self.parameters['images'][self.key].get('compression', False)
+        if self.key == 'ramdisk':
+            self.logger.debug("Not decompressing ramdisk as can be used compressed.")
+            return False
+        return self.parameters[self.key].get('compression', False)
+
+    def _download_cache(self):
+        """
+        The download cache is shared by all jobs on this worker.
+        Returns None if the cache cannot be used.
+        """
+        return DownloadCache.from_job(self.job)
+
     @contextlib.contextmanager
     def _decompressor_stream(self):  # pylint: disable=too-many-branches
         dwnld_file = None
-        compression = False
-        if 'images' in self.parameters and self.key in self.parameters['images']:
-            compression = self.parameters['images'][self.key].get('compression', False)
-        else:
-            if self.key == 'ramdisk':
-                self.logger.debug("Not decompressing ramdisk as can be used compressed.")
-            else:
-                compression = self.parameters[self.key].get('compression', False)
+        compression = self._compression()
 
         fname, _ = self._url_to_fname_suffix(self.path, compression)
         if os.path.exists(fname):
@@ -167,18 +264,19 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
         else:
             self.logger.debug("No compression specified.")
 
-        def write(buff):
-            if decompressor:
-                try:
-                    buff = decompressor.decompress(buff)
-                except (IOError, lzma.error, zlib.error) as exc:
-                    self.logger.exception(str(exc))
-                    raise JobError(exc)
-            dwnld_file.write(buff)
+        def decompress(buff):
+            try:
+                return decompressor.decompress(buff)
+            except (IOError, LZMA_ERROR, zlib.error) as exc:
+                self.logger.exception(str(exc))
+                raise JobError(exc)
 
         try:
-            dwnld_file = open(fname, 'wb')
-            yield (write, fname)
+            if self._writes_file():
+                yield (None, None, fname)
+            else:
+                dwnld_file = open(fname, 'wb')
+                yield (decompress if decompressor else None, dwnld_file.write, fname)
         finally:
             if dwnld_file:
                 dwnld_file.close()
@@ -213,32 +311,37 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
         if self.key == 'kernel':
             self.set_common_data('type', self.key, self.parameters[self.key].get('type', None))
 
-    def run(self, connection, args=None):  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    def _download(self, remote):  # pylint: disable=too-many-locals
+        """
+        Downloads and decompresses the remote file.
+        :return: the filename of the download
+        """
         def progress_unknown_total(downloaded_size, last_value):
             """ Compute progress when the size is unknown """
             condition = downloaded_size >= last_value + 25 * 1024 * 1024
             return (condition, downloaded_size,
-                    "progress %dMB" % (int(downloaded_size / (1024 * 1024))) if condition else "")
+                    "%s progress %dMB" % (self.key, int(downloaded_size / (1024 * 1024))) if condition else "")
 
         def progress_known_total(downloaded_size, last_value):
             """ Compute progress when the size is known """
             percent = math.floor(downloaded_size / float(self.size) * 100)
             condition = percent >= last_value + 5
             return (condition, percent,
-                    "progress %3d%% (%dMB)" % (percent, int(downloaded_size / (1024 * 1024))) if condition else "")
+                    "%s progress %3d%% (%dMB)" % (self.key, percent, int(downloaded_size / (1024 * 1024))) if condition else "")
 
-        connection = super(DownloadHandler, self).run(connection, args)
         # self.cookies = self.job.context.config.lava_cookies  # FIXME: work out how to restore
-        md5 = hashlib.md5()
-        sha256 = hashlib.sha256()
-        with self._decompressor_stream() as (writer, fname):
+        # only calculate the checksums which have been requested
+        digests = OrderedDict()
+        if remote.get('md5sum', None) is not None:
+            digests['md5'] = hashlib.md5()
+        if remote.get('sha256sum', None) is not None:
+            digests['sha256'] = hashlib.sha256()
 
-            if 'images' in self.parameters and self.key in self.parameters['images']:
-                remote = self.parameters['images'][self.key]
-            else:
-                remote = self.parameters[self.key]
-            md5sum = remote.get('md5sum', None)
-            sha256sum = remote.get('sha256sum', None)
+        def checksum(buff):
+            for digest in digests.values():
+                digest.update(buff)
+
+        with self._decompressor_stream() as (decompress, write, fname):
 
             self.logger.info("downloading %s as %s" % (remote['url'], fname))
 
@@ -254,34 +357,67 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
                 last_value = -5
                 progress = progress_known_total
 
+            # network reads stay in this thread, the checksums, the
+            # decompression and the writes each run in their own thread.
+            writer = None
+            stages = []
+            heads = []
+            if write:
+                writer = DownloadStage('write', write)
+                stages = [writer]
+                heads = [writer]
+            if decompress:
+                decompressor = DownloadStage('decompress', decompress, writer)
+                stages.append(decompressor)
+                heads = [decompressor]
+            if digests:
+                hasher = DownloadStage('checksum', checksum)
+                stages.append(hasher)
+                heads.append(hasher)
+            for stage in stages:
+                stage.start()
+
             # Download the file and log the progresses
-            for buff in self.reader():
-                downloaded_size += len(buff)
-                (printing, new_value, msg) = progress(downloaded_size, last_value)
-                if printing:
-                    last_value = new_value
-                    self.logger.debug(msg)
-                md5.update(buff)
-                sha256.update(buff)
-                writer(buff)
+            try:
+                for buff in self.reader():
+                    DeadlineManager.check()
+                    downloaded_size += len(buff)
+                    (printing, new_value, msg) = progress(downloaded_size, last_value)
+                    if printing:
+                        last_value = new_value
+                        self.logger.debug(msg)
+                    for stage in heads:
+                        stage.put(buff)
+                    if any([stage.error for stage in stages]):
+                        break
+            finally:
+                for stage in heads:
+                    stage.put(None)
+                for stage in stages:
+                    stage.wait()
+            for stage in stages:
+                if stage.error:
+                    raise stage.error
 
             # Log the download speed
             ending = time.time()
             self.logger.info("%dMB downloaded in %0.2fs (%0.2fMB/s)" %
                              (downloaded_size / (1024 * 1024), round(ending - beginning, 2),
                               round(downloaded_size / (1024 * 1024 * (ending - beginning)), 2)))
+            for stage in stages:
+                self.logger.debug(stage.throughput())
 
         # set the dynamic data into the context
         self.data['download_action'][self.key]['file'] = fname
-        self.data['download_action'][self.key]['md5'] = md5.hexdigest()
-        self.data['download_action'][self.key]['sha256'] = sha256.hexdigest()
+        for name, digest in digests.items():
+            self.data['download_action'][self.key][name] = digest.hexdigest()
+        return fname
 
+    def _check_checksums(self, fname, md5sum, sha256sum):
         if md5sum is not None:
             if md5sum != self.data['download_action'][self.key]['md5']:
                 self.logger.error("md5sum of downloaded content: %s" % (
                     self.data['download_action'][self.key]['md5']))
-                self.logger.info("sha256sum of downloaded content: %s" % (
-                    self.data['download_action'][self.key]['sha256']))
                 self.results = {'fail': {
                     'md5': md5sum, 'download': self.data['download_action'][self.key]['md5']}}
                 raise JobError("MD5 checksum for '%s' does not match." % fname)
@@ -289,8 +425,6 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
 
         if sha256sum is not None:
             if sha256sum != self.data['download_action'][self.key]['sha256']:
-                self.logger.info("md5sum of downloaded content: %s" % (
-                    self.data['download_action'][self.key]['md5']))
                 self.logger.error("sha256sum of downloaded content: %s" % (
                     self.data['download_action'][self.key]['sha256']))
                 self.results = {'fail': {
@@ -298,6 +432,55 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
                 raise JobError("SHA256 checksum for '%s' does not match." % fname)
             self.results = {'success': {'sha256': sha256sum}}
 
+    def _cached_download(self, cache, remote, md5sum, sha256sum):
+        """
+        Serves the download from the worker cache or downloads into
+        the cache. The file is copied out of the cache unless the key is
+        known to be read-only, so a later change cannot alter the entry.
+        :return: the filename of the download
+        """
+        compression = self._compression()
+        fname, _ = self._url_to_fname_suffix(self.path, compression)
+        copy = self.key not in self.cache_link_keys or \
+            self.data['download_action'][self.key].get('overlay', False)
+        with cache.lookup(remote['url'], md5sum, sha256sum, compression) as entry:
+            if entry.hit:
+                self.logger.info("using cached copy of %s as %s" % (remote['url'], fname))
+                metadata = entry.fetch(fname, copy)
+                self.data['download_action'][self.key]['file'] = fname
+                for name in ['md5', 'sha256']:
+                    if metadata.get(name, None):
+                        self.data['download_action'][self.key][name] = metadata[name]
+                self.results = {'cache': 'hit'}
+                self._check_checksums(fname, md5sum, sha256sum)
+            else:
+                fname = self._download(remote)
+                self._check_checksums(fname, md5sum, sha256sum)
+                entry.store(fname, {
+                    'url': remote['url'],
+                    'md5': self.data['download_action'][self.key].get('md5', None),
+                    'sha256': self.data['download_action'][self.key].get('sha256', None)
+                }, copy)
+                self.results = {'cache': 'miss'}
+        cache.trim()
+        return fname
+
+    def run(self, connection, args=None):
+        connection = super(DownloadHandler, self).run(connection, args)
+        remote = self._remote()
+        md5sum = remote.get('md5sum', None)
+        sha256sum = remote.get('sha256sum', None)
+
+        # only downloads with a known checksum can be safely shared between jobs
+        cache = None
+        if md5sum or sha256sum:
+            cache = self._download_cache()
+        if cache:
+            fname = self._cached_download(cache, remote, md5sum, sha256sum)
+        else:
+            fname = self._download(remote)
+            self._check_checksums(fname, md5sum, sha256sum)
+
         # certain deployments need prefixes set
         if self.parameters['to'] == 'tftp':
             suffix = self.data['tftp-deploy'].get('suffix', '')
@@ -307,8 +490,10 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
             self.set_common_data('file', self.key, os.path.join(suffix, os.path.basename(fname)))
         else:
             self.set_common_data('file', self.key, fname)
-        self.logger.info("md5sum of downloaded content: %s" % (self.data['download_action'][self.key]['md5']))
-        self.logger.info("sha256sum of downloaded content: %s" % (self.data['download_action'][self.key]['sha256']))
+        if 'md5' in self.data['download_action'][self.key]:
+            self.logger.info("md5sum of downloaded content: %s" % (self.data['download_action'][self.key]['md5']))
+        if 'sha256' in self.data['download_action'][self.key]:
+            self.logger.info("sha256sum of downloaded content: %s" % (self.data['download_action'][self.key]['sha256']))
         return connection
 
 
@@ -356,6 +541,7 @@ class HttpDownloadAction(DownloadHandler):
         self.name = "http_download"
         self.description = "use http to download the file"
         self.summary = "http download"
+        self.accept_ranges = False
 
     def validate(self):
         super(HttpDownloadAction, self).validate()
@@ -372,20 +558,191 @@ class HttpDownloadAction(DownloadHandler):
                     self.errors = "Resources not available at '%s'" % (self.url.geturl())
 
             self.size = int(res.headers.get('content-length', -1))
+            self.accept_ranges = res.headers.get('accept-ranges', '') == 'bytes' and \
+                'content-encoding' not in res.headers
         except requests.Timeout:
             self.errors = "'%s' timed out" % (self.url.geturl())
         except requests.RequestException as exc:
             # TODO: find a better way to report the error
             self.errors = str(exc)
 
+    def _partial_name(self):
+        """
+        Raw content already downloaded by a previous, failed, attempt
+        of the RetryAction. Kept until the download completes.
+        """
+        return os.path.join(self.path, "%s.partial" % os.path.basename(self.url.path))
+
+    def _writes_file(self):
+        # without decompression, the raw content is the downloaded file
+        return not self._compression()
+
+    def _complete(self, partial):
+        """
+        Moves the raw content of a complete download into place,
+        unless it has been decompressed into the downloaded file.
+        """
+        if self._writes_file():
+            fname, _ = self._url_to_fname_suffix(self.path, False)
+            os.rename(partial, fname)
+        else:
+            os.remove(partial)
+
+    def _request(self, offset):
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        return requests.get(self.url.geturl(), allow_redirects=True, stream=True,
+                            timeout=HTTP_DOWNLOAD_TIMEOUT, headers=headers)
+
+    def _segmented_reader(self, connections, segment_size, chunk_size):  # pylint: disable=too-many-locals,too-many-statements
+        """
+        Fetches byte ranges of the file over several connections at the
+        same time, writing each range at its offset in the partial file,
+        which is then moved into place as for other downloads. The content
+        is yielded in order as each segment completes so that checksums
+        and decompression overlap with the rest of the download.
+        """
+        partial = self._partial_name()
+        segments = [(start, min(start + segment_size, self.size) - 1)
+                    for start in range(0, self.size, segment_size)]
+        done = [False] * len(segments)
+        failures = []
+        pending = queue.Queue()
+        for index in range(len(segments)):
+            pending.put(index)
+        condition = threading.Condition()
+        stop = threading.Event()
+        with open(partial, 'wb') as spool:
+            spool.truncate(self.size)
+
+        def fetch():
+            session = requests.Session()
+            try:
+                with open(partial, 'r+b') as spool:
+                    while not stop.is_set():
+                        try:
+                            index = pending.get_nowait()
+                        except queue.Empty:
+                            return
+                        start, end = segments[index]
+                        res = None
+                        try:
+                            res = session.get(
+                                self.url.geturl(), allow_redirects=True, stream=True,
+                                timeout=HTTP_DOWNLOAD_TIMEOUT,
+                                headers={'Range': 'bytes=%d-%d' % (start, end)})
+                            if res.status_code != requests.codes.partial_content:  # pylint: disable=no-member
+                                raise JobError("Unable to download bytes %d-%d of '%s'" % (
+                                    start, end, self.url.geturl()))
+                            spool.seek(start)
+                            for buff in res.iter_content(chunk_size):
+                                if stop.is_set():
+                                    return
+                                spool.write(buff)
+                            if spool.tell() != end + 1:
+                                raise JobError("Incomplete download of bytes %d-%d of '%s'" % (
+                                    start, end, self.url.geturl()))
+                            spool.flush()
+                        except (requests.RequestException, JobError, IOError) as exc:
+                            with condition:
+                                failures.append(exc)
+                                condition.notify_all()
+                            return
+                        finally:
+                            if res is not None:
+                                res.close()
+                        with condition:
+                            done[index] = True
+                            condition.notify_all()
+            finally:
+                session.close()
+
+        self.logger.debug("Downloading %d segments of %dMB using %d connections" % (
+            len(segments), int(segment_size / (1024 * 1024)), connections))
+        threads = []
+        for _ in range(min(connections, len(segments))):
+            thread = threading.Thread(target=fetch)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        complete = False
+        try:
+            # unbuffered, a read-ahead buffer could hold content from
+            # before the next segment was written.
+            with open(partial, 'rb', 0) as spool:
+                for index, (start, end) in enumerate(segments):
+                    with condition:
+                        while not done[index] and not failures:
+                            condition.wait(1)
+                            DeadlineManager.check()
+                        if failures:
+                            raise JobError(failures[0])
+                    spool.seek(start)
+                    remaining = end - start + 1
+                    while remaining:
+                        buff = spool.read(min(chunk_size, remaining))
+                        remaining -= len(buff)
+                        yield buff
+            complete = True
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if complete:
+                self._complete(partial)
+            else:
+                # the missing ranges are holes, so the file cannot be resumed
+                os.remove(partial)
+
     def reader(self):
+        config = deploy_parameters(self.job, 'http_download')
+        connections = config.get('connections', HTTP_DOWNLOAD_CONNECTIONS)
+        segment_size = config.get('segment_size', HTTP_DOWNLOAD_SEGMENT_SIZE)
+        chunk_size = config.get('chunk_size', HTTP_DOWNLOAD_CHUNK_SIZE)
+        if connections > 1 and self.accept_ranges and self.size > segment_size:
+            return self._segmented_reader(connections, segment_size, chunk_size)
+        return self._stream_reader(chunk_size)
+
+    def _stream_reader(self, chunk_size):
         res = None
+        partial = self._partial_name()
+        offset = 0
+        if os.path.exists(partial):
+            offset = os.stat(partial).st_size
         try:
-            res = requests.get(self.url.geturl(), allow_redirects=True, stream=True, timeout=HTTP_DOWNLOAD_TIMEOUT)
-            if res.status_code != requests.codes.OK:  # pylint: disable=no-member
+            res = self._request(offset)
+            if offset and res.status_code == requests.codes.partial_content and \
+                    res.headers.get('content-range', '').startswith('bytes %d-' % offset):  # pylint: disable=no-member
+                self.logger.info("Resuming download of %s from %dMB" % (
+                    self.url.geturl(), int(offset / (1024 * 1024))))
+                mode = 'ab'
+                # replay the content of the previous attempt so that the
+                # checksums and the decompression see the entire file.
+                with open(partial, 'rb') as previous:
+                    buff = previous.read(FILE_DOWNLOAD_CHUNK_SIZE)
+                    while buff:
+                        yield buff
+                        buff = previous.read(FILE_DOWNLOAD_CHUNK_SIZE)
+            else:
+                if offset:
+                    self.logger.debug("Unable to resume the download, restarting")
+                    if res.status_code != requests.codes.OK:  # pylint: disable=no-member
+                        res.close()
+                        res = self._request(0)
+                mode = 'wb'
+            if res.status_code != requests.codes.OK and mode == 'wb':  # pylint: disable=no-member
                 raise JobError("Unable to download '%s'" % (self.url.geturl()))
-            for buff in res.iter_content(HTTP_DOWNLOAD_CHUNK_SIZE):
-                yield buff
+            with open(partial, mode) as spool:
+                for buff in res.iter_content(chunk_size):
+                    spool.write(buff)
+                    yield buff
+            # keep the partial content if the connection was closed early
+            expected = res.headers.get('content-length', None)
+            if expected is not None and res.raw.tell() < int(expected):
+                raise JobError("Download of '%s' interrupted after %d of %s bytes" % (
+                    self.url.geturl(), res.raw.tell(), expected))
+            self._complete(partial)
         except requests.RequestException as exc:
             # TODO: improve error reporting
             raise JobError(exc)
@@ -408,11 +765,11 @@ class ScpDownloadAction(DownloadHandler):
     def validate(self):
         super(ScpDownloadAction, self).validate()
         try:
-            size = subprocess.check_output(['nice', 'ssh',
-                                            self.url.netloc,
-                                            'stat', '-c', '%s',
-                                            self.url.path],
-                                           stderr=subprocess.STDOUT)
+            size = DeadlineManager.check_output(['nice', 'ssh',
+                                                 self.url.netloc,
+                                                 'stat', '-c', '%s',
+                                                 self.url.path],
+                                                stderr=subprocess.STDOUT)
             self.size = int(size)
         except subprocess.CalledProcessError as exc:
             self.errors = str(exc)
@@ -424,10 +781,17 @@ class ScpDownloadAction(DownloadHandler):
                 ['nice', 'ssh', self.url.netloc, 'cat', self.url.path],
                 stdout=subprocess.PIPE
             )
-            buff = process.stdout.read(SCP_DOWNLOAD_CHUNK_SIZE)
-            while buff:
+            # wait for the output in short polls, so that a stalled
+            # connection cannot hold the download past the deadline.
+            fileno = process.stdout.fileno()
+            while True:
+                DeadlineManager.check()
+                if not select.select([fileno], [], [], 0.1)[0]:
+                    continue
+                buff = os.read(fileno, SCP_DOWNLOAD_CHUNK_SIZE)
+                if not buff:
+                    break
                 yield buff
-                buff = process.stdout.read(SCP_DOWNLOAD_CHUNK_SIZE)
             if process.wait() != 0:
                 raise JobError("Dowloading '%s' failed with message '%s'"
                                % (self.url.geturl(), process.stderr.read()))
@@ -451,6 +815,8 @@ class QCowConversionAction(Action):
         self.description = "convert qcow image using qemu-img"
         self.summary = "qcow conversion"
         self.key = key
+        self.reads = ['download_action.%s' % key]
+        self.writes = ['download_action.%s' % key, 'common.file.%s' % key]
 
     def run(self, connection, args=None):
         if self.key not in self.data['download_action']:
@@ -465,8 +831,8 @@ class QCowConversionAction(Action):
             fname += ".img"
 
         self.logger.debug("Converting downloaded image from qcow2 to raw")
-        subprocess.check_call(['qemu-img', 'convert', '-f', 'qcow2',
-                               '-O', 'raw', origin, fname])
+        DeadlineManager.check_output(['qemu-img', 'convert', '-f', 'qcow2',
+                                      '-O', 'raw', origin, fname])
         self.data['download_action'][self.key]['file'] = fname
         self.set_common_data('file', self.key, fname)
         return connection
@@ -35,6 +35,8 @@ class DeployDeviceEnvironment(Action):
         self.summary = "deploy device environment"
         self.description = "deploy device environment"
         self.env = ""
+        self.reads = []
+        self.writes = ['common.environment']
 
     def validate(self):
         if 'lava_test_shell_file' not in \
@@ -43,6 +43,8 @@ class CustomisationAction(DeployAction):
         self.name = "customise"
         self.description = "customise image during deployment"
         self.summary = "customise image"
+        self.reads = []
+        self.writes = []
 
     def run(self, connection, args=None):
         connection = super(CustomisationAction, self).run(connection, args)
@@ -86,6 +88,12 @@ class OverlayAction(DeployAction):
         self.v2_scripts_to_copy = []
         # 755 file permissions
         self.xmod = stat.S_IRWXU | stat.S_IXGRP | stat.S_IRGRP | stat.S_IXOTH | stat.S_IROTH
+        # the context keys used by the internal pipeline are included,
+        # so that the overlay can be built whilst the images download.
+        self.reads = ['lava_test_results_dir']
+        self.writes = ['lava-overlay', 'test', 'test-definition', 'compress-overlay',
+                       'common.authorize', 'common.nfs_url', 'common.repo-action',
+                       'common.test-definition', 'common.test-runscript-overlay']
 
     def validate(self):
         super(OverlayAction, self).validate()
@@ -98,6 +106,7 @@ class OverlayAction(DeployAction):
         namespace = self.parameters.get('namespace', None)
         if namespace:
             self.action_namespaces.append(namespace)
+            self.writes.append('common.%s' % namespace)
             self.set_common_data(namespace, 'lava_test_results_dir',
                                  lava_test_results_dir)
             lava_test_sh_cmd = self.parameters['deployment_data']['lava_test_sh_cmd']
@@ -202,6 +211,8 @@ class MultinodeOverlayAction(OverlayAction):
             '%s/../../../pipeline/lava_test_shell/multi_node/' % os.path.dirname(__file__))
         self.role = None
         self.protocol = MultinodeProtocol.name
+        self.reads = ['lava-overlay', 'lava_test_results_dir']
+        self.writes = []
 
     def populate(self, parameters):
         # override the populate function of overlay action which provides the
@@ -320,6 +331,8 @@ class VlandOverlayAction(OverlayAction):
         self.tags = []
         self.names = []
         self.protocol = VlandProtocol.name
+        self.reads = ['lava-overlay', 'lava_test_results_dir']
+        self.writes = []
 
     def populate(self, parameters):
         # override the populate function of overlay action which provides the
@@ -24,10 +24,15 @@ import re
 import yaml
 import base64
 import hashlib
+import sys
 import tarfile
 import shutil
 from collections import OrderedDict
 from nose.tools import nottest
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 from lava_dispatcher.pipeline.action import (
     Action,
     InfrastructureError,
@@ -36,9 +41,47 @@ from lava_dispatcher.pipeline.action import (
     TestError,
 )
 from lava_dispatcher.pipeline.actions.test import TestAction
+from lava_dispatcher.pipeline.device import deploy_parameters
+from lava_dispatcher.pipeline.utils.cache import DownloadCache
 from lava_dispatcher.pipeline.utils.strings import indices
-from lava_dispatcher.pipeline.utils.vcs import BzrHelper, GitHelper
-from lava_dispatcher.pipeline.utils.constants import DEFAULT_V1_FIXUP, DEFAULT_V1_PATTERN
+from lava_dispatcher.pipeline.utils.vcs import (
+    BzrHelper,
+    GitHelper,
+    TarHelper,
+    URLHelper,
+)
+from lava_dispatcher.pipeline.utils.constants import (
+    DEFAULT_V1_FIXUP,
+    DEFAULT_V1_PATTERN,
+    GIT_MIRROR_DIR,
+)
+
+if sys.version_info[0] == 2:
+    import urlparse as lavaurl
+elif sys.version_info[0] == 3:
+    import urllib.parse as lavaurl  # pylint: disable=no-name-in-module,import-error
+
+
+def load_testdef(job, yaml_file):
+    """
+    Parses each test definition YAML file once per job, using the libyaml
+    loader if available. The parsed testdef is shared by the handler and
+    overlay actions of the test definition, so callers must not modify it.
+    The cache is keyed by the path and is reloaded if the modification time
+    or size of the file has changed.
+    """
+    try:
+        info = os.stat(yaml_file)
+    except OSError:
+        raise JobError("Unable to find test definition YAML: %s" % yaml_file)
+    cache = job.context.setdefault('testdef-cache', {})
+    stamp = (info.st_mtime, info.st_size)
+    if yaml_file in cache and cache[yaml_file][0] == stamp:
+        return cache[yaml_file][1]
+    with open(yaml_file, 'r') as test_file:
+        testdef = yaml.load(test_file, Loader=SafeLoader)
+    cache[yaml_file] = (stamp, testdef)
+    return testdef
 
 
 def identify_test_definitions(parameters):
@@ -158,23 +201,14 @@ class RepoAction(Action):
         if 'test_name' not in self.parameters:
             self.errors = "Unable to determine test_name"
             return
-        if not isinstance(self, InlineRepoAction):
-            if self.vcs is None:
-                raise RuntimeError("RepoAction validate called super without setting the vcs")
-            if not os.path.exists(self.vcs.binary):
-                self.errors = "%s is not installed on the dispatcher." % self.vcs.binary
+        if self.vcs is None and not isinstance(self, (InlineRepoAction, TarRepoAction)):
+            raise RuntimeError("RepoAction validate called super without setting the vcs")
+        if self.vcs and self.vcs.binary and not os.path.exists(self.vcs.binary):
+            self.errors = "%s is not installed on the dispatcher." % self.vcs.binary
         # a genuinely unique ID based on the *database* JobID and pipeline level for reproducibility
         # and tracking - {DB-JobID}_{PipelineLevel}, e.g. 15432.0_3.5.4
         self.uuid = "%s_%s" % (self.job.job_id, self.level)
         super(RepoAction, self).validate()
-        # list of levels involved in the repo actions for this overlay
-        uuid_list = self.get_common_data('repo-action', 'uuid-list')
-        if uuid_list:
-            if self.uuid not in uuid_list:
-                uuid_list.append(self.uuid)
-        else:
-            uuid_list = [self.uuid]
-        self.set_common_data('repo-action', 'uuid-list', uuid_list)
 
     def run(self, connection, args=None):
         """
@@ -281,9 +315,19 @@ class GitRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
             self.errors = "Path to YAML file not specified in the job definition"
         if not self.valid:
             return
-        self.vcs = GitHelper(self.parameters['repository'])
+        self.vcs = GitHelper(self.parameters['repository'], self._mirror_dir())
         super(GitRepoAction, self).validate()
 
+    def _mirror_dir(self):
+        """
+        The git mirrors are shared by all jobs on this worker.
+        The location can be set in the deploy parameters of the
+        device dictionary using git_mirror: path, an empty path
+        disables the mirrors.
+        """
+        config = deploy_parameters(self.job, 'git_mirror')
+        return config.get('path', GIT_MIRROR_DIR) or None
+
     @classmethod
     def accepts(cls, repo_type):
         if repo_type == 'git':
@@ -321,10 +365,7 @@ class GitRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
         # now read the YAML to create a testdef dict to retrieve metadata
         yaml_file = os.path.join(runner_path, self.parameters['path'])
         self.logger.debug("Tests stored (tmp) in %s", yaml_file)
-        if not os.path.exists(yaml_file):
-            raise JobError("Unable to find test definition YAML: %s" % yaml_file)
-        with open(yaml_file, 'r') as test_file:
-            testdef = yaml.safe_load(test_file)
+        testdef = load_testdef(self.job, yaml_file)
 
         # set testdef metadata in base class
         self.store_testdef(testdef, 'git', commit_id)
@@ -385,10 +426,7 @@ class BzrRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
 
         # now read the YAML to create a testdef dict to retrieve metadata
         yaml_file = os.path.join(runner_path, self.parameters['path'])
-        if not os.path.exists(yaml_file):
-            raise JobError("Unable to find test definition YAML: %s" % yaml_file)
-        with open(yaml_file, 'r') as test_file:
-            self.testdef = yaml.safe_load(test_file)
+        self.testdef = load_testdef(self.job, yaml_file)
 
         # set testdef metadata in base class
         self.store_testdef(self.testdef, 'bzr', commit_id)
@@ -463,6 +501,18 @@ class TarRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
         self.summary = "unpack tar test repo"
         self.vcs_binary = "/bin/tar"
 
+    def validate(self):
+        if 'repository' not in self.parameters:
+            self.errors = "Tar repository not specified in job definition"
+        if 'path' not in self.parameters:
+            self.errors = "Path to YAML file not specified in the job definition"
+        if not self.valid:
+            return
+        # otherwise, the repository is a base64 encoded tarball
+        if '://' in self.parameters['repository']:
+            self.vcs = TarHelper(self.parameters['repository'])
+        super(TarRepoAction, self).validate()
+
     @classmethod
     def accepts(cls, repo_type):
         if repo_type == 'tar':
@@ -471,35 +521,34 @@ class TarRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
 
     def run(self, connection, args=None):
         """
-        Extracts the provided encoded tar archive into tmpdir.
+        Extracts the tarball, downloaded or provided as a base64 encoded
+        archive, into the overlay without writing the tarball to disc.
         """
-        connection = super(TarRepoAction, self).run(connection, args)
-        runner_path = os.path.join(self.data['test-definition']['overlay_dir'], 'tests', self.parameters['test_name'])
-        temp_tar = os.path.join(self.data['test-definition']['overlay_dir'], "tar-repo.tar")
+        connection = super(TarRepoAction, self).run(connection, self.parameters)
+        runner_path = self.data['test'][self.uuid]['overlay_path'][self.parameters['test_name']]
 
-        try:
-            if not os.path.isdir(runner_path):
-                self.logger.debug("Creating directory to extract the tar archive into.")
-                os.makedirs(runner_path)
-
-            encoded_in = io.StringIO(self.parameters['repository'])
-            decoded_out = io.StringIO()
-            base64.decode(encoded_in, decoded_out)
-
-            # The following two operations can also be done in memory
-            # using cStringIO.
-            # At the moment the tar file sent is not big, but that can change.
-            with open(temp_tar, "w") as write_tar:
-                write_tar.write(decoded_out.getvalue())
-
-            with tarfile.open(temp_tar) as tar:
-                tar.extractall(path=runner_path)
-        except (OSError, tarfile.TarError) as ex:
-            raise JobError("Error extracting the tar archive.\n" + str(ex))
-        finally:
-            # Remove the temporary created tar file after it has been extracted.
-            if os.path.isfile(temp_tar):
-                os.unlink(temp_tar)
+        if self.vcs:
+            self.logger.info("Fetching tests from %s", self.parameters['repository'])
+            self.vcs.cache = DownloadCache.from_job(self.job)
+            commit_id = self.vcs.clone(runner_path, self.parameters.get('revision', None))
+        else:
+            try:
+                if not os.path.isdir(runner_path):
+                    self.logger.debug("Creating directory to extract the tar archive into.")
+                    os.makedirs(runner_path)
+                data = base64.b64decode(self.parameters['repository'])
+                commit_id = hashlib.sha256(data).hexdigest()
+                with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                    tar.extractall(path=runner_path)
+            except (OSError, TypeError, ValueError, tarfile.TarError) as ex:
+                raise JobError("Error extracting the tar archive.\n" + str(ex))
+        self.results = {
+            'success': commit_id,
+            'path': self.parameters['path']}
+
+        yaml_file = os.path.join(runner_path, self.parameters['path'])
+        testdef = load_testdef(self.job, yaml_file)
+        self.store_testdef(testdef, 'tar', commit_id)
         return connection
 
 
@@ -512,9 +561,18 @@ class UrlRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
         self.name = "url-repo-action"
         self.description = "apply a single test file to the test image"
         self.summary = "download file test"
-        self.tmpdir = None  # FIXME: needs to be a /mntpoint/lava-%hostname/ directory.
         self.testdef = None
 
+    def validate(self):
+        if 'repository' not in self.parameters:
+            self.errors = "Test definition URL not specified in job definition"
+        if not self.parameters.get('path', None):
+            self.errors = "Unable to determine the file name of the test definition URL"
+        if not self.valid:
+            return
+        self.vcs = URLHelper(self.parameters['repository'])
+        super(UrlRepoAction, self).validate()
+
     @classmethod
     def accepts(cls, repo_type):
         if repo_type == 'url':
@@ -522,23 +580,21 @@ class UrlRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
         return False
 
     def run(self, connection, args=None):
-        """Download the provided test definition file into tmpdir."""
-        super(UrlRepoAction, self).run(connection, args)
-        runner_path = os.path.join(self.data['test-definition']['overlay_dir'], 'tests', self.parameters['test_name'])
+        """Download the provided test definition file into the overlay."""
+        connection = super(UrlRepoAction, self).run(connection, self.parameters)
+        runner_path = self.data['test'][self.uuid]['overlay_path'][self.parameters['test_name']]
 
+        self.vcs.cache = DownloadCache.from_job(self.job)
         try:
-            if not os.path.isdir(runner_path):
-                self.logger.debug("Creating directory to download the url file into.")
-                os.makedirs(runner_path)
-            # we will not use 'testdef_file' here, we can get this info from URL
-            # testdef_file = download_image(testdef_repo, context, urldir)
-            # FIXME: this handler uses DownloaderAction.run()
-
+            commit_id = self.vcs.clone(runner_path)
         except OSError as exc:
             raise JobError('Unable to get test definition from url\n' + str(exc))
-        finally:
-            self.logger.info("Downloaded test definition file to %s." % runner_path)
+        self.logger.info("Downloaded test definition file to %s." % runner_path)
+        self.results = {
+            'success': commit_id,
+            'repository': self.parameters['repository']}
 
+        self.testdef = load_testdef(self.job, os.path.join(runner_path, self.parameters['path']))
         i = []
         for elem in " $&()\"'<>/\\|;`":
             i.extend(indices(self.testdef["metadata"]["name"], elem))
@@ -552,6 +608,7 @@ class UrlRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
             msg = "Test name contains non-ascii symbols: %s" % encode
             raise JobError(msg)
 
+        self.store_testdef(self.testdef, 'url', commit_id)
         return connection
 
 
@@ -591,6 +648,10 @@ class TestDefinitionAction(TestAction):
                 # namespace support allows only running the install steps for the relevant
                 # deployment as the next deployment could be a different OS.
                 handler = RepoAction.select(testdef['from'])()
+                if testdef['from'] == 'url' and 'path' not in testdef:
+                    # the downloaded file is stored using the name in the URL
+                    testdef['path'] = os.path.basename(
+                        lavaurl.urlparse(testdef.get('repository', '')).path)
 
                 # set the full set of job YAML parameters for this handler as handler parameters.
                 handler.job = self.job
@@ -599,6 +660,11 @@ class TestDefinitionAction(TestAction):
                 handler.parameters['test_name'] = "%s_%s" % (len(list(index.keys())), handler.parameters['name'])
                 self.internal_pipeline.add_action(handler)
                 handler.uuid = "%s_%s" % (self.job.job_id, handler.level)
+                # repositories are fetched at the same time, each overlay
+                # only waits for the handler of the same test definition.
+                handler.concurrent = True
+                handler.reads = ['common', 'lava-overlay', 'lava_test_results_dir', 'test-definition']
+                handler.writes = ['test.%s' % handler.uuid]
 
                 # copy details into the overlay, one per handler but the same class each time.
                 overlay = TestOverlayAction()
@@ -624,9 +690,11 @@ class TestDefinitionAction(TestAction):
                 index[len(list(index.keys()))] = handler.parameters['name']
 
                 # add overlay handlers to the pipeline
-                self.internal_pipeline.add_action(overlay)
-                self.internal_pipeline.add_action(installer)
-                self.internal_pipeline.add_action(runsh)
+                for action in [overlay, installer, runsh]:
+                    action.concurrent = True
+                    action.reads = ['test.%s' % handler.uuid]
+                    action.writes = []
+                    self.internal_pipeline.add_action(action)
                 self.set_common_data(self.name, 'testdef_index', index)
 
     def validate(self):
@@ -634,7 +702,11 @@ class TestDefinitionAction(TestAction):
         TestDefinitionAction is part of the overlay and therefore part of the deployment -
         the internal pipeline then looks inside the job definition for details of the tests to deploy.
         Jobs with no test actions defined (empty test_list) are explicitly allowed.
+        The handlers and overlays are validated concurrently, so the shared data
+        is created here and the ordered lists are collated afterwards.
         """
+        if self.job and self.get_common_data('test-runscript-overlay', 'testdef_levels') is None:
+            self.set_common_data('test-runscript-overlay', 'testdef_levels', {})
         super(TestDefinitionAction, self).validate()
         if not self.job:
             self.errors = "missing job object"
@@ -648,6 +720,12 @@ class TestDefinitionAction(TestAction):
             if 'from' not in testdef:
                 self.errors = "missing 'from' field in test definition %s" % testdef
         self.internal_pipeline.validate_actions()
+        # list of levels involved in the repo actions for this overlay
+        uuid_list = self.get_common_data('repo-action', 'uuid-list') or []
+        for handler in self.internal_pipeline.actions:
+            if isinstance(handler, RepoAction) and handler.uuid not in uuid_list:
+                uuid_list.append(handler.uuid)
+        self.set_common_data('repo-action', 'uuid-list', uuid_list)
 
     def run(self, connection, args=None):
         """
@@ -752,12 +830,7 @@ class TestOverlayAction(TestAction):  # pylint: disable=too-many-instance-attrib
         runner_path = self.data['test'][self.test_uuid]['overlay_path'][self.parameters['test_name']]
         # now read the YAML to create a testdef dict to retrieve metadata
         yaml_file = os.path.join(runner_path, self.parameters['path'])
-        # FIXME: check the existence at the same time as the open.
-        if not os.path.exists(yaml_file):
-            raise JobError("Unable to find test definition YAML: %s" % yaml_file)
-
-        with open(yaml_file, 'r') as test_file:
-            testdef = yaml.safe_load(test_file)
+        testdef = load_testdef(self.job, yaml_file)
 
         # FIXME: change lava-test-runner to accept a variable instead of duplicating the YAML?
         with open("%s/testdef.yaml" % runner_path, 'w') as run_file:
@@ -820,15 +893,13 @@ class TestInstallAction(TestOverlayAction):
         super(TestInstallAction, self).validate()
 
     def run(self, connection, args=None):
-        connection = super(TestInstallAction, self).run(connection, args)
+        # testdef.yaml, uuid and testdef_metadata are written by the TestOverlayAction,
+        # which can run at the same time.
+        connection = super(TestOverlayAction, self).run(connection, args)  # pylint: disable=bad-super-call
         runner_path = self.data['test'][self.test_uuid]['overlay_path'][self.parameters['test_name']]
         # now read the YAML to create a testdef dict to retrieve metadata
         yaml_file = os.path.join(runner_path, self.parameters['path'])
-        if not os.path.exists(yaml_file):
-            raise JobError("Unable to find test definition YAML: %s" % yaml_file)
-
-        with open(yaml_file, 'r') as test_file:
-            testdef = yaml.safe_load(test_file)
+        testdef = load_testdef(self.job, yaml_file)
 
         if 'install' not in testdef:
             self.results = {'skipped %s' % self.name: self.test_uuid}
@@ -899,24 +970,23 @@ class TestRunnerAction(TestOverlayAction):
                 self.testdef_levels[self.level] = "%s_%s" % (count, name)
         if not self.testdef_levels:
             self.errors = "Unable to identify test definition names"
-        current = self.get_common_data(self.name, 'testdef_levels')
-        if current:
+        # updated in place as other runners may be validated at the same time
+        current = self.get_common_data(self.name, 'testdef_levels', deepcopy=False)
+        if current is not None:
             current.update(self.testdef_levels)
         else:
-            current = self.testdef_levels
-        self.set_common_data(self.name, 'testdef_levels', current)
+            self.set_common_data(self.name, 'testdef_levels', dict(self.testdef_levels))
 
     def run(self, connection, args=None):
-        connection = super(TestRunnerAction, self).run(connection, args)
+        # testdef.yaml, uuid and testdef_metadata are written by the TestOverlayAction,
+        # which can run at the same time.
+        connection = super(TestOverlayAction, self).run(connection, args)  # pylint: disable=bad-super-call
         runner_path = self.data['test'][self.test_uuid]['overlay_path'][self.parameters['test_name']]
         # now read the YAML to create a testdef dict to retrieve metadata
         yaml_file = os.path.join(runner_path, self.parameters['path'])
-        if not os.path.exists(yaml_file):
-            raise JobError("Unable to find test definition YAML: %s" % yaml_file)
+        testdef = load_testdef(self.job, yaml_file)
 
         testdef_levels = self.get_common_data('test-runscript-overlay', 'testdef_levels')
-        with open(yaml_file, 'r') as test_file:
-            testdef = yaml.safe_load(test_file)
 
         filename = '%s/run.sh' % runner_path
         content = self.handle_parameters(testdef)
@@ -21,10 +21,10 @@
 import re
 import sys
 import time
+import threading
 import yaml
 import logging
 import pexpect
-from collections import OrderedDict
 
 from lava_dispatcher.pipeline.actions.test import (
     TestAction,
@@ -42,13 +42,16 @@ from lava_dispatcher.pipeline.logical import (
 )
 from lava_dispatcher.pipeline.connection import (
     BaseSignalHandler,
-    SignalMatch
+    SignalMatch,
+    SignalScanner,
 )
 from lava_dispatcher.pipeline.utils.constants import (
     DEFAULT_SHELL_PROMPT,
     DEFAULT_V1_PATTERN,
     DEFAULT_V1_FIXUP,
 )
+from lava_dispatcher.pipeline.utils.network import dispatcher_ip
+from lava_dispatcher.pipeline.utils.results import ResultsListener, ResultsStore
 if sys.version > '3':
     from functools import reduce  # pylint: disable=redefined-builtin
 
@@ -149,10 +152,22 @@ class TestShellAction(TestAction):
         self.name = "lava-test-shell"
         self.signal_director = self.SignalDirector(None)  # no default protocol
         self.patterns = {}
+        self._scanners = {}
+        # lookup from the name of each LAVA_SIGNAL to the method handling it,
+        # which can return a different name to pass to the SignalDirector.
+        self._signal_handlers = {
+            "STARTRUN": self._signal_startrun,
+            "ENDRUN": self._signal_endrun,
+            "TESTCASE": self._signal_testcase,
+            "TESTSET": self._signal_testset,
+        }
         self.signal_match = SignalMatch()
         self.definition = None
         self.testset_name = None  # FIXME
-        self.report = {}
+        self._store = ResultsStore()
+        # keys of the results posted to the results listener, if used
+        self._received = set()
+        self._results_lock = threading.Lock()
         self.start = None
         self.testdef_dict = {}
         # noinspection PyTypeChecker
@@ -198,6 +213,8 @@ class TestShellAction(TestAction):
             raise InfrastructureError("Connection closed")
 
         self.signal_director.connection = connection
+        self._store = ResultsStore(self.job.parameters.get('output_dir', None) if self.job else None)
+        self._received = set()
 
         pattern_dict = {self.pattern.name: self.pattern}
         # pattern dictionary is the lookup from the STARTRUN to the parse pattern.
@@ -220,10 +237,20 @@ class TestShellAction(TestAction):
             for command in pre_command_list:
                 connection.sendline(command)
 
+        listener = None
+        environment = ''
+        if self.parameters.get('results_listener', False):
+            address = self.job.device.get('results_listener_address', None) or dispatcher_ip()
+            listener = ResultsListener(self._post_result, address)
+            listener.start()
+            self.logger.info("Listening for test case results on %s", listener.url)
+            environment = 'LAVA_RESULTS_URL=%s ' % listener.url
+
         with connection.test_connection() as test_connection:
             # the structure of lava-test-runner means that there is just one TestAction and it must run all definitions
             test_connection.sendline(
-                "%s/bin/lava-test-runner %s" % (
+                "%s%s/bin/lava-test-runner %s" % (
+                    environment,
                     self.data["lava_test_results_dir"],
                     self.data["lava_test_results_dir"]),
                 delay=self.character_delay)
@@ -236,10 +263,18 @@ class TestShellAction(TestAction):
                 self.logger.info("Setting connection timeout: %.0f seconds" % self.connection_timeout.duration)
                 test_connection.timeout = self.connection_timeout.duration
 
-            while self._keep_running(test_connection, test_connection.timeout, connection.check_char):
-                pass
-
-        self.logger.debug(yaml.dump(self.report))
+            try:
+                while self._keep_running(test_connection, test_connection.timeout, connection.check_char):
+                    pass
+            finally:
+                if listener:
+                    listener.stop()
+                    self.logger.debug("%d results received by the listener, %d rejected",
+                                      listener.received, listener.rejected)
+                self._store.close()
+
+        self.logger.debug("%d test case results", len(self._store))
+        self.logger.debug(yaml.safe_dump(self._store.totals()))
         return connection
 
     def parse_v2_case_result(self, data, fixupdict=None):
@@ -302,109 +337,9 @@ class TestShellAction(TestAction):
             name, params = test_connection.match.groups()
             self.logger.debug("Received signal: <%s> %s" % (name, params))
             params = params.split()
-            if name == "STARTRUN":
-                self.signal_director.test_uuid = params[1]
-                self.definition = params[0]
-                uuid = params[1]
-                self.start = time.time()
-                self.logger.debug("Starting test definition: %s" % self.definition)
-                self.logger.info("Starting test lava.%s (%s)", self.definition, uuid)
-                # set the pattern for this run from pattern_dict
-                testdef_index = self.get_common_data('test-definition', 'testdef_index')
-                uuid_list = self.get_common_data('repo-action', 'uuid-list')
-                for key, value in testdef_index.items():
-                    if self.definition == "%s_%s" % (key, value):
-                        pattern = self.job.context['test'][uuid_list[key]]['testdef_pattern']['pattern']
-                        fixup = self.job.context['test'][uuid_list[key]]['testdef_pattern']['fixupdict']
-                        self.patterns.update({'test_case_result': re.compile(pattern, re.M)})
-                        self.pattern.update(pattern, fixup)
-                        self.logger.info("Enabling test definition pattern %r" % pattern)
-                self.logger.results({
-                    "definition": "lava",
-                    "case": self.definition,
-                    "uuid": uuid,
-                    # The test is marked as failed and updated to "pass" when finished.
-                    # If something goes wrong then it will stay to "fail".
-                    "result": "fail"
-                })
-            elif name == "ENDRUN":
-                self.definition = params[0]
-                uuid = params[1]
-                # remove the pattern for this run from pattern_dict
-                self._reset_patterns()
-                # catch error in ENDRUN being handled without STARTRUN
-                if not self.start:
-                    self.start = time.time()
-                self.logger.info("Ending use of test pattern.")
-                self.logger.info("Ending test lava.%s (%s), duration %.02f",
-                                 self.definition, uuid,
-                                 time.time() - self.start)
-                self.logger.results({
-                    "definition": "lava",
-                    "case": self.definition,
-                    "uuid": uuid,
-                    "duration": "%.02f" % (time.time() - self.start),
-                    "result": "pass"
-                })
-                self.start = None
-            elif name == "TESTCASE":
-                data = handle_testcase(params)
-                # get the fixup from the pattern_dict
-                res = self.signal_match.match(data, fixupdict=self.pattern.fixupdict())
-                p_res = self.data["test"][
-                    self.signal_director.test_uuid
-                ].setdefault("results", OrderedDict())
-
-                # prevent losing data in the update
-                # FIXME: support parameters and retries
-                if res["test_case_id"] in p_res:
-                    raise JobError(
-                        "Duplicate test_case_id in results: %s",
-                        res["test_case_id"])
-                # check for measurements
-                calc = {}
-                if 'measurement' in res:
-                    calc['measurement'] = res['measurement']
-                if 'measurement' in res and 'units' in res:
-                    calc['units'] = res['units']
-                # turn the result dict inside out to get the unique
-                # test_case_id/testset_name as key and result as value
-                if self.testset_name:
-                    res_data = {
-                        'definition': self.definition,
-                        'case': res["test_case_id"],
-                        'set': self.testset_name,
-                        'result': res["result"]
-                    }
-                    res_data.update(calc)
-                    self.logger.results(res_data)
-                    self.report.update({
-                        "set": self.testset_name,
-                        "case": res["test_case_id"],
-                        "result": res["result"]})
-                else:
-                    res_data = {
-                        'definition': self.definition,
-                        'case': res["test_case_id"],
-                        'result': res["result"]}
-                    res_data.update(calc)
-                    self.logger.results(res_data)
-                    self.report.update({
-                        res["test_case_id"]: res["result"]
-                    })
-            elif name == "TESTSET":
-                action = params.pop(0)
-                if action == "START":
-                    name = "testset_" + action.lower()
-                    try:
-                        self.testset_name = params[0]
-                    except IndexError:
-                        raise JobError("Test set declared without a name")
-                    self.logger.info("Starting test_set %s", self.testset_name)
-                elif action == "STOP":
-                    self.logger.info("Closing test_set %s", self.testset_name)
-                    self.testset_name = None
-                    name = "testset_" + action.lower()
+            handler = self._signal_handlers.get(name)
+            if handler:
+                name = handler(params) or name
 
             try:
                 self.signal_director.signal(name, params)
@@ -423,31 +358,159 @@ class TestShellAction(TestAction):
         elif event == 'test_case_result':
             res = test_connection.match.groupdict()
             if res:
-                # FIXME: make this a function
-                # check for measurements
-                calc = {}
-                if 'measurement' in res:
-                    calc['measurement'] = res['measurement']
-                if 'measurement' in res and 'units' in res:
-                    calc['units'] = res['units']
-                res_data = {
-                    'definition': self.definition,
-                    'case': res["test_case_id"],
-                    'result': res["result"]}
-                res_data.update(calc)
-                self.logger.results(res_data)
-                self.report.update({
-                    res["test_case_id"]: res["result"]
-                })
+                self._add_result(self._result_data(res, self.definition))
             ret_val = True
 
         return ret_val
 
+    def _signal_startrun(self, params):
+        self.signal_director.test_uuid = params[1]
+        self.definition = params[0]
+        uuid = params[1]
+        self.start = time.time()
+        self.logger.debug("Starting test definition: %s" % self.definition)
+        self.logger.info("Starting test lava.%s (%s)", self.definition, uuid)
+        # set the pattern for this run from pattern_dict
+        testdef_index = self.get_common_data('test-definition', 'testdef_index')
+        uuid_list = self.get_common_data('repo-action', 'uuid-list')
+        for key, value in testdef_index.items():
+            if self.definition == "%s_%s" % (key, value):
+                pattern = self.job.context['test'][uuid_list[key]]['testdef_pattern']['pattern']
+                fixup = self.job.context['test'][uuid_list[key]]['testdef_pattern']['fixupdict']
+                self.pattern.update(pattern, fixup)
+                self.patterns.update({'test_case_result': self.pattern.pat})
+                self.logger.info("Enabling test definition pattern %r" % pattern)
+        self.logger.results({
+            "definition": "lava",
+            "case": self.definition,
+            "uuid": uuid,
+            # The test is marked as failed and updated to "pass" when finished.
+            # If something goes wrong then it will stay to "fail".
+            "result": "fail"
+        })
+
+    def _signal_endrun(self, params):
+        self.definition = params[0]
+        uuid = params[1]
+        # remove the pattern for this run from pattern_dict
+        self._reset_patterns()
+        # catch error in ENDRUN being handled without STARTRUN
+        if not self.start:
+            self.start = time.time()
+        self.logger.info("Ending use of test pattern.")
+        self.logger.info("Ending test lava.%s (%s), duration %.02f",
+                         self.definition, uuid,
+                         time.time() - self.start)
+        totals = self._store.summary.get(self.definition)
+        if totals:
+            self.logger.info("Results of %s: %s", self.definition,
+                             ', '.join(["%s %d" % (result, count) for result, count in totals.items()]))
+        self._store.flush()
+        self.logger.results({
+            "definition": "lava",
+            "case": self.definition,
+            "uuid": uuid,
+            "duration": "%.02f" % (time.time() - self.start),
+            "result": "pass"
+        })
+        self.start = None
+
+    def _signal_testcase(self, params):
+        data = handle_testcase(params)
+        # get the fixup from the pattern_dict
+        res = self.signal_match.match(data, fixupdict=self.pattern.fixupdict())
+        self._add_result(self._result_data(res, self.definition, self.testset_name), duplicates=False)
+
+    def _post_result(self, data):
+        """
+        Handles a result posted to the ResultsListener, in the thread of the
+        listener. The definition and the test set are posted with the result
+        as the signals on the console may not have been processed yet.
+        A result which was already received is ignored.
+        """
+        definition = data.pop('definition', None) or self.definition
+        testset = data.pop('set', None)
+        fixupdict = self.pattern.fixupdict() if definition == self.definition else None
+        res = self.signal_match.match(data, fixupdict=fixupdict)
+        res_data = self._result_data(res, definition, testset)
+        with self._results_lock:
+            if res_data in self._store:
+                self.logger.debug("Ignoring duplicate result for %s", res["test_case_id"])
+                return
+            self._received.add(ResultsStore.key(res_data))
+            self.logger.results(res_data)
+            self._store.add(res_data)
+
+    def _result_data(self, res, definition, testset=None):  # pylint: disable=no-self-use
+        res_data = {
+            'definition': definition,
+            'case': res["test_case_id"],
+            'result': res["result"]}
+        if testset:
+            res_data['set'] = testset
+        # check for measurements
+        if 'measurement' in res:
+            res_data['measurement'] = res['measurement']
+        if 'measurement' in res and 'units' in res:
+            res_data['units'] = res['units']
+        return res_data
+
+    def _add_result(self, res_data, duplicates=True):
+        """
+        Logs the result of a test case and appends it to the results store.
+        The results are not kept in memory, only counted.
+        """
+        with self._results_lock:
+            if ResultsStore.key(res_data) in self._received:
+                # the console signal is the fallback if a post fails
+                self.logger.debug("Result for %s already received by the listener", res_data['case'])
+                return
+            # prevent losing data in the update
+            # FIXME: support parameters and retries
+            if not duplicates and res_data in self._store:
+                raise JobError(
+                    "Duplicate test_case_id in results: %s" %
+                    res_data['case'])
+            # one log record per result, which only reaches the master in a
+            # batch with other records if a log batch size is set for the job
+            self.logger.results(res_data)
+            self._store.add(res_data)
+
+    def _signal_testset(self, params):
+        """
+        :return: the name of the signal for the SignalDirector
+        """
+        action = params.pop(0)
+        if action == "START":
+            try:
+                self.testset_name = params[0]
+            except IndexError:
+                raise JobError("Test set declared without a name")
+            self.logger.info("Starting test_set %s", self.testset_name)
+            return "testset_" + action.lower()
+        elif action == "STOP":
+            self.logger.info("Closing test_set %s", self.testset_name)
+            self.testset_name = None
+            return "testset_" + action.lower()
+        return None
+
+    def scanner(self):
+        """
+        The SignalScanner for the current set of patterns. Patterns change
+        at the start and end of each test definition, so scanners are
+        cached to compile each set only once.
+        """
+        key = tuple(self.patterns.items())
+        if key not in self._scanners:
+            self._scanners[key] = SignalScanner(key)
+        return self._scanners[key]
+
     def _keep_running(self, test_connection, timeout, check_char):
         if 'test_case_results' in self.patterns:
             self.logger.info("Test case result pattern: %r" % self.patterns['test_case_results'])
-        retval = test_connection.expect(list(self.patterns.values()), timeout=timeout)
-        return self.check_patterns(list(self.patterns.keys())[retval], test_connection, check_char)
+        scanner = self.scanner()
+        retval = test_connection.expect(scanner, timeout=timeout)
+        return self.check_patterns(scanner.names[retval], test_connection, check_char)
 
     class SignalDirector(object):
 
@@ -19,7 +19,9 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import os
+import re
 import time
+import uuid
 import pexpect
 import signal
 import decimal
@@ -98,6 +100,152 @@ class SignalMatch(InternalObject):  # pylint: disable=too-few-public-methods
         return res
 
 
+class SignalScanner(object):  # pylint: disable=too-many-instance-attributes
+    """
+    A pexpect searcher for the patterns of a test shell, which compiles
+    the patterns into a single alternation of named groups so that each
+    read from the device is scanned once, whatever the number of patterns.
+    As with pexpect, the earliest match wins, then the first pattern.
+    String patterns are compiled with the flags, like the test definition
+    patterns. Patterns with other flags or numbered backreferences are
+    searched one by one.
+
+    Patterns are expected to match within a single line: complete lines
+    which did not match are not scanned again when more output arrives.
+    The match is that of the individual pattern, so groups() and
+    groupdict() are unchanged.
+
+    As pexpect does for a spawn without an encoding, string patterns are
+    converted to bytes to search a bytes buffer.
+    """
+
+    def __init__(self, patterns, flags=re.M):
+        """
+        :param patterns: sequence of (name, pattern) pairs, where the
+            pattern can be a string, a compiled regex, pexpect.EOF or
+            pexpect.TIMEOUT
+        """
+        self.names = []
+        self.regexes = []
+        self.eof_index = -1
+        self.timeout_index = -1
+        for index, (name, pattern) in enumerate(patterns):
+            self.names.append(name)
+            if pattern is pexpect.EOF:
+                self.eof_index = index
+            elif pattern is pexpect.TIMEOUT:
+                self.timeout_index = index
+            elif hasattr(pattern, 'search'):
+                self.regexes.append((index, pattern))
+            else:
+                self.regexes.append((index, re.compile(pattern, flags)))
+        self.combined = None
+        if all([regex.flags & ~re.UNICODE == flags and not re.search(r'\\[1-9]', regex.pattern)
+                for _, regex in self.regexes]):
+            try:
+                self.combined = re.compile('|'.join([
+                    '(?P<_scan%d>%s)' % (index, regex.pattern) for index, regex in self.regexes]), flags)
+            except re.error:
+                pass
+        self.lookup = dict(self.regexes)
+        self.converted = {}
+        self.start = None
+        self.end = None
+        self.match = None
+        self.offset = 0
+        self.length = None
+        self.scanned = 0
+
+    def reset(self):
+        """ Called at the start of each expect, as the buffer may have changed """
+        self.offset = 0
+        self.length = None
+        self.scanned = 0
+
+    @staticmethod
+    def _convert(regex, binary):
+        if binary and not isinstance(regex.pattern, bytes):
+            return re.compile(regex.pattern.encode('utf-8'), regex.flags & ~re.UNICODE)
+        if not binary and isinstance(regex.pattern, bytes):
+            return re.compile(regex.pattern.decode('utf-8'), regex.flags)
+        return regex
+
+    def _compiled(self, buffer):
+        """
+        The regexes, combined regex and lookup, of the same type as the buffer.
+        """
+        binary = isinstance(buffer, bytes)
+        if binary not in self.converted:
+            regexes = [(index, self._convert(regex, binary)) for index, regex in self.regexes]
+            combined = None
+            if self.combined is not None:
+                combined = self._convert(self.combined, binary)
+            self.converted[binary] = (regexes, combined, dict(regexes))
+        return self.converted[binary]
+
+    def _search(self, buffer, offset):
+        regexes, combined, lookup = self._compiled(buffer)
+        if combined is not None:
+            match = combined.search(buffer, offset)
+            if match is None:
+                return -1, None
+            index = int(match.lastgroup[5:])
+            return index, lookup[index].match(buffer, match.start()) or match
+        best = (-1, None)
+        for index, regex in regexes:
+            match = regex.search(buffer, offset)
+            if match is not None and (best[1] is None or match.start() < best[1].start()):
+                best = (index, match)
+        return best
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        """
+        Called by pexpect with the whole buffer each time data is read.
+        Returns the index of the matching pattern or -1.
+        """
+        if self.length is None or freshlen >= len(buffer):
+            self.offset = 0
+        elif self.length + freshlen != len(buffer):
+            # pexpect dropped the start of the buffer
+            self.offset = max(0, self.offset - (self.length + freshlen - len(buffer)))
+        offset = self.offset
+        if searchwindowsize:
+            offset = max(offset, len(buffer) - searchwindowsize)
+        self.scanned += len(buffer) - offset
+        index, match = self._search(buffer, offset)
+        if match is None:
+            newline = buffer.rfind(b'\n' if isinstance(buffer, bytes) else u'\n', offset)
+            if newline >= 0:
+                self.offset = newline + 1
+            self.length = len(buffer)
+            return -1
+        self.start = match.start()
+        self.end = match.end()
+        self.match = match
+        # pexpect keeps the data after the match as the new buffer
+        self.offset = 0
+        self.length = len(buffer) - self.end
+        return index
+
+
+class PatternSearcher(pexpect.searcher_re):
+    """
+    The pexpect searcher for a list of patterns, which also counts
+    the bytes scanned, for comparison with a bounded search window.
+    """
+
+    def __init__(self, patterns):
+        super(PatternSearcher, self).__init__(patterns)
+        self.scanned = 0
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        if searchwindowsize:
+            self.scanned += min(len(buffer), searchwindowsize)
+        else:
+            self.scanned += len(buffer)
+        return super(PatternSearcher, self).search(buffer, freshlen, searchwindowsize)
+
+
 class Connection(object):
     """
     A raw_connection is an arbitrary instance of a standard Python (or added LAVA) class
@@ -127,6 +275,19 @@ class Connection(object):
         self.connected = True
         self.check_char = '#'
 
+    @property
+    def search_window(self):
+        return getattr(self.raw_connection, 'searchwindowsize', None)
+
+    @search_window.setter
+    def search_window(self, window):
+        """
+        Sets the search window of the raw_connection for the current action,
+        None restores the default of the device.
+        """
+        if hasattr(self.raw_connection, 'search_window'):
+            self.raw_connection.searchwindowsize = window or self.raw_connection.search_window
+
     def corruption_check(self):
         self.sendline(self.check_char)
 
@@ -177,6 +338,7 @@ class CommandRunner(object):
         self._prompt_str_includes_rc = prompt_str_includes_rc
         self.match_id = None
         self.match = None
+        self.timings = []
 
     def change_prompt(self, string):
         # self.logger.debug("Changing prompt to %s" % string)
@@ -199,9 +361,9 @@ class CommandRunner(object):
         :return: The exit value of the command, if wait_for_rc not explicitly
             set to False during construction.
         """
+        start = time.time()
         self._connection.empty_buffer()
         self._connection.sendline(cmd)
-        start = time.time()
         if response is not None:
             self.match_id = self._connection.expect(response, timeout=timeout)
             self.match = self._connection.match
@@ -232,6 +394,38 @@ class CommandRunner(object):
         else:
             return_code = None
 
+        self._record(cmd, start, return_code)
+        return return_code
+
+    def _record(self, cmd, start, return_code):
+        self.timings.append({
+            'command': cmd,
+            'duration': '%.02f' % (time.time() - start),
+            'exit_code': return_code,
+        })
+
+    def execute(self, cmd, timeout=-1, delay=0):
+        """Run `cmd` without waiting for the shell prompt.
+
+        The exit code is echoed after a marker which is unique to the command,
+        so the end of the command is matched as soon as it is output, without
+        the latency of the send profile before the command.
+
+        :param cmd: The command to execute.
+        :param timeout: How long to wait for the command to complete.
+        :param delay: Delay in milliseconds between sending each character.
+        :return: The exit value of the command.
+        """
+        marker = uuid.uuid4().hex[:12]
+        start = time.time()
+        self._connection.empty_buffer()
+        with self._connection.low_latency():
+            # the quotes prevent the echo of the command matching the marker
+            self._connection.sendline('%s ; echo "LAVA_""%s $?"' % (cmd, marker), delay)
+        self.match_id = self._connection.expect([r'LAVA_%s (\d+)' % marker], timeout=timeout)
+        self.match = self._connection.match
+        return_code = int(self.match.group(1))
+        self._record(cmd, start, return_code)
         return return_code
 
 
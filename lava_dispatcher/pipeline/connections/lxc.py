@@ -19,11 +19,11 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import os
-import signal
 from time import sleep
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     JobError,
 )
 from lava_dispatcher.pipeline.shell import ShellCommand, ShellSession
@@ -60,7 +60,7 @@ class ConnectLxc(Action):
 
         cmd = "lxc-attach -n {0}".format(lxc_name)
         self.logger.info("%s Connecting to device using '%s'", self.name, cmd)
-        signal.alarm(0)  # clear the timeouts used without connections.
+        DeadlineManager.clear()  # the connection timeout applies from here.
         # ShellCommand executes the connection command
         shell = self.shell_class("%s\n" % cmd, self.timeout,
                                  logger=self.logger)
@@ -18,11 +18,11 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
-import signal
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
 from lava_dispatcher.pipeline.utils.constants import DEFAULT_SHELL_PROMPT
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     JobError,
 )
 from lava_dispatcher.pipeline.shell import ShellCommand, SimpleSession
@@ -67,9 +67,11 @@ class ConnectDevice(Action):
             return connection
         command = self.job.device['commands']['connect'][:]  # local copy to retain idempotency.
         self.logger.info("%s Connecting to device using '%s'", self.name, command)
-        signal.alarm(0)  # clear the timeouts used without connections.
+        DeadlineManager.clear()  # the connection timeout applies from here.
         # ShellCommand executes the connection command
-        shell = self.shell_class("%s\n" % command, self.timeout, logger=self.logger)
+        shell = self.shell_class("%s\n" % command, self.timeout, logger=self.logger,
+                                 profile=self.job.device.get('send_profile', None),
+                                 search_window=self.job.device.get('search_window', None))
         if shell.exitstatus:
             raise JobError("%s command exited %d: %s" % (command, shell.exitstatus, shell.readlines()))
         # ShellSession monitors the pexpect
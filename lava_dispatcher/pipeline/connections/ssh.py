@@ -19,11 +19,10 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 
-import signal
 from lava_dispatcher.pipeline.action import JobError
 from lava_dispatcher.pipeline.utils.filesystem import check_ssh_identity_file
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
-from lava_dispatcher.pipeline.action import Action
+from lava_dispatcher.pipeline.action import Action, DeadlineManager
 from lava_dispatcher.pipeline.shell import ShellCommand, ShellSession
 from lava_dispatcher.pipeline.utils.constants import DEFAULT_SHELL_PROMPT
 
@@ -131,7 +130,7 @@ class ConnectSsh(Action):
         if connection:
             self.logger.debug("Already connected")
             return connection
-        signal.alarm(0)  # clear the timeouts used without connections.
+        DeadlineManager.clear()  # the connection timeout applies from here.
         # ShellCommand executes the connection command
 
         params = self._check_params()
@@ -153,7 +152,8 @@ class ConnectSsh(Action):
         else:
             raise JobError("Unable to identify host address. Primary? %s", self.primary)
         command_str = " ".join(str(item) for item in command)
-        shell = ShellCommand("%s\n" % command_str, self.timeout, logger=self.logger)
+        shell = ShellCommand("%s\n" % command_str, self.timeout, logger=self.logger,
+                             search_window=self.job.device.get('search_window', None))
         if shell.exitstatus:
             raise JobError("%s command exited %d: %s" % (
                 self.command, shell.exitstatus, shell.readlines()))
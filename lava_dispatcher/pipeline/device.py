@@ -23,6 +23,17 @@ import os
 import yaml
 
 
+def deploy_parameters(job, name):
+    """
+    The settings of this worker for name, e.g. download_cache, from the
+    deploy parameters of the device dictionary. Empty if not set.
+    """
+    if not job or not job.device:
+        return {}
+    deploy = job.device.get('actions', {}).get('deploy', {})
+    return (deploy.get('parameters') or {}).get(name) or {}
+
+
 class PipelineDevice(dict):
     """
     Dictionary Device class which accepts data rather than a filename.
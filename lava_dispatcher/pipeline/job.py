@@ -23,7 +23,7 @@ import time
 import yaml
 
 from lava_dispatcher.pipeline.action import Action, JobError, InfrastructureError
-from lava_dispatcher.pipeline.log import YAMLLogger  # pylint: disable=unused-import
+from lava_dispatcher.pipeline.log import YAMLLogger, ZMQPushHandler  # pylint: disable=unused-import
 from lava_dispatcher.pipeline.logical import PipelineContext
 from lava_dispatcher.pipeline.diagnostics import DiagnoseNetwork
 from lava_dispatcher.pipeline.protocols.multinode import MultinodeProtocol  # pylint: disable=unused-import
@@ -62,6 +62,7 @@ class Job(object):  # pylint: disable=too-many-instance-attributes
             DiagnoseNetwork,
         ]
         self.timeout = None
+        self.deadline = None
         self.protocols = []
         self.compatibility = 2
         # We are now able to create the logger when the job is started,
@@ -145,9 +146,8 @@ class Job(object):  # pylint: disable=too-many-instance-attributes
     def run(self):
         """
         Top level routine for the entire life of the Job, using the job level timeout.
-        Python only supports one alarm on SIGALRM - any Action without a connection
-        will have a default timeout which will use SIGALRM. So the overarching Job timeout
-        can only stop processing actions if the job wide timeout is exceeded.
+        The job deadline contains the deadline of each action, so the job timeout
+        is checked between actions and by any expect loop or download within an action.
         """
         for protocol in self.protocols:
             try:
@@ -164,6 +164,14 @@ class Job(object):  # pylint: disable=too-many-instance-attributes
                 raise JobError(msg)
 
         self.pipeline.run_actions(self.connection)
+        handler = getattr(self.logger, 'handler', None)
+        if isinstance(handler, ZMQPushHandler) and (handler.dropped or handler.spilled):
+            self.logger.warning("The master was slower than the job: %d log records dropped, %d spilled to disk",
+                                handler.dropped, handler.spilled)
+        if isinstance(handler, ZMQPushHandler) and handler.compression:
+            self.logger.debug("Log compression (%s): %d bytes of records sent as %d bytes in %.02fs",
+                              handler.compression, handler.record_bytes,
+                              handler.wire_bytes, handler.compress_time)
         if self.pipeline.errors:
             self.logger.exception(self.pipeline.errors)
             return len(self.pipeline.errors)
@@ -20,16 +20,318 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import datetime
+import json
 import logging
+import os
+import re
+import struct
 import sys
+import tempfile
+import threading
+import time
 import yaml
+import zlib
 import zmq
 import zmq.auth
 
+from lava_dispatcher.pipeline.utils.constants import (
+    LOG_BATCH_SIZE,
+    LOG_COMPRESSION,
+    LOG_COMPRESSION_MIN_SIZE,
+    LOG_QUEUE_POLICY,
+    LOG_QUEUE_SIZE,
+    LOG_SPOOL_SEGMENT,
+    LOG_SPOOL_SIZE,
+    LOG_SPOOL_TIMEOUT,
+)
 
-class ZMQPushHandler(logging.Handler):
-    def __init__(self, socket_addr, master_cert, slave_cert, job_id):
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+if sys.version > '3':
+    import queue  # pylint: disable=import-error
+else:
+    import Queue as queue  # pylint: disable=import-error
+
+
+# The escapes used by yaml.dump in double quoted scalars, for the
+# ASCII characters which cannot be written as they are.
+_YAML_ESCAPES = dict([(chr(code), '\\x%02X' % code) for code in list(range(0x20)) + [0x7f]])
+_YAML_ESCAPES.update({
+    '\0': '\\0', '\x07': '\\a', '\x08': '\\b', '\t': '\\t',
+    '\n': '\\n', '\x0b': '\\v', '\x0c': '\\f', '\r': '\\r',
+    '\x1b': '\\e', '"': '\\"', '\\': '\\\\',
+})
+_YAML_UNSAFE = re.compile(r'[^ !#-\[\]-~]')
+
+
+def _yaml_escape(match):
+    return _YAML_ESCAPES[match.group()]
+
+
+def yaml_quote(text):
+    """
+    Returns text as yaml.dump(text, default_style='"') would write it
+    or None if the text is not plain ASCII, in which case the YAML
+    representer has to choose the tag and the escapes.
+    """
+    if type(text) is not str:  # pylint: disable=unidiomatic-typecheck
+        return None
+    try:
+        return '"' + _YAML_UNSAFE.sub(_yaml_escape, text) + '"'
+    except KeyError:
+        return None
+
+
+# A compressed batch of log records is sent as [job_id, header, frame].
+# The header names the codec, the frame is the compressed sequence of
+# length prefixed fields: level, name, record, level, name, record, ...
+LOG_FRAME_HEADER = b'lava-log-frame/1 '
+LOG_FRAME_FIELD = struct.Struct('!I')
+
+LOG_CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+if zstandard is not None:
+    LOG_CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def _bytes(data):
+    return data if isinstance(data, bytes) else data.encode('utf-8')
+
+
+def pack_log_frame(items, codec):
+    """
+    Returns the header and the compressed frame for a batch of
+    (level, name, record) tuples.
+    """
+    fields = []
+    for item in items:
+        for field in item:
+            field = _bytes(field)
+            fields.append(LOG_FRAME_FIELD.pack(len(field)))
+            fields.append(field)
+    return LOG_FRAME_HEADER + codec.encode('ascii'), LOG_CODECS[codec][0](b''.join(fields))
+
+
+def unpack_log_frame(header, frame):
+    """
+    Returns the list of fields in a compressed frame.
+    Raises ValueError for unknown codecs and corrupt frames.
+    """
+    codec = header[len(LOG_FRAME_HEADER):].decode('ascii')
+    if codec not in LOG_CODECS:
+        raise ValueError("Unsupported log frame codec '%s'" % codec)
+    try:
+        data = LOG_CODECS[codec][1](frame)
+    except Exception as exc:  # pylint: disable=broad-except
+        raise ValueError("Corrupt %s log frame: %s" % (codec, exc))
+    fields = []
+    offset = 0
+    while offset < len(data):
+        if offset + LOG_FRAME_FIELD.size > len(data):
+            raise ValueError("Truncated %s log frame" % codec)
+        (size,) = LOG_FRAME_FIELD.unpack_from(data, offset)
+        offset += LOG_FRAME_FIELD.size
+        fields.append(data[offset:offset + size])
+        offset += size
+    if offset != len(data) or len(fields) % 3:
+        raise ValueError("Truncated %s log frame" % codec)
+    return fields
+
+
+def log_records(message):
+    """
+    Splits a multipart message from ZMQPushHandler into
+    (job_id, level, name, record) tuples, decompressing the
+    frame if the message has a frame header.
+    """
+    job_id = message[0]
+    fields = message[1:]
+    if len(message) == 3 and message[1].startswith(LOG_FRAME_HEADER):
+        fields = unpack_log_frame(message[1], message[2])
+    for index in range(0, len(fields) - 2, 3):
+        yield (job_id, fields[index], fields[index + 1], fields[index + 2])
+
+
+class LogSpool(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Append-only spool of (level, name, record) tuples on disk, stored as
+    length prefixed fields in numbered segment files. Records are read
+    back in order and each segment is removed once all of its records
+    have been consumed. Segments left by a previous process are read
+    first, so that the slave can send the records which lava-dispatch
+    could not send before the end of the job.
+    """
+
+    def __init__(self, path, size=LOG_SPOOL_SIZE, segment_size=LOG_SPOOL_SEGMENT):
+        self.path = path
+        self.size = size
+        self.segment_size = segment_size
+        self.lock = threading.Condition()
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        self.segments = sorted([int(name.split('.')[0]) for name in os.listdir(path)
+                                if name.endswith('.spool')])
+        self.used = 0
+        self.records = 0
+        for number in self.segments:
+            self.used += os.path.getsize(self._segment(number))
+            with open(self._segment(number), 'rb') as segment:
+                while True:
+                    items = self._read(segment, 1000)[0]
+                    if not items:
+                        break
+                    self.records += len(items)
+        self.writing = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(self.writing)
+        self.writer = open(self._segment(self.writing), 'ab')
+        self.reader = open(self._segment(self.segments[0]), 'rb')
+        self.offset = 0
+
+    def _segment(self, number):
+        return os.path.join(self.path, '%08d.spool' % number)
+
+    @staticmethod
+    def _read(segment, count):
+        """
+        Reads up to count complete records.
+        :return: the records and the number of bytes they used
+        """
+        items = []
+        consumed = 0
+        while len(items) < count:
+            fields = []
+            size = 0
+            for _ in range(3):
+                header = segment.read(LOG_FRAME_FIELD.size)
+                if len(header) < LOG_FRAME_FIELD.size:
+                    return items, consumed
+                (length,) = LOG_FRAME_FIELD.unpack(header)
+                field = segment.read(length)
+                if len(field) < length:
+                    return items, consumed
+                fields.append(field)
+                size += LOG_FRAME_FIELD.size + length
+            items.append(tuple(fields))
+            consumed += size
+        return items, consumed
+
+    def append(self, item):
+        """
+        Adds a record to the spool.
+        Returns False if the spool is full.
+        """
+        data = b''.join([LOG_FRAME_FIELD.pack(len(field)) + field
+                         for field in [_bytes(field) for field in item]])
+        with self.lock:
+            if self.used + len(data) > self.size:
+                return False
+            self.writer.write(data)
+            self.used += len(data)
+            self.records += 1
+            if self.writer.tell() >= self.segment_size:
+                self.writer.close()
+                self.writing += 1
+                self.segments.append(self.writing)
+                self.writer = open(self._segment(self.writing), 'ab')
+            self.lock.notify()
+        return True
+
+    def read(self, count):
+        """
+        Returns up to count records from the head of the spool, without
+        consuming them, and the position to pass to consume().
+        """
+        with self.lock:
+            # the records appended since the last read are flushed together
+            self.writer.flush()
+            while True:
+                self.reader.seek(self.offset)
+                items, consumed = self._read(self.reader, count)
+                if items or self.segments[0] == self.writing:
+                    return items, self.offset + consumed
+                # the end of a complete segment, possibly with a record
+                # truncated when a previous process stopped
+                self.reader.close()
+                fname = self._segment(self.segments.pop(0))
+                self.used -= os.path.getsize(fname)
+                os.unlink(fname)
+                self.reader = open(self._segment(self.segments[0]), 'rb')
+                self.offset = 0
+
+    def consume(self, position, count):
+        with self.lock:
+            self.offset = position
+            self.records -= count
+
+    def wait(self, timeout):
+        """ Waits for records to be appended to an empty spool """
+        with self.lock:
+            if not self.records:
+                self.lock.wait(timeout)
+
+    def close(self):
+        """
+        Closes the spool and removes the segments, unless
+        some records have not been consumed.
+        """
+        with self.lock:
+            self.writer.close()
+            self.reader.close()
+            if not self.records:
+                for number in self.segments:
+                    os.unlink(self._segment(number))
+                self.segments = []
+
+
+class ZMQPushHandler(logging.Handler):  # pylint: disable=too-many-instance-attributes
+    """
+    Sends the records to the master from a background thread so that a
+    slow master does not stall the job. Records wait in a bounded queue
+    and all the records waiting when the socket is ready are sent as one
+    multipart message, of up to batch_size records:
+        [job_id, level, name, record, level, name, record, ...]
+    The default batch_size of 1 keeps one record per message, for masters
+    which do not split the messages with log_records().
+    When the queue is full, the policy applies:
+        block: wait for the sender thread to make room
+        drop: discard debug records, wait for the others
+        spill: append records to a temporary file until the queue has
+               drained, keeping the order of the records
+    If a spool directory is set, records are written to a LogSpool instead
+    of the queue and only removed from the spool once the master is
+    connected and has accepted them, so records are kept on disk whilst
+    the master is unreachable. The size of the spool limits the disk used
+    and records are dropped if the spool is full.
+    If a compression codec is set, batches larger than
+    LOG_COMPRESSION_MIN_SIZE are compressed and sent with a frame header,
+    see log_records(). record_bytes, wire_bytes and compress_time measure
+    the saving and the cost.
+    A batch which cannot be sent is dropped and the error is reported on
+    stderr, as the handler cannot log its own errors. If the sender thread
+    is not running, records are dropped instead of waiting for room in
+    the queue, so that logging never blocks the job.
+    """
+
+    policies = ['block', 'drop', 'spill']
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, socket_addr, master_cert, slave_cert, job_id,
+                 queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 policy=LOG_QUEUE_POLICY, compression=LOG_COMPRESSION, spool=None):
         super(ZMQPushHandler, self).__init__()
+        if policy not in self.policies:
+            raise ValueError("Unknown log queue policy '%s'" % policy)
+        if compression is not None and compression not in LOG_CODECS:
+            raise ValueError("Unsupported log compression '%s'" % compression)
 
         # Create the PUSH socket
         # pylint: disable=no-member
@@ -45,37 +347,241 @@ class ZMQPushHandler(logging.Handler):
             (server_public, _) = zmq.auth.load_certificate(master_cert)
             self.socket.curve_serverkey = server_public
 
+        self.spool = None
+        if spool is not None:
+            self.spool = LogSpool(spool)
+            # only queue messages whilst the master is connected
+            self.socket.setsockopt(zmq.IMMEDIATE, 1)
         self.socket.connect(socket_addr)
 
         self.job_id = str(job_id)
         self.action_level = '0'
         self.action_name = 'dispatcher'
+        # concurrent actions log from their own thread
+        self.local = threading.local()
 
         self.formatter = logging.Formatter("%(message)s")
 
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.policy = policy
+        self.sending = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.spilled = 0
+        self.spill = None
+        self.spill_pending = 0
+        self.spill_offset = 0
+        self.spill_lock = threading.Lock()
+        self.compression = compression
+        self.record_bytes = 0
+        self.wire_bytes = 0
+        self.compress_time = 0.0
+        self.closing = None
+        self.spool_timeout = LOG_SPOOL_TIMEOUT
+        self.sender = threading.Thread(
+            target=self._sender if self.spool is None else self._spool_sender,
+            name='log-sender')
+        self.sender.daemon = True
+        self.sender.start()
+
     def setMetadata(self, level, name):
-        self.action_level = level
-        self.action_name = name
+        self.local.action_level = level
+        self.local.action_name = name
+        if threading.current_thread().name == 'MainThread':
+            self.action_level = level
+            self.action_name = name
+
+    @property
+    def depth(self):
+        """ Number of records waiting to be sent """
+        if self.spool is not None:
+            return self.spool.records
+        return self.queue.qsize() + self.spill_pending + self.sending
 
     def emit(self, record):
-        msg = [self.job_id, self.action_level, self.action_name,
-               self.formatter.format(record)]
-        self.socket.send_multipart(msg)
+        item = (getattr(self.local, 'action_level', self.action_level),
+                getattr(self.local, 'action_name', self.action_name),
+                self.formatter.format(record))
+        if self.spool is not None:
+            if not self.spool.append(item):
+                self.dropped += 1
+        elif not self.sender.is_alive():
+            # nothing empties the queue, so never wait for room
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+        elif self.policy == 'spill':
+            with self.spill_lock:
+                # once spilling, keep spilling until the file is read back
+                if not self.spill_pending:
+                    try:
+                        self.queue.put_nowait(item)
+                        return
+                    except queue.Full:
+                        pass
+                self._spill(item)
+        elif self.policy == 'drop' and record.levelno <= logging.DEBUG:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            while True:
+                try:
+                    self.queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    if not self.sender.is_alive():
+                        self.dropped += 1
+                        return
+
+    def _spill(self, item):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        self.spill.seek(0, os.SEEK_END)
+        self.spill.write((json.dumps(item) + '\n').encode('utf-8'))
+        self.spill_pending += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        items = []
+        with self.spill_lock:
+            if not self.spill_pending:
+                return items
+            self.spill.seek(self.spill_offset)
+            while self.spill_pending and len(items) < self.batch_size:
+                line = self.spill.readline()
+                items.append(tuple([part.encode('utf-8') for part in json.loads(line.decode('utf-8'))]))
+                self.spill_pending -= 1
+            self.spill_offset = self.spill.tell()
+            if not self.spill_pending:
+                self.spill.seek(0)
+                self.spill.truncate()
+                self.spill_offset = 0
+        return items
+
+    def _send(self, items, flags=0):
+        message = [_bytes(self.job_id)]
+        for item in items:
+            message.extend([_bytes(part) for part in item])
+        record_bytes = size = sum([len(part) for part in message])
+        if self.compression and size >= LOG_COMPRESSION_MIN_SIZE:
+            start = time.time()
+            message = [_bytes(self.job_id)] + list(pack_log_frame(items, self.compression))
+            self.compress_time += time.time() - start
+            size = sum([len(part) for part in message])
+        self.socket.send_multipart(message, flags)
+        self.record_bytes += record_bytes
+        self.wire_bytes += size
+
+    def _send_batch(self, items):
+        try:
+            self._send(items)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.errors += 1
+            self.dropped += len(items)
+            if self.errors == 1:
+                sys.stderr.write("Unable to send %d log records to the master: %s\n" % (len(items), exc))
+            return
+        self.sent += len(items)
+
+    def _sender(self):
+        running = True
+        while running:
+            if self.spill_pending and self.queue.empty():
+                items = self._unspill()
+            else:
+                try:
+                    items = [self.queue.get(timeout=0.1)]
+                except queue.Empty:
+                    continue
+                while len(items) < self.batch_size:
+                    try:
+                        items.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if items[-1] is None:
+                    running = False
+                    items.pop()
+            self.sending = len(items)
+            if items:
+                self._send_batch(items)
+            self.sending = 0
+        while self.spill_pending:
+            self._send_batch(self._unspill())
+
+    def _spool_sender(self):
+        while True:
+            items, position = self.spool.read(self.batch_size)
+            if not items:
+                if self.closing:
+                    break
+                self.spool.wait(0.1)
+                continue
+            try:
+                self._send(items, zmq.NOBLOCK)  # pylint: disable=no-member
+            except zmq.Again:
+                # the master is not connected: keep the records in the
+                # spool until it is or, when closing, until the deadline
+                if self.closing and time.time() > self.closing:
+                    break
+                self.socket.poll(100, zmq.POLLOUT)  # pylint: disable=no-member
+                continue
+            self.spool.consume(position, len(items))
+            self.sent += len(items)
 
     def close(self):
+        if self.spool is not None:
+            self.closing = time.time() + self.spool_timeout
+            self.sender.join()
+            self.spool.close()
+        elif self.sender.is_alive():
+            # sends everything logged so far before stopping
+            self.queue.put(None)
+            self.sender.join()
         super(ZMQPushHandler, self).close()
         self.socket.close()
         self.context.destroy()
+        if self.spill is not None:
+            self.spill.close()
+        if self.errors:
+            sys.stderr.write("%d errors sending log records to the master, %d records dropped\n" % (
+                self.errors, self.dropped))
 
 
 class YAMLLogger(logging.Logger):
+    """
+    Each record is a single line mapping of the time, the level and the
+    message. The default format is the flow style YAML of yaml.dump.
+    The json format writes the same mapping as a JSON object, which is
+    also a valid YAML flow mapping, so that the logs can be read as
+    JSON lines.
+    """
+
+    formats = ['yaml', 'json']
+
     def __init__(self, name):
         super(YAMLLogger, self).__init__(name)
         self.handler = None
+        self.log_format = 'yaml'
+        self.batch_size = LOG_BATCH_SIZE
+        self.compression = LOG_COMPRESSION
+        self.spool = None
+
+    def set_format(self, log_format):
+        if log_format not in self.formats:
+            raise ValueError("Unknown log format '%s'" % log_format)
+        self.log_format = log_format
 
-    def addZMQHandler(self, socket_addr, master_cert, slave_cert, job_id):
+    def addZMQHandler(self, socket_addr, master_cert, slave_cert, job_id, **kwargs):
+        kwargs.setdefault('batch_size', self.batch_size)
+        kwargs.setdefault('compression', self.compression)
+        kwargs.setdefault('spool', self.spool)
         self.handler = ZMQPushHandler(socket_addr, master_cert,
-                                      slave_cert, job_id)
+                                      slave_cert, job_id, **kwargs)
         self.addHandler(self.handler)
         return self.handler
 
@@ -84,18 +590,38 @@ class YAMLLogger(logging.Logger):
             self.handler.setMetadata(level, name)
 
     def log_message(self, level, level_name, message, *args, **kwargs):
-        # Build the dictionnary
-        data = {'dt': datetime.datetime.utcnow().isoformat(),
-                'lvl': level_name}
-
         if isinstance(message, str) and args:
-            data['msg'] = message % args
+            message = message % args
+        dt = datetime.datetime.utcnow().isoformat()
+        if self.log_format == 'json':
+            self._log(level, self.json_record(dt, level_name, message), ())
         else:
-            data['msg'] = message
+            self._log(level, self.yaml_record(dt, level_name, message), ())
+
+    @staticmethod
+    def yaml_record(dt, level_name, message):
+        """
+        The output of yaml.dump for the record. The time, the level names
+        and almost all messages are ASCII strings, which are quoted
+        directly instead of going through the YAML emitter.
+        """
+        msg = yaml_quote(message)
+        if msg is not None:
+            return '{"dt": "%s", "lvl": "%s", "msg": %s}' % (dt, level_name, msg)
+        data = {'dt': dt, 'lvl': level_name, 'msg': message}
         # Set width to a really large value in order to always get one line.
-        self._log(level, yaml.dump(data, default_flow_style=True,
-                                   default_style='"',
-                                   width=sys.maxint)[:-1], ())
+        return yaml.dump(data, default_flow_style=True, default_style='"',
+                         width=sys.maxsize)[:-1]
+
+    @staticmethod
+    def json_record(dt, level_name, message):
+        data = {'dt': dt, 'lvl': level_name, 'msg': message}
+        try:
+            return json.dumps(data, sort_keys=True, default=str)
+        except ValueError:
+            # undecodable bytes or circular references
+            data['msg'] = repr(message)
+            return json.dumps(data, sort_keys=True)
 
     def exception(self, exc, *args, **kwargs):
         self.log_message(logging.ERROR, 'exception', exc, *args, **kwargs)
@@ -19,9 +19,9 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 
-import time
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     JobError,
     InfrastructureError,
     TestError,
@@ -61,7 +61,7 @@ class RetryAction(Action):
             except (JobError, InfrastructureError, TestError) as exc:
                 self.retries += 1
                 self.errors = "%s failed: %d of %d attempts. '%s'" % (self.name, self.retries, self.max_retries, exc)
-                time.sleep(self.sleep)
+                DeadlineManager.sleep(self.sleep)
         if not self.valid:
             self.errors = "%s retries failed for %s" % (self.retries, self.name)
             if "boot-result" not in self.data:
@@ -26,9 +26,9 @@ import logging
 import traceback
 import os
 import socket
-import time
 from lava_dispatcher.pipeline.connection import Protocol
 from lava_dispatcher.pipeline.action import (
+    DeadlineManager,
     Timeout,
     JobError,
     InfrastructureError,
@@ -119,7 +119,7 @@ class MultinodeProtocol(Protocol):
                                   exc.errno,
                                   self.settings['coordinator_hostname'],
                                   self.settings['port'])
-            time.sleep(delay)
+            DeadlineManager.sleep(delay)
             self.sock.close()
             return False
 
@@ -207,7 +207,7 @@ class MultinodeProtocol(Protocol):
             if json_data['response'] != 'wait':
                 break
             else:
-                time.sleep(delay)
+                DeadlineManager.sleep(delay)
             # apply the default timeout to each poll operation.
             if c_iter > timeout:
                 self.finalise_protocol()
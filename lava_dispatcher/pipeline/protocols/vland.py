@@ -20,12 +20,11 @@
 
 
 import copy
-import time
 import json
 import socket
 import logging
 from lava_dispatcher.pipeline.connection import Protocol
-from lava_dispatcher.pipeline.action import JobError, TestError
+from lava_dispatcher.pipeline.action import DeadlineManager, JobError, TestError
 from lava_dispatcher.pipeline.protocols.multinode import MultinodeProtocol
 from lava_dispatcher.pipeline.utils.constants import VLAND_DEPLOY_TIMEOUT
 
@@ -98,7 +97,7 @@ class VlandProtocol(Protocol):
             self.logger.exception(
                 "socket error on connect: %d %s %s",
                 exc.errno, self.settings['vland_hostname'], self.settings['port'])
-            time.sleep(delay)
+            DeadlineManager.sleep(delay)
             self.sock.close()
             return False
 
@@ -180,7 +179,7 @@ class VlandProtocol(Protocol):
             if json_data['response'] != 'wait':
                 break
             else:
-                time.sleep(delay)
+                DeadlineManager.sleep(delay)
             # apply the default timeout to each poll operation.
             if c_iter > timeout:
                 self.finalise_protocol()
@@ -21,59 +21,105 @@
 import contextlib
 import os
 import pexpect
+import re
 import sys
+import termios
 import time
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     JobError,
     TestError,
     InfrastructureError,
     Timeout,
 )
-from lava_dispatcher.pipeline.connection import Connection, CommandRunner
-from lava_dispatcher.pipeline.utils.constants import SHELL_SEND_DELAY
+from lava_dispatcher.pipeline.connection import (
+    Connection,
+    CommandRunner,
+    PatternSearcher,
+    SignalScanner,
+)
+from lava_dispatcher.pipeline.utils.constants import (
+    SHELL_LOG_INTERVAL,
+    SHELL_SCAN_REPORT,
+    SHELL_SEARCH_WINDOW,
+    SHELL_SEND_PROFILE,
+)
+
+_SANITISE = re.compile(b'"|\n\n')
+_REPLACEMENTS = {b'"': b'\\"', b'\n\n': b'\n'}
+
+
+def _replace(match):
+    return _REPLACEMENTS[match.group(0)]
 
 
 class ShellLogger(object):
     """
     Builds a YAML log message out of the incremental output of the pexpect.spawn
     using the logfile support built into pexpect.
+
+    Complete lines are logged together, in one message per interval,
+    so that fast output does not generate a log message for each line.
+    A partial line is kept until the rest of the line is received.
     """
 
-    def __init__(self, logger):
-        self.line = ''
+    def __init__(self, logger, interval=SHELL_LOG_INTERVAL):
+        self.line = bytearray()
+        self.lines = []
         self.logger = logger
+        self.interval = interval
+        self.last = 0
+
+    @staticmethod
+    def sanitise(data):
+        """
+        Removes carriage returns and escape characters, reduces double
+        lines to single and escapes double quotes for YAML syntax.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        return _SANITISE.sub(_replace, data.translate(None, b'\r\x1b'))
 
     def write(self, new_line):
-        replacements = {
-            '\n\n': '\n',  # double lines to single
-            '\r': '',
-            '"': '\\\"',  # escape double quotes for YAML syntax
-            '\x1b': ''  # remove escape control characters
-        }
-        for key, value in replacements.items():
-            new_line = new_line.replace(key, value)
-        lines = self.line + new_line
-
-        # Print one full line at a time. A partial line is kept in memory.
-        if '\n' in lines:
-            last_ret = lines.rindex('\n')
-            self.line = lines[last_ret + 1:]
-            lines = lines[:last_ret]
-            for line in lines.split('\n'):
-                self.logger.target(line)
-        else:
-            self.line = lines
-        return
+        self.line.extend(self.sanitise(new_line))
+        last_ret = self.line.rfind(b'\n')
+        if last_ret >= 0:
+            self.lines.append(bytes(self.line[:last_ret]))
+            del self.line[:last_ret + 1]
+        if self.lines and time.time() - self.last >= self.interval:
+            self.emit()
+
+    @property
+    def pending(self):
+        return bool(self.lines)
+
+    def emit(self):
+        """
+        Logs the complete lines received since the last message.
+        """
+        if not self.lines:
+            return
+        data = b'\n'.join(self.lines)
+        self.lines = []
+        self.last = time.time()
+        self.logger.target(data if isinstance(data, str) else data.decode('utf-8', 'replace'))
 
     def flush(self):  # pylint: disable=no-self-use
         sys.stdout.flush()
         sys.stderr.flush()
 
-    def __del__(self):
+    def close(self):
+        """
+        Logs all of the output received, including a partial line.
+        """
         # Only needed for processes that does not end output with a new line.
         if self.line:
-            self.write('\n')
+            self.write(b'\n')
+        self.emit()
+
+    def __del__(self):
+        self.close()
 
 
 class ShellCommand(pexpect.spawn):  # pylint: disable=too-many-public-methods
@@ -85,41 +131,54 @@ class ShellCommand(pexpect.spawn):  # pylint: disable=too-many-public-methods
     A ShellCommand is a raw_connection for a ShellConnection instance.
     """
 
-    def __init__(self, command, lava_timeout, logger=None, cwd=None):
+    def __init__(self, command, lava_timeout, logger=None, cwd=None, profile=None,  # pylint: disable=too-many-arguments
+                 search_window=None):
         if not lava_timeout or not isinstance(lava_timeout, Timeout):
             raise RuntimeError("ShellCommand needs a timeout set by the calling Action")
         if not logger:
             raise RuntimeError("ShellCommand needs a logger")
+        # only the tail of the output is searched if a search window is set,
+        # the default for the device which an action can override.
+        self.search_window = int(search_window or SHELL_SEARCH_WINDOW or 0) or None
         pexpect.spawn.__init__(
             self, command,
             timeout=lava_timeout.duration,
+            searchwindowsize=self.search_window,
             cwd=cwd,
             logfile=ShellLogger(logger),
         )
         self.name = "ShellCommand"
         self.logger = logger
         # serial can be slow, races do funny things, so allow for a delay
-        self.delaybeforesend = SHELL_SEND_DELAY
+        # before each string, not before each write.
+        self.profile = dict(SHELL_SEND_PROFILE)
+        self.profile.update(profile or {})
+        self.delaybeforesend = None
         self.lava_timeout = lava_timeout
+        self.sent_bytes = 0
+        self.send_time = 0.0
+        self.scanned = 0
+        self.scanned_bytes = 0
 
     def sendline(self, s='', delay=0, send_char=True):  # pylint: disable=arguments-differ
         """
         Extends pexpect.sendline so that it can support the delay argument which allows a delay
         between sending each character to get around slow serial problems (iPXE).
-        pexpect sendline does exactly the same thing: calls send for the string then os.linesep.
+        The string and os.linesep are sent together so that the latency is only applied once.
 
         :param s: string to send
         :param delay: delay in milliseconds between sending each character
         :param send_char: send one character or entire string
         """
+        self._emit_output()
         if delay:
             self.logger.debug({"sending": s, "delay": "%s millisecond" % delay})
         else:
             self.logger.debug({"sending": s})
-        self.send(s, delay, send_char)
-        self.send(os.linesep, delay)
+        self.send(s + os.linesep, delay, send_char)
 
     def sendcontrol(self, char):
+        self._emit_output()
         self.logger.debug("sendcontrol: %s", char)
         return super(ShellCommand, self).sendcontrol(char)
 
@@ -127,38 +186,157 @@ class ShellCommand(pexpect.spawn):  # pylint: disable=too-many-public-methods
     def send(self, string, delay=0, send_char=True):  # pylint: disable=arguments-differ
         """
         Extends pexpect.send to support extra arguments, delay and send by character flags.
+
+        Without a delay, the string is written at once. With a delay, the
+        string is written in bursts of up to the burst size of the send profile
+        and the interval between bursts keeps the average rate to one character
+        per delay, limited by the baud rate of the profile. Each burst is
+        drained if the transport is a tty.
         """
-        sent = 0
+        if self.profile['latency']:
+            DeadlineManager.sleep(self.profile['latency'])
         delay = float(delay) / 1000
-        if send_char:
-            for char in string:
-                sent += super(ShellCommand, self).send(char)
-                time.sleep(delay)
-        else:
-            sent = super(ShellCommand, self).send(string)
+        burst = int(self.profile['burst']) if delay and send_char else len(string)
+        interval = max(delay, 10.0 / self.profile['baud'])
+        sent = 0
+        start = time.time()
+        for offset in range(0, len(string), max(burst, 1)):
+            chunk = string[offset:offset + burst]
+            written = time.time()
+            sent += super(ShellCommand, self).send(chunk)
+            self._drain()
+            if delay and offset + burst < len(string):
+                pause = len(chunk) * interval - (time.time() - written)
+                if pause > 0:
+                    DeadlineManager.sleep(pause)
+        elapsed = time.time() - start
+        self.sent_bytes += sent
+        self.send_time += elapsed
+        if delay and elapsed:
+            self.logger.debug("Sent %d bytes in %.2f seconds (%d bytes/s, %d bytes/s overall)",
+                              sent, elapsed, sent / elapsed, self.send_rate)
         return sent
 
+    def _emit_output(self):
+        """
+        Logs the lines held by the ShellLogger, so that the output
+        is logged before the messages which follow it.
+        """
+        if isinstance(self.logfile, ShellLogger):
+            self.logfile.emit()
+
+    def close(self, force=True):
+        if isinstance(self.logfile, ShellLogger):
+            self.logfile.close()
+        return super(ShellCommand, self).close(force)
+
+    def _drain(self):
+        """
+        Waits for the data to be transmitted, if the transport supports it.
+        """
+        try:
+            termios.tcdrain(self.child_fd)
+        except (termios.error, IOError, OSError):
+            pass
+
+    @property
+    def send_rate(self):
+        """
+        Effective send throughput in bytes per second, excluding the latency
+        before each send, so that the send_profile of the device can be tuned.
+        """
+        if not self.send_time:
+            return None
+        return self.sent_bytes / self.send_time
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        """
+        Extends pexpect.read_nonblocking so that lines held by the ShellLogger
+        are logged once the output stops, without waiting for more output.
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        logfile = self.logfile
+        if isinstance(logfile, ShellLogger) and logfile.pending and \
+                (timeout is None or timeout > logfile.interval):
+            start = time.time()
+            try:
+                return super(ShellCommand, self).read_nonblocking(size, logfile.interval)
+            except pexpect.TIMEOUT:
+                logfile.emit()
+            if timeout is not None:
+                timeout = max(0, timeout - (time.time() - start))
+        return super(ShellCommand, self).read_nonblocking(size, timeout)
+
     def expect(self, *args, **kw):
         """
         No point doing explicit logging here, the SignalDirector can help
         the TestShellAction make much more useful reports of what was matched
+
+        The connection timeout is limited to the time remaining before the
+        deadline of the action (and of the job).
+        A SignalScanner can be used in place of the list of patterns.
+
+        The number of bytes scanned is kept in scanned, large scans
+        are logged as these can be limited with a search window.
         """
+        args = list(args)
+        if len(args) > 1:
+            timeout = args.pop(1)
+        else:
+            timeout = kw.pop('timeout', -1)
+        if timeout == -1:
+            timeout = self.timeout
+        kw['timeout'] = DeadlineManager.remaining(timeout)
+        searcher = None
         try:
-            proc = super(ShellCommand, self).expect(*args, **kw)
+            if isinstance(args[0], SignalScanner):
+                searcher = args[0]
+                searcher.reset()
+            else:
+                searcher = PatternSearcher(self.compile_pattern_list(args[0]))
+            proc = self.expect_loop(searcher, **kw)
         except pexpect.TIMEOUT:
+            if kw['timeout'] != timeout:
+                DeadlineManager.check()
             raise TestError("ShellCommand command timed out.")
         except ValueError as exc:
             raise TestError(exc)
         except pexpect.EOF:
             # FIXME: deliberately closing the connection (and starting a new one) needs to be supported.
             raise InfrastructureError("Connection closed")
+        finally:
+            self._emit_output()
+            if searcher:
+                self.scanned = searcher.scanned
+                self.scanned_bytes += searcher.scanned
+                if self.scanned > SHELL_SCAN_REPORT:
+                    self.logger.debug("Scanned %d bytes of output, search window %s",
+                                      self.scanned, self.searchwindowsize)
         return proc
 
     def empty_buffer(self):
-        """Make sure there is nothing in the pexpect buffer."""
+        """
+        Make sure there is nothing in the pexpect buffer.
+        Only the output which has already arrived is discarded,
+        without waiting to see if there is more to come.
+        """
         index = 0
         while index == 0:
-            index = self.expect(['.+', pexpect.EOF, pexpect.TIMEOUT], timeout=1)
+            index = self.expect(['.+', pexpect.EOF, pexpect.TIMEOUT], timeout=0)
+
+    @contextlib.contextmanager
+    def low_latency(self):
+        """
+        Skips the latency of the send profile before each string,
+        e.g. when the output of each command is matched by a marker.
+        """
+        latency = self.profile['latency']
+        self.profile['latency'] = 0
+        try:
+            yield
+        finally:
+            self.profile['latency'] = latency
 
 
 class ShellSession(Connection):
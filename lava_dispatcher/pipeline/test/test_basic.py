@@ -22,12 +22,13 @@ import os
 import sys
 import glob
 import time
+import threading
 import unittest
 import simplejson
 import yaml
 
 from lava_dispatcher.pipeline.utils.filesystem import mkdtemp
-from lava_dispatcher.pipeline.action import Pipeline, Action, JobError
+from lava_dispatcher.pipeline.action import Pipeline, Action, DeadlineManager, JobError
 from lava_dispatcher.pipeline.parser import JobParser
 from lava_dispatcher.pipeline.job import Job
 from lava_dispatcher.pipeline.device import NewDevice
@@ -272,6 +273,141 @@ class TestPipeline(unittest.TestCase):  # pylint: disable=too-many-public-method
         self.assertEqual(action.level, "3")
         self.assertEqual(len(pipe.describe()), 3)
 
+    def test_concurrent_actions(self):
+        action = Action()
+        action.name = "pipe_action"
+        pipe = Pipeline()
+        pipe.add_action(action)
+        internal = Pipeline(action)
+        fakes = []
+        for _ in range(3):
+            fake = TestPipeline.FakeAction()
+            fake.concurrent = True
+            internal.add_action(fake)
+            fakes.append(fake)
+        self.assertEqual(len(list(internal._action_groups())), 1)  # pylint: disable=protected-access
+        start = time.time()
+        internal.run_actions(None)
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(all([fake.ran for fake in fakes]))
+        # the top level pipeline never runs actions concurrently
+        action.concurrent = True
+        self.assertEqual(len(list(pipe._action_groups())), 1)  # pylint: disable=protected-access
+        self.assertEqual(list(pipe._action_groups())[0], [action])  # pylint: disable=protected-access
+
+    def test_concurrent_timeout(self):
+
+        class FakeJob(object):
+            device = None
+            parameters = {}
+            triggers = []
+
+            def __init__(self):
+                self.context = {}
+
+        class ConcurrentAction(TestPipeline.FakeAction):
+
+            def __init__(self, delay):
+                super(ConcurrentAction, self).__init__()
+                self.concurrent = True
+                self.delay = delay
+                self.cleaned = []
+
+            def run(self, connection, args=None):
+                DeadlineManager.sleep(self.delay)
+                self.ran = True
+
+            def cleanup(self):
+                self.cleaned.append(threading.current_thread())
+
+        action = Action()
+        action.name = "pipe_action"
+        pipe = Pipeline(job=FakeJob())
+        pipe.add_action(action)
+        internal = Pipeline(action)
+        slow = ConcurrentAction(30)
+        slow.timeout.duration = 1
+        other = ConcurrentAction(2)
+        internal.add_action(slow)
+        internal.add_action(other)
+        threads = threading.active_count()
+        self.assertRaises(JobError, internal.run_actions, None)
+        # the error is only raised once every worker has stopped
+        self.assertEqual(threading.active_count(), threads)
+        self.assertFalse(slow.ran)
+        self.assertTrue(other.ran)
+        # failed actions are cleaned up by the thread running the pool
+        self.assertEqual(slow.cleaned, [threading.current_thread()])
+        self.assertEqual(other.cleaned, [])
+
+    def test_dag_scheduler(self):
+
+        class DeclaredAction(TestPipeline.FakeAction):
+
+            def __init__(self, reads, writes, finished):
+                super(DeclaredAction, self).__init__()
+                self.reads = reads
+                self.writes = writes
+                self.finished = finished
+
+            def run(self, connection, args=None):
+                super(DeclaredAction, self).run(connection, args)
+                self.finished.append(self)
+
+        action = Action()
+        action.name = "pipe_action"
+        pipe = Pipeline()
+        pipe.add_action(action)
+        internal = Pipeline(action)
+        finished = []
+        kernel = DeclaredAction([], ['download_action.kernel'], finished)
+        overlay = DeclaredAction([], ['lava-overlay'], finished)
+        apply_overlay = DeclaredAction(['download_action', 'lava-overlay'], ['download_action.ramdisk'], finished)
+        undeclared = TestPipeline.FakeAction()
+        for item in [kernel, overlay, apply_overlay, undeclared]:
+            internal.add_action(item)
+        groups = list(internal._action_groups(dag=True))  # pylint: disable=protected-access
+        self.assertEqual(groups, [[kernel, overlay, apply_overlay], [undeclared]])
+        self.assertFalse(internal._depends(kernel, overlay))  # pylint: disable=protected-access
+        self.assertTrue(internal._depends(kernel, apply_overlay))  # pylint: disable=protected-access
+        # without the DAG scheduler, declared actions run one at a time
+        self.assertEqual(len(list(internal._action_groups())), 4)  # pylint: disable=protected-access
+        start = time.time()
+        internal._run_concurrent_actions(groups[0], None)  # pylint: disable=protected-access
+        self.assertLess(time.time() - start, 2.5)
+        self.assertEqual(finished[-1], apply_overlay)
+        # levels are unchanged by the scheduler
+        self.assertEqual([item.level for item in internal.actions], ['1.1', '1.2', '1.3', '1.4'])
+
+    def test_concurrent_validation(self):
+
+        class SlowValidate(Action):
+
+            def __init__(self, delay, error):
+                super(SlowValidate, self).__init__()
+                self.name = "slow-validate"
+                self.delay = delay
+                self.error = error
+
+            def validate(self):
+                time.sleep(self.delay)
+                self.errors = self.error
+
+        action = Action()
+        action.name = "pipe_action"
+        pipe = Pipeline()
+        pipe.add_action(action)
+        internal = Pipeline(action)
+        for delay, error in [(1, 'first'), (0.5, 'second'), (0, 'third')]:
+            slow = SlowValidate(delay, error)
+            slow.concurrent = True
+            internal.add_action(slow)
+        start = time.time()
+        internal.validate_actions()
+        self.assertLess(time.time() - start, 1.5)
+        # errors retain the pipeline order, not the completion order
+        self.assertEqual(internal.errors, ['first', 'second', 'third'])
+
     def test_simulated_action(self):
         factory = Factory()
         job = factory.create_kvm_job('sample_jobs/basics.yaml', mkdtemp())
@@ -20,17 +20,36 @@
 
 
 import os
+import re
+import sys
+import json
+import time
 import yaml
 import logging
 import unittest
+import threading
 import subprocess
-from lava_dispatcher.pipeline.action import JobError
+import pexpect
+import zmq
+from lava_dispatcher.pipeline.action import DeadlineManager, JobError
 from lava_dispatcher.pipeline.utils.filesystem import mkdtemp
 from lava_dispatcher.pipeline.device import NewDevice
+from lava_dispatcher.pipeline.connection import CommandRunner, SignalScanner
 from lava_dispatcher.pipeline.action import Timeout
+from lava_dispatcher.pipeline.log import (
+    LOG_FRAME_HEADER,
+    LogSpool,
+    YAMLLogger,
+    ZMQPushHandler,
+    log_records,
+    pack_log_frame,
+    unpack_log_frame,
+)
+from lava_dispatcher.pipeline.shell import ShellCommand, ShellLogger, ShellSession
 from lava_dispatcher.pipeline.parser import JobParser
 from lava_dispatcher.pipeline.actions.boot.ssh import SchrootAction
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
+from lava_dispatcher.pipeline.utils.constants import SHELL_SEND_PROFILE
 from lava_dispatcher.pipeline.test.test_basic import pipeline_reference
 from lava_dispatcher.pipeline.utils.filesystem import check_ssh_identity_file
 from lava_dispatcher.pipeline.protocols.multinode import MultinodeProtocol
@@ -333,3 +352,546 @@ class TestTimeouts(unittest.TestCase):
             retry.connection_timeout.duration
         )
         self.assertEqual(90, retry.timeout.duration)
+
+
+class TestSendProfile(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestSendProfile, self).setUp()
+        logger = YAMLLogger('send-profile')
+        logger.addHandler(logging.NullHandler())
+        self.shell = ShellCommand('cat', Timeout('fake', 30), logger=logger,
+                                  profile={'burst': 4, 'latency': 0})
+        self.addCleanup(self.shell.close, True)
+
+    def test_no_delay(self):
+        start = time.time()
+        self.assertEqual(self.shell.send('x' * 2048), 2048)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.shell.sent_bytes, 2048)
+        self.assertIsNotNone(self.shell.send_rate)
+
+    def test_burst(self):
+        # 20 characters at 10ms each, in bursts of 4
+        start = time.time()
+        self.assertEqual(self.shell.send('abcdefghijklmnopqrst', delay=10), 20)
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertLess(elapsed, 1.0)
+        self.shell.expect('abcdefghijklmnopqrst', timeout=5)
+
+    def test_default_burst(self):
+        # without a send_profile, each character waits for the delay
+        shell = ShellCommand('cat', Timeout('fake', 30), logger=self.shell.logger,
+                             profile={'latency': 0})
+        self.addCleanup(shell.close, True)
+        self.assertEqual(shell.profile['burst'], 1)
+        start = time.time()
+        self.assertEqual(shell.send('abcde', delay=50), 5)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        shell.expect('abcde', timeout=5)
+
+    def test_baud(self):
+        self.shell.profile['baud'] = 1200
+        self.shell.profile['burst'] = 60
+        # 120 bytes at 1200 baud is at least 0.5s, whatever the delay
+        start = time.time()
+        self.shell.send('x' * 120, delay=1)
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+    def test_deadline(self):
+        self.shell.profile['burst'] = 1
+        start = time.time()
+        with DeadlineManager.deadline('send', 0.5):
+            # 600 characters at 10ms each would take 6 seconds
+            self.assertRaises(JobError, self.shell.send, 'x' * 600, delay=10)
+        self.assertLess(time.time() - start, 3)
+
+
+class TargetLogger(YAMLLogger):
+
+    def __init__(self, name):
+        super(TargetLogger, self).__init__(name)
+        self.messages = []
+        self.addHandler(logging.NullHandler())
+
+    def target(self, message, *args, **kwargs):
+        self.messages.append(message)
+
+
+class TestShellLogger(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def test_sanitise(self):
+        self.assertEqual(ShellLogger.sanitise(b'a\r\n\x1b[0m"b"\n\nc'), b'a\n[0m\\"b\\"\nc')
+
+    def test_batches(self):
+        logger = TargetLogger('shell-logger')
+        shell_logger = ShellLogger(logger, interval=60)
+        shell_logger.write(b'first\r\n')
+        self.assertEqual(logger.messages, ['first'])
+        for line in range(200):
+            shell_logger.write(b'line %d\r\n' % line)
+        shell_logger.write(b'partial')
+        self.assertEqual(len(logger.messages), 1)
+        self.assertTrue(shell_logger.pending)
+        shell_logger.emit()
+        self.assertEqual(len(logger.messages), 2)
+        self.assertEqual(logger.messages[1].split('\n'), ['line %d' % line for line in range(200)])
+        shell_logger.write(b' line\n')
+        shell_logger.emit()
+        self.assertEqual(logger.messages[2], 'partial line')
+
+    def test_idle_output(self):
+        logger = TargetLogger('shell-logger')
+        shell = ShellCommand("sh -c 'echo one; sleep 0.05; echo two; sleep 1; echo done'",
+                             Timeout('fake', 30), logger=logger)
+        self.addCleanup(shell.close, True)
+        self.assertEqual(shell.expect(['done', 'nothing'], timeout=5), 0)
+        # two is held whilst waiting for more output, then logged once the output stops
+        self.assertEqual(logger.messages, ['one', 'two', 'done'])
+
+    def test_emit_on_match(self):
+        logger = TargetLogger('shell-logger')
+        shell = ShellCommand("sh -c 'echo one; echo two; sleep 0.2; printf tail'",
+                             Timeout('fake', 30), logger=logger)
+        self.addCleanup(shell.close, True)
+        shell.logfile.interval = 60
+        self.assertEqual(shell.expect(['two', 'nothing'], timeout=5), 0)
+        # the lines are logged when the match returns, not at the next interval
+        self.assertEqual('\n'.join(logger.messages).split('\n'), ['one', 'two'])
+        shell.expect([pexpect.EOF], timeout=5)
+        shell.close()
+        self.assertEqual(logger.messages[-1], 'tail')
+
+
+class TestSignalScanner(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    patterns = [
+        ("exit", "<LAVA_TEST_RUNNER>: exiting"),
+        ("eof", pexpect.EOF),
+        ("timeout", pexpect.TIMEOUT),
+        ("signal", r"<LAVA_SIGNAL_(\S+) ([^>]+)>"),
+        ("test_case_result", re.compile(r"^(?P<test_case_id>\S+): (?P<result>\w+)$", re.M)),
+    ]
+
+    def test_combined(self):
+        scanner = SignalScanner(self.patterns)
+        self.assertIsNotNone(scanner.combined)
+        self.assertEqual(scanner.eof_index, 1)
+        self.assertEqual(scanner.timeout_index, 2)
+        buf = "noise\nbogus: pass\n<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=a RESULT=pass>\n"
+        self.assertEqual(scanner.search(buf, len(buf)), 4)
+        self.assertEqual(scanner.match.groupdict(), {'test_case_id': 'bogus', 'result': 'pass'})
+        self.assertEqual(buf[scanner.start:scanner.end], 'bogus: pass')
+        rest = buf[scanner.end:]
+        self.assertEqual(scanner.search(rest, 0), 3)
+        self.assertEqual(scanner.match.groups(), ('TESTCASE', 'TEST_CASE_ID=a RESULT=pass'))
+
+    def test_fallback(self):
+        patterns = self.patterns + [("repeat", re.compile(r"(\w)\1"))]
+        scanner = SignalScanner(patterns)
+        self.assertIsNone(scanner.combined)
+        buf = "<LAVA_SIGNAL_ENDRUN 0_smoke 1234>"
+        self.assertEqual(scanner.search(buf, len(buf)), 3)
+        self.assertEqual(scanner.search("xyzz", 4), 5)
+
+    def test_bytes(self):
+        # the buffer of a spawn without an encoding
+        scanner = SignalScanner(self.patterns)
+        buf = b"noise\nbogus: pass\n"
+        self.assertEqual(scanner.search(buf, len(buf)), 4)
+        self.assertEqual(scanner.match.groupdict(), {'test_case_id': b'bogus', 'result': b'pass'})
+        scanner = SignalScanner(self.patterns + [("repeat", re.compile(r"(\w)\1"))])
+        self.assertEqual(scanner.search(b"xyzz", 4), 5)
+
+    def test_split_read(self):
+        scanner = SignalScanner(self.patterns)
+        buf = "line one\nline two\n<LAVA_SIG"
+        self.assertEqual(scanner.search(buf, len(buf)), -1)
+        # complete lines are not scanned again
+        self.assertEqual(scanner.offset, buf.rindex('\n') + 1)
+        buf += "NAL_STARTRUN 0_smoke 1234>"
+        self.assertEqual(scanner.search(buf, 26), 3)
+        self.assertEqual(scanner.match.groups(), ('STARTRUN', '0_smoke 1234'))
+
+    def test_shell(self):
+        lines = ["<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=case%d RESULT=pass>" % count for count in range(200)]
+        script = os.path.join(mkdtemp(), 'signals')
+        with open(script, 'w') as output:
+            output.write('\n'.join(lines + ["<LAVA_TEST_RUNNER>: exiting", ""]))
+        shell = ShellCommand("cat %s" % script, Timeout('fake', 30), logger=TargetLogger('scanner'))
+        self.addCleanup(shell.close, True)
+        scanner = SignalScanner(self.patterns)
+        cases = []
+        while shell.expect(scanner, timeout=5) == 3:
+            # a bytes buffer, unless the spawn has an encoding
+            case = shell.match.group(2).split()[0]
+            cases.append(case.decode('utf-8') if isinstance(case, bytes) else case)
+        self.assertEqual(scanner.names[shell.match_index], "exit")
+        self.assertEqual(cases, ["TEST_CASE_ID=case%d" % count for count in range(200)])
+
+
+class TestSearchWindow(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    command = "sh -c 'yes noise 2>/dev/null | head -n 50000; echo done'"
+
+    def shell(self, search_window=None):
+        shell = ShellCommand(self.command, Timeout('fake', 30), logger=TargetLogger('window'),
+                             search_window=search_window)
+        self.addCleanup(shell.close, True)
+        return shell
+
+    def test_bounded(self):
+        unbounded = self.shell()
+        self.assertIsNone(unbounded.searchwindowsize)
+        self.assertEqual(unbounded.expect(['done', 'nothing'], timeout=10), 0)
+        bounded = self.shell(search_window=1024)
+        self.assertEqual(bounded.searchwindowsize, 1024)
+        self.assertEqual(bounded.expect(['done', 'nothing'], timeout=10), 0)
+        # only the search is bounded, not the output before the match
+        self.assertEqual(bounded.before, unbounded.before)
+        # 350000 bytes of output, searched in full after every read
+        self.assertGreater(unbounded.scanned, 10 * 300000)
+        self.assertLess(bounded.scanned, 2 * 300000)
+        self.assertEqual(bounded.scanned_bytes, bounded.scanned)
+
+    def test_scanner(self):
+        shell = self.shell(search_window=1024)
+        scanner = SignalScanner([("done", "^done"), ("eof", pexpect.EOF)])
+        self.assertEqual(shell.expect(scanner, timeout=10), 0)
+        self.assertLess(shell.scanned, 2 * 300000)
+
+    def test_action_override(self):
+        shell = self.shell(search_window=1024)
+        connection = ShellSession(Factory().create_ssh_job('sample_jobs/ssh-deploy.yaml', mkdtemp()), shell)
+        connection.search_window = 100
+        self.assertEqual(shell.searchwindowsize, 100)
+        connection.search_window = None
+        self.assertEqual(connection.search_window, 1024)
+
+
+class TestCommandRunner(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestCommandRunner, self).setUp()
+        self.shell = ShellCommand('sh', Timeout('fake', 30), logger=TargetLogger('runner'))
+        self.addCleanup(self.shell.close, True)
+        self.runner = CommandRunner(self.shell, ['\\$ '], False)
+
+    def test_empty_buffer(self):
+        self.shell.sendline('echo one')
+        self.shell.expect(['one'], timeout=5)
+        start = time.time()
+        self.shell.empty_buffer()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(len(self.shell.buffer), 0)
+
+    def test_execute(self):
+        start = time.time()
+        self.assertEqual(self.runner.execute('true', timeout=5), 0)
+        self.assertEqual(self.runner.execute('echo "$((6 * 7))" && false', timeout=5), 1)
+        self.assertLess(time.time() - start, 1)
+        # a bytes buffer, unless the spawn has an encoding
+        before = self.shell.before
+        self.assertIn('42', before.decode('utf-8') if isinstance(before, bytes) else before)
+        self.assertEqual(self.shell.profile['latency'], SHELL_SEND_PROFILE['latency'])
+        self.assertEqual([timing['command'] for timing in self.runner.timings],
+                         ['true', 'echo "$((6 * 7))" && false'])
+        self.assertEqual([timing['exit_code'] for timing in self.runner.timings], [0, 1])
+
+
+class RecordHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+class TestYAMLLogger(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestYAMLLogger, self).setUp()
+        self.logger = YAMLLogger('yaml-logger')
+        self.handler = RecordHandler()
+        self.logger.addHandler(self.handler)
+
+    def test_same_as_yaml_dump(self):
+        messages = [chr(code) for code in range(256)] + [
+            '', 'a "quoted" \\ path', 'x ' * 200, u'unicode', 42, None,
+            {'case': 'test', 'result': 'pass'}, ['one', 2]]
+        for message in messages:
+            data = {'dt': '2016-01-01T00:00:00', 'lvl': 'info', 'msg': message}
+            expected = yaml.dump(data, default_flow_style=True, default_style='"',
+                                 width=sys.maxsize)[:-1]
+            self.assertEqual(YAMLLogger.yaml_record(data['dt'], 'info', message), expected)
+
+    def test_formats(self):
+        self.logger.info("%s \"%s\"", 'formatted', 'message')
+        self.logger.set_format('json')
+        self.logger.results({'case': 'test', 'result': 'pass'})
+        self.logger.debug('\xff')
+        self.assertRaises(ValueError, self.logger.set_format, 'xml')
+        self.assertEqual(yaml.safe_load(self.handler.records[0])['msg'], 'formatted "message"')
+        self.assertTrue(self.handler.records[1].startswith('{"dt": '))
+        self.assertEqual(json.loads(self.handler.records[1])['msg'], {'case': 'test', 'result': 'pass'})
+        self.assertEqual(json.loads(self.handler.records[2])['lvl'], 'debug')
+        for record in self.handler.records:
+            self.assertEqual(sorted(yaml.safe_load(record).keys()), ['dt', 'lvl', 'msg'])
+
+
+class SlowHandler(ZMQPushHandler):
+    """ Holds the records in the queue until the master is ready """
+
+    def __init__(self, *args, **kwargs):
+        self.ready = threading.Event()
+        self.waiting = threading.Event()
+        super(SlowHandler, self).__init__(*args, **kwargs)
+
+    def _send(self, items, flags=0):
+        self.waiting.set()
+        self.ready.wait()
+        super(SlowHandler, self)._send(items, flags)
+
+
+class FailingHandler(ZMQPushHandler):
+    """ Fails to send the first batch of records """
+
+    def __init__(self, *args, **kwargs):
+        self.failures = 1
+        super(FailingHandler, self).__init__(*args, **kwargs)
+
+    def _send(self, items, flags=0):
+        if self.failures:
+            self.failures -= 1
+            raise zmq.ZMQError(zmq.EAGAIN)  # pylint: disable=no-member
+        super(FailingHandler, self)._send(items, flags)
+
+
+class TestZMQPushHandler(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestZMQPushHandler, self).setUp()
+        self.context = zmq.Context()
+        self.master = self.context.socket(zmq.PULL)  # pylint: disable=no-member
+        self.addCleanup(self.context.destroy, 0)
+        self.port = self.master.bind_to_random_port('tcp://127.0.0.1')
+        self.logger = YAMLLogger('zmq-%s' % self.id())
+
+    def handler(self, **kwargs):
+        handler = SlowHandler('tcp://127.0.0.1:%d' % self.port, None, None, 42, **kwargs)
+        self.addCleanup(handler.ready.set)
+        self.logger.handler = handler
+        self.logger.addHandler(handler)
+        return handler
+
+    def received(self):
+        messages = []
+        while self.master.poll(1000):
+            messages.append(self.master.recv_multipart())
+        return messages
+
+    def records(self, messages):
+        records = []
+        for message in messages:
+            for job_id, level, name, record in log_records(message):
+                self.assertEqual(job_id, b'42')
+                records.append(yaml.safe_load(record)['msg'])
+        return records
+
+    def test_batches(self):
+        handler = self.handler(queue_size=100, batch_size=8)
+        for count in range(20):
+            self.logger.info('record %d', count)
+        handler.waiting.wait()
+        self.assertEqual(handler.depth, 20)
+        handler.ready.set()
+        handler.close()
+        messages = self.received()
+        self.assertEqual(self.records(messages), ['record %d' % count for count in range(20)])
+        self.assertLessEqual(len(messages), 4)
+        self.assertEqual(handler.sent, 20)
+
+    def test_one_record_per_message(self):
+        handler = self.handler()
+        handler.ready.set()
+        for count in range(3):
+            self.logger.info('record %d', count)
+        handler.close()
+        messages = self.received()
+        self.assertEqual([len(message) for message in messages], [4, 4, 4])
+        self.assertEqual(self.records(messages), ['record 0', 'record 1', 'record 2'])
+
+    def test_send_error(self):
+        handler = FailingHandler('tcp://127.0.0.1:%d' % self.port, None, None, 42)
+        self.logger.handler = handler
+        self.logger.addHandler(handler)
+        self.logger.info('lost')
+        self.logger.info('kept')
+        handler.close()
+        self.assertEqual(self.records(self.received()), ['kept'])
+        self.assertEqual(handler.errors, 1)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_sender_stopped(self):
+        handler = self.handler(queue_size=2)
+        handler.ready.set()
+        handler.queue.put(None)
+        handler.sender.join()
+        # the queue fills up, but logging does not block
+        for count in range(10):
+            self.logger.info('record %d', count)
+        self.assertEqual(handler.dropped, 8)
+        handler.close()
+
+    def test_drop_debug(self):
+        handler = self.handler(queue_size=2, policy='drop')
+        for count in range(10):
+            self.logger.debug('debug %d', count)
+        self.assertGreaterEqual(handler.dropped, 7)
+        handler.ready.set()
+        self.logger.info('info')
+        handler.close()
+        records = self.records(self.received())
+        self.assertEqual(len(records), 11 - handler.dropped)
+        self.assertEqual(records[-1], 'info')
+
+    def test_spill(self):
+        handler = self.handler(queue_size=2, batch_size=5, policy='spill')
+        for count in range(50):
+            self.logger.info('record %d', count)
+        self.assertGreaterEqual(handler.spilled, 47)
+        handler.waiting.wait()
+        self.assertEqual(handler.depth, 50)
+        handler.ready.set()
+        self.logger.info('record 50')
+        handler.close()
+        self.assertEqual(handler.depth, 0)
+        self.assertEqual(self.records(self.received()), ['record %d' % count for count in range(51)])
+
+    def test_compression(self):
+        handler = self.handler(queue_size=100, batch_size=50, compression='zlib')
+        for count in range(40):
+            self.logger.info('[%d] kernel output which repeats itself', count)
+        handler.ready.set()
+        self.logger.info('last')
+        handler.close()
+        messages = self.received()
+        self.assertIn(LOG_FRAME_HEADER + b'zlib', [message[1] for message in messages])
+        self.assertEqual(self.records(messages), ['[%d] kernel output which repeats itself' % count
+                                                  for count in range(40)] + ['last'])
+        self.assertLess(handler.wire_bytes, handler.record_bytes / 2)
+
+    def test_log_frame(self):
+        header, frame = pack_log_frame([('1', 'name', 'record')], 'zlib')
+        self.assertEqual(list(log_records([b'42', header, frame])), [(b'42', b'1', b'name', b'record')])
+        self.assertEqual(list(log_records([b'42', b'1', b'name', b'record'])), [(b'42', b'1', b'name', b'record')])
+        self.assertRaises(ValueError, unpack_log_frame, header, frame[:-2])
+        self.assertRaises(ValueError, unpack_log_frame, LOG_FRAME_HEADER + b'lzma', frame)
+        self.assertRaises(ValueError, ZMQPushHandler, 'tcp://127.0.0.1:%d' % self.port,
+                          None, None, 42, compression='lzma')
+
+
+class TestLogSpool(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestLogSpool, self).setUp()
+        self.path = os.path.join(mkdtemp(), 'spool')
+
+    def test_segments(self):
+        spool = LogSpool(self.path, segment_size=100)
+        for count in range(10):
+            self.assertTrue(spool.append(('1', 'name', 'record %d' % count)))
+        self.assertEqual(spool.records, 10)
+        self.assertGreater(len(os.listdir(self.path)), 2)
+        consumed = []
+        while spool.records:
+            items, position = spool.read(3)
+            spool.consume(position, len(items))
+            consumed.extend([item[2] for item in items])
+        self.assertEqual(consumed, [b'record %d' % count for count in range(10)])
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        spool.close()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_flush_on_read(self):
+        spool = LogSpool(self.path)
+        for count in range(10):
+            spool.append(('1', 'name', 'record %d' % count))
+        segment = os.path.join(self.path, os.listdir(self.path)[0])
+        self.assertEqual(os.path.getsize(segment), 0)
+        self.assertEqual(len(spool.read(100)[0]), 10)
+        self.assertGreater(os.path.getsize(segment), 0)
+        spool.close()
+
+    def test_size(self):
+        spool = LogSpool(self.path, size=100)
+        self.assertTrue(spool.append(('1', 'name', 'x' * 60)))
+        self.assertFalse(spool.append(('1', 'name', 'x' * 60)))
+        spool.close()
+
+    def test_replay(self):
+        spool = LogSpool(self.path)
+        spool.append(('1', 'name', 'first'))
+        spool.append(('1', 'name', 'second'))
+        spool.consume(spool.read(1)[1], 1)
+        spool.close()
+        # a record truncated by the end of the previous process is skipped
+        with open(os.path.join(self.path, os.listdir(self.path)[0]), 'ab') as segment:
+            segment.write(b'\0\0\0\x05abc')
+        spool = LogSpool(self.path)
+        self.assertEqual(spool.records, 2)
+        items, position = spool.read(10)
+        self.assertEqual(items, [(b'1', b'name', b'first'), (b'1', b'name', b'second')])
+        spool.append(('1', 'name', 'third'))
+        spool.consume(position, len(items))
+        self.assertEqual(spool.read(10)[0], [(b'1', b'name', b'third')])
+
+
+class TestSpooledHandler(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestSpooledHandler, self).setUp()
+        tmpdir = mkdtemp()
+        self.spool = os.path.join(tmpdir, 'spool')
+        self.socket_addr = 'ipc://%s' % os.path.join(tmpdir, 'logs')
+        self.context = zmq.Context()
+        self.addCleanup(self.context.destroy, 0)
+        self.logger = YAMLLogger('spool-%s' % self.id())
+        self.logger.addHandler(logging.NullHandler())
+
+    def master(self):
+        master = self.context.socket(zmq.PULL)  # pylint: disable=no-member
+        master.bind(self.socket_addr)
+        records = []
+        while master.poll(1000):
+            for _, _, _, record in log_records(master.recv_multipart()):
+                records.append(yaml.safe_load(record)['msg'])
+        master.close()
+        return records
+
+    def test_master_offline(self):
+        handler = self.logger.addZMQHandler(self.socket_addr, None, None, 42, spool=self.spool)
+        for count in range(10):
+            self.logger.info('record %d', count)
+        time.sleep(0.2)
+        self.assertEqual(handler.depth, 10)
+        self.assertEqual(handler.sent, 0)
+        self.assertEqual(self.master(), ['record %d' % count for count in range(10)])
+        self.assertEqual(handler.depth, 0)
+        handler.close()
+        self.assertEqual(os.listdir(self.spool), [])
+
+    def test_replay(self):
+        handler = self.logger.addZMQHandler(self.socket_addr, None, None, 42, spool=self.spool)
+        self.logger.info('left in the spool')
+        handler.spool_timeout = 0
+        handler.close()
+        self.assertNotEqual(os.listdir(self.spool), [])
+        replay = ZMQPushHandler(self.socket_addr, None, None, 42, spool=self.spool)
+        self.assertEqual(replay.depth, 1)
+        self.assertEqual(self.master(), ['left in the spool'])
+        replay.close()
+        self.assertEqual(os.listdir(self.spool), [])
@@ -25,15 +25,18 @@ import glob
 import stat
 import yaml
 import pexpect
+import shutil
+import tempfile
 import unittest
 from lava_dispatcher.pipeline.power import FinalizeAction
-from lava_dispatcher.pipeline.action import InfrastructureError
+from lava_dispatcher.pipeline.action import InfrastructureError, JobError
 from lava_dispatcher.pipeline.actions.test.shell import TestShellRetry, PatternFixup
 from lava_dispatcher.pipeline.test.test_basic import Factory
 from lava_dispatcher.pipeline.test.test_uboot import Factory as BBBFactory
 from lava_dispatcher.pipeline.actions.deploy import DeployAction
 from lava_dispatcher.pipeline.actions.deploy.image import DeployImagesAction
 from lava_dispatcher.pipeline.actions.deploy.testdef import (
+    load_testdef,
     TestDefinitionAction,
     GitRepoAction,
     TestOverlayAction,
@@ -115,6 +118,45 @@ class TestDefinitionHandlers(unittest.TestCase):  # pylint: disable=too-many-pub
             else:
                 self.assertNotIn('revision', git_repo.parameters)
 
+    def test_concurrent_handlers(self):
+        deploy = [action for action in self.job.pipeline.actions if action.name == 'deployimages'][0]
+        overlay = [action for action in deploy.internal_pipeline.actions if action.name == 'lava-overlay'][0]
+        testdef = [action for action in overlay.internal_pipeline.actions if action.name == 'test-definition'][0]
+        testdef.validate()
+        self.assertTrue(testdef.valid)
+        actions = testdef.internal_pipeline.actions
+        # all repositories are fetched at the same time
+        self.assertEqual(list(testdef.internal_pipeline._action_groups()), [actions])  # pylint: disable=protected-access
+        handlers = [action for action in actions if isinstance(action, GitRepoAction)]
+        self.assertGreater(len(handlers), 1)
+        depends = testdef.internal_pipeline._depends  # pylint: disable=protected-access
+        for handler in handlers[1:]:
+            self.assertFalse(depends(handlers[0], handler))
+        for action in actions:
+            if isinstance(action, TestOverlayAction):
+                self.assertEqual(
+                    [handler.uuid for handler in handlers if depends(handler, action)],
+                    [action.test_uuid])
+        # the order of the uuid list is the pipeline order
+        self.assertEqual(
+            testdef.get_common_data('repo-action', 'uuid-list'),
+            [handler.uuid for handler in handlers])
+
+    def test_load_testdef(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        yaml_file = os.path.join(tmpdir, 'smoke.yaml')
+        with open(yaml_file, 'w') as testdef:
+            testdef.write("metadata:\n  name: smoke\nrun:\n  steps:\n  - lava-test-case a --shell true\n")
+        testdef = load_testdef(self.job, yaml_file)
+        self.assertEqual(testdef['metadata']['name'], 'smoke')
+        # parsed once and shared
+        self.assertIs(load_testdef(self.job, yaml_file), testdef)
+        with open(yaml_file, 'w') as testdef:
+            testdef.write("metadata:\n  name: smoke-tests\n")
+        self.assertEqual(load_testdef(self.job, yaml_file)['metadata']['name'], 'smoke-tests')
+        self.assertRaises(JobError, load_testdef, self.job, os.path.join(tmpdir, 'missing.yaml'))
+
     def test_overlay(self):
 
         script_list = [
@@ -245,6 +287,29 @@ class TestDefinitionParams(unittest.TestCase):  # pylint: disable=too-many-publi
             }
         )
 
+    def test_overlay_files(self):
+        allow_missing_path(self.job.pipeline.validate_actions, self, 'qemu-system-x86_64')
+        deploy = [action for action in self.job.pipeline.actions if action.name == 'deployimages'][0]
+        overlay = [action for action in deploy.internal_pipeline.actions if action.name == 'lava-overlay'][0]
+        testdef = [action for action in overlay.internal_pipeline.actions if action.name == 'test-definition'][0]
+        test, install, runsh = testdef.internal_pipeline.actions[1:4]
+        runner_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, runner_path)
+        with open(os.path.join(runner_path, 'params.yaml'), 'w') as params:
+            yaml.safe_dump({'install': {'deps': ['curl']}, 'run': {'steps': ['true']}}, params)
+        self.job.context.setdefault('test', {})[test.test_uuid] = {
+            'overlay_path': {test.parameters['test_name']: runner_path},
+            'runner_path': {test.parameters['test_name']: '/lava-1/tests/0_smoke-tests'},
+            'testdef_metadata': {}}
+        # the install and run scripts run at the same time as the overlay
+        # and must not rewrite the files which it writes
+        install.run(None)
+        runsh.run(None)
+        self.assertEqual(sorted(os.listdir(runner_path)), ['install.sh', 'params.yaml', 'run.sh'])
+        test.run(None)
+        self.assertEqual(sorted(os.listdir(runner_path)), [
+            'install.sh', 'params.yaml', 'run.sh', 'testdef.yaml', 'testdef_metadata', 'uuid'])
+
 
 class TestDefinitionRepeat(unittest.TestCase):  # pylint: disable=too-many-public-methods
 
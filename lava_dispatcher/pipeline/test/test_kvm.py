@@ -20,7 +20,12 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import os
+import sys
 import glob
+import gzip
+import hashlib
+import threading
+import time
 import unittest
 import yaml
 import pexpect
@@ -35,6 +40,8 @@ from lava_dispatcher.pipeline.action import (
 from lava_dispatcher.pipeline.test.test_basic import Factory, pipeline_reference
 from lava_dispatcher.pipeline.job import Job
 from lava_dispatcher.pipeline.actions.deploy import DeployAction
+from lava_dispatcher.pipeline.actions.deploy.download import DownloadStage
+from lava_dispatcher.pipeline.utils.cache import DownloadCache
 from lava_dispatcher.pipeline.actions.boot.qemu import BootAction
 from lava_dispatcher.pipeline.device import NewDevice
 from lava_dispatcher.pipeline.parser import JobParser
@@ -42,6 +49,12 @@ from lava_dispatcher.pipeline.test.test_messages import FakeConnection
 from lava_dispatcher.pipeline.utils.messages import LinuxKernelMessages
 from lava_dispatcher.pipeline.test.test_defs import allow_missing_path, check_missing_path
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
+from lava_dispatcher.pipeline.utils.constants import DOWNLOAD_QUEUE_DEPTH
+
+if sys.version_info[0] == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
+elif sys.version_info[0] == 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
 
 # pylint: disable=invalid-name
 
@@ -179,6 +192,16 @@ class TestKVMBasicDeploy(unittest.TestCase):  # pylint: disable=too-many-public-
         for action in self.job.pipeline.actions:
             self.assertEqual([], action.errors)
 
+    def test_dag_groups(self):
+        deploy = [action for action in self.job.pipeline.actions if action.name == 'deployimages'][0]
+        internal = deploy.internal_pipeline
+        actions = dict((action.name, action) for action in internal.actions)
+        groups = list(internal._action_groups(dag=True))  # pylint: disable=protected-access
+        self.assertEqual(groups, [internal.actions])
+        # the overlay is built whilst the image downloads
+        self.assertFalse(internal._depends(actions['download_retry'], actions['lava-overlay']))  # pylint: disable=protected-access
+        self.assertTrue(internal._depends(actions['lava-overlay'], actions['apply-overlay-guest']))  # pylint: disable=protected-access
+
     def test_overlay(self):
         overlay = None
         for action in self.job.pipeline.actions:
@@ -623,6 +646,209 @@ class TestKvmUefi(unittest.TestCase):  # pylint: disable=too-many-public-methods
         self.assertIn(uefi_dir, execute.sub_command)
 
 
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves RangeHandler.content, supporting byte ranges. While interrupt
+    is set, each GET closes the connection after half of the content.
+    """
+    content = b''
+    interrupt = 0
+    ranges = []
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        header = self.headers.get('Range')
+        self.ranges.append(header)
+        start, end = 0, len(self.content) - 1
+        if header:
+            first, last = header[len('bytes='):].split('-')
+            start, end = int(first), int(last) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(self.content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        data = self.content[start:end + 1]
+        if RangeHandler.interrupt:
+            RangeHandler.interrupt -= 1
+            data = data[:len(data) // 2]
+        self.wfile.write(data)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class TestHttpDownload(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestHttpDownload, self).setUp()
+        factory = Factory()
+        self.job = factory.create_kvm_job('sample_jobs/kvm-inline.yaml', mkdtemp())
+        deploy = [action for action in self.job.pipeline.actions if action.name == 'deployimages'][0]
+        retry = [action for action in deploy.internal_pipeline.actions if action.name == 'download_retry'][0]
+        self.action = [action for action in retry.internal_pipeline.actions if action.name == 'http_download'][0]
+        RangeHandler.content = b''.join([('%08d\n' % count).encode('utf-8') for count in range(8192)])
+        RangeHandler.interrupt = 0
+        RangeHandler.ranges = []
+        self.server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def download(self, name, **image):
+        image['url'] = 'http://127.0.0.1:%d/%s' % (self.server.server_address[1], name)
+        self.action.parameters.update({'images': {'rootfs': image}})
+        self.action.validate()
+        return self.action._download(self.action._remote())  # pylint: disable=protected-access
+
+    def partial(self, name):
+        return os.path.join(self.action.path, '%s.partial' % name)
+
+    def test_download(self):
+        md5sum = hashlib.md5(RangeHandler.content).hexdigest()
+        fname = self.download('image.img', md5sum=md5sum)
+        # the raw content is moved into place, not written a second time
+        self.assertTrue(self.action._writes_file())  # pylint: disable=protected-access
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), RangeHandler.content)
+        self.assertFalse(os.path.exists(self.partial('image.img')))
+        self.assertEqual(self.action.data['download_action']['rootfs']['md5'], md5sum)
+
+    def test_resume(self):
+        md5sum = hashlib.md5(RangeHandler.content).hexdigest()
+        RangeHandler.interrupt = 1
+        self.assertRaises(JobError, self.download, 'image.img', md5sum=md5sum)
+        size = os.path.getsize(self.partial('image.img'))
+        self.assertGreater(size, 0)
+        self.assertLess(size, len(RangeHandler.content))
+        fname = self.download('image.img', md5sum=md5sum)
+        self.assertEqual(RangeHandler.ranges, [None, 'bytes=%d-' % size])
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), RangeHandler.content)
+        self.assertFalse(os.path.exists(self.partial('image.img')))
+        # the checksum covers the content of both attempts
+        self.assertEqual(self.action.data['download_action']['rootfs']['md5'], md5sum)
+
+    def test_compressed(self):
+        original = RangeHandler.content
+        RangeHandler.content = self._gzip(original)
+        fname = self.download('image.img.gz', compression='gz')
+        self.assertTrue(fname.endswith('image.img'))
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), original)
+        self.assertFalse(os.path.exists(self.partial('image.img.gz')))
+
+    def segmented(self):
+        deploy = self.job.device['actions']['deploy']
+        deploy['parameters'] = dict(deploy.get('parameters') or {})
+        deploy['parameters']['http_download'] = {'connections': 3, 'segment_size': 16384}
+
+    def test_segmented(self):
+        self.segmented()
+        md5sum = hashlib.md5(RangeHandler.content).hexdigest()
+        fname = self.download('image.img', md5sum=md5sum)
+        self.assertEqual(len(RangeHandler.ranges), 5)
+        self.assertIn('bytes=65536-73727', RangeHandler.ranges)
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), RangeHandler.content)
+        # the segments are written in place, without another copy
+        self.assertEqual(os.listdir(self.action.path), ['image.img'])
+        self.assertEqual(self.action.data['download_action']['rootfs']['md5'], md5sum)
+
+    def test_segmented_compressed(self):
+        self.segmented()
+        original = RangeHandler.content
+        RangeHandler.content = self._gzip(original * 4)
+        fname = self.download('image.img.gz', compression='gz')
+        self.assertGreater(len(RangeHandler.ranges), 1)
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), original * 4)
+        self.assertEqual(os.listdir(self.action.path), ['image.img'])
+
+    def test_segmented_failure(self):
+        self.segmented()
+        RangeHandler.interrupt = 1
+        self.assertRaises(JobError, self.download, 'image.img')
+        # a file with missing ranges must not be resumed
+        self.assertFalse(os.path.exists(self.partial('image.img')))
+        fname = self.download('image.img')
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), RangeHandler.content)
+
+    def test_corrupt(self):
+        RangeHandler.content = b'not gzip data\n' * 10000
+        start = time.time()
+        self.assertRaises(JobError, self.download, 'image.img.gz', compression='gz')
+        self.assertLess(time.time() - start, 10)
+
+    def test_cached_copy(self):
+        md5sum = hashlib.md5(RangeHandler.content).hexdigest()
+        cache = DownloadCache(mkdtemp())
+        self.download('image.img', md5sum=md5sum)
+        remote = self.action._remote()  # pylint: disable=protected-access
+        self.action._cached_download(cache, remote, md5sum, None)  # pylint: disable=protected-access
+        self.assertEqual(self.action.results['cache'], 'miss')
+        fname = self.action._cached_download(cache, remote, md5sum, None)  # pylint: disable=protected-access
+        self.assertEqual(self.action.results['cache'], 'hit')
+        # the VM writes to the rootfs, so the cache entry must not be linked
+        self.assertEqual(os.stat(fname).st_nlink, 1)
+        with open(fname, 'wb') as image:
+            image.write(b'modified by the VM')
+        fname = self.action._cached_download(cache, remote, md5sum, None)  # pylint: disable=protected-access
+        with open(fname, 'rb') as image:
+            self.assertEqual(image.read(), RangeHandler.content)
+
+    @staticmethod
+    def _gzip(data):
+        fname = os.path.join(mkdtemp(), 'content.gz')
+        with gzip.open(fname, 'wb') as compressed:
+            compressed.write(data)
+        with open(fname, 'rb') as compressed:
+            return compressed.read()
+
+
+class TestDownloadStage(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    @staticmethod
+    def fail(buff):
+        raise JobError("unable to write %d bytes" % len(buff))
+
+    def test_error(self):
+        writer = DownloadStage('write', self.fail)
+        writer.start()
+        writer.put(b'x')
+        writer.wait()
+        self.assertIsInstance(writer.error, JobError)
+        # nothing reads the queue any more, put discards the content
+        start = time.time()
+        for _ in range(DOWNLOAD_QUEUE_DEPTH * 2):
+            writer.put(b'x')
+        writer.put(None)
+        self.assertLess(time.time() - start, 5)
+
+    def test_chained_error(self):
+        writer = DownloadStage('write', self.fail)
+        decompressor = DownloadStage('decompress', lambda buff: buff, writer)
+        writer.start()
+        decompressor.start()
+        for _ in range(DOWNLOAD_QUEUE_DEPTH * 4):
+            decompressor.put(b'x')
+        decompressor.put(None)
+        decompressor.wait()
+        writer.wait()
+        self.assertIsNone(decompressor.error)
+        self.assertIsInstance(writer.error, JobError)
+        self.assertEqual(writer.size, 0)
+
+
 class TestMonitor(unittest.TestCase):  # pylint: disable=too-many-public-methods
 
     def setUp(self):
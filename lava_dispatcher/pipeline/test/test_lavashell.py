@@ -18,10 +18,18 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
+import os
+import shutil
+import logging
+import tempfile
 import unittest
 import datetime
+import yaml
+import subprocess
 from lava_dispatcher.pipeline.action import Action, Pipeline, JobError, Timeout
 from lava_dispatcher.pipeline.job import Job
+from lava_dispatcher.pipeline.log import YAMLLogger
+from lava_dispatcher.pipeline.utils.results import ResultsListener
 from lava_dispatcher.pipeline.test.test_basic import Factory
 from lava_dispatcher.pipeline.actions.test.shell import TestShellRetry, TestShellAction
 
@@ -72,6 +80,13 @@ class TestDefinitionHandlers(unittest.TestCase):  # pylint: disable=too-many-pub
         self.assertFalse(testshell.check_patterns('eof', None, ''))
         self.assertFalse(testshell.check_patterns('timeout', None, ''))
 
+    def test_testshell_description(self):
+        # the description is written to results.yaml by FinalizeAction,
+        # so the internal state of the test shell must not leak into it.
+        data = yaml.dump(self.job.pipeline.describe())
+        self.assertIn('lava-test-shell', data)
+        self.assertIsNotNone(yaml.load(data, Loader=yaml.Loader))
+
 
 class TestShellResults(unittest.TestCase):   # pylint: disable=too-many-public-methods
 
@@ -111,3 +126,79 @@ class TestShellResults(unittest.TestCase):   # pylint: disable=too-many-public-m
         def run(self, connection, args=None):
             self.count += 1
             raise JobError("fake error")
+
+
+class ResultsLogger(YAMLLogger):
+
+    def __init__(self, name):
+        super(ResultsLogger, self).__init__(name)
+        self.recorded = []
+        self.addHandler(logging.NullHandler())
+
+    def results(self, results, *args, **kwargs):
+        self.recorded.append(results)
+
+
+class TestResultsListener(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestResultsListener, self).setUp()
+        self.action = TestShellAction()
+        self.action.logger = ResultsLogger('results-listener')
+        self.action.definition = '0_smoke'
+        self.listener = ResultsListener(self.action._post_result, '127.0.0.1')  # pylint: disable=protected-access
+        self.listener.start()
+        self.addCleanup(self.listener.stop)
+        self.result_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.result_dir)
+
+    def run_script(self, name, *args):
+        # the pipeline scripts are copied over the v1 scripts in the overlay
+        script = os.path.join(os.path.dirname(__file__), '../lava_test_shell', name)
+        if not os.path.exists(script):
+            script = os.path.join(os.path.dirname(__file__), '../../lava_test_shell', name)
+        env = dict(os.environ)
+        env.update({
+            'LAVA_RESULTS_URL': self.listener.url,
+            'LAVA_RESULT_DIR': self.result_dir,
+            'TESTRUN_ID': '0_smoke',
+        })
+        return subprocess.check_output(['sh', script] + list(args), env=env).decode('utf-8')
+
+    @unittest.skipIf(subprocess.call('which curl', shell=True, stdout=subprocess.PIPE) != 0,
+                     "curl not available")
+    def test_post(self):
+        self.assertEqual(self.run_script('lava-test-case', 'first', '--result', 'pass'), '')
+        self.assertIn('<LAVA_SIGNAL_TESTSET START set1>', self.run_script('lava-test-set', 'start', 'set1'))
+        self.assertEqual(self.run_script('lava-test-case', 'second', '--result', 'fail',
+                                         '--measurement', '1.5', '--units', 'seconds'), '')
+        self.run_script('lava-test-set', 'stop')
+        self.assertEqual(self.listener.received, 2)
+        self.assertEqual(self.action.logger.recorded[0], {
+            'definition': '0_smoke', 'case': 'first', 'result': 'pass'})
+        self.assertEqual(self.action.logger.recorded[1]['set'], 'set1')
+        self.assertEqual(self.action.logger.recorded[1]['units'], 'seconds')
+        # the console signal for the same result is ignored
+        self.action._add_result({  # pylint: disable=protected-access
+            'definition': '0_smoke', 'case': 'first', 'result': 'pass'}, duplicates=False)
+        self.assertEqual(len(self.action._store), 2)
+        # a repeated post is ignored
+        self.assertEqual(self.run_script('lava-test-case', 'first', '--result', 'pass'), '')
+        self.assertEqual(len(self.action._store), 2)
+
+    def test_duplicate(self):
+        result = {'definition': '0_smoke', 'case': 'first', 'result': 'pass'}
+        self.action._add_result(dict(result))  # pylint: disable=protected-access
+        with self.assertRaises(JobError) as context:
+            self.action._add_result(dict(result), duplicates=False)  # pylint: disable=protected-access
+        self.assertEqual(str(context.exception), "Duplicate test_case_id in results: first")
+
+    @unittest.skipIf(subprocess.call('which curl', shell=True, stdout=subprocess.PIPE) != 0,
+                     "curl not available")
+    def test_fallback(self):
+        output = self.run_script('lava-test-case', 'bad', '--result', 'maybe')
+        self.assertEqual(self.listener.rejected, 1)
+        self.assertIn('<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=bad RESULT=maybe>', output)
+        self.listener.stop()
+        output = self.run_script('lava-test-case', 'offline', '--result', 'pass')
+        self.assertIn('<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=offline RESULT=pass>', output)
@@ -19,10 +19,12 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 
+import threading
 import time
 import unittest
 from lava_dispatcher.pipeline.action import (
     Action,
+    DeadlineManager,
     Pipeline,
     Timeout,
     JobError,
@@ -673,3 +675,50 @@ class TestTimeout(unittest.TestCase):  # pylint: disable=too-many-public-methods
             self.fakejob.run()
         except JobError as exc:
             self.fail(exc)
+
+    def test_nested_deadlines(self):
+        with DeadlineManager.deadline('job', 1) as job:
+            with DeadlineManager.deadline('action', 30) as action:
+                self.assertIs(action.parent, job)
+                # the job deadline limits the action
+                self.assertLessEqual(DeadlineManager.remaining(60), 1)
+                self.assertEqual(DeadlineManager.remaining(0.5), 0.5)
+                time.sleep(1)
+                with self.assertRaisesRegexp(JobError, 'job timed out'):
+                    DeadlineManager.check()
+                self.assertFalse(action.expired)
+        self.assertIsNone(DeadlineManager.current())
+
+    def test_deadline_in_thread(self):
+        failures = []
+
+        def worker(parent):
+            with DeadlineManager.adopt(parent):
+                try:
+                    with Timeout('worker', 1).action_timeout():
+                        time.sleep(1.5)
+                except JobError as exc:
+                    failures.append(exc)
+
+        with DeadlineManager.deadline('job', 30):
+            thread = threading.Thread(target=worker, args=(DeadlineManager.current(),))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(failures), 1)
+        self.assertIn('worker timed out', str(failures[0]))
+
+    def test_command_deadline(self):
+        self.assertEqual(DeadlineManager.check_output(['echo', 'done']), b'done\n')
+        start = time.time()
+        with DeadlineManager.deadline('command', 1):
+            # the shell and the sleep it starts are both killed
+            self.assertRaises(JobError, DeadlineManager.check_output,
+                              'sleep 30; echo done', shell=True)
+        self.assertLess(time.time() - start, 10)
+
+    def test_sleep_deadline(self):
+        start = time.time()
+        with DeadlineManager.deadline('sleep', 1):
+            self.assertRaises(JobError, DeadlineManager.sleep, 30)
+        self.assertLess(time.time() - start, 10)
+        DeadlineManager.sleep(0.1)
@@ -18,12 +18,19 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
+import io
+import gzip
+import decimal
 import os
+import sys
 import shutil
 import logging
 import subprocess
+import tarfile
 import tempfile
+import threading
 import unittest
+import yaml
 
 from lava_dispatcher.pipeline.utils.filesystem import mkdtemp
 from lava_dispatcher.pipeline.test.test_uboot import Factory
@@ -31,8 +38,17 @@ from lava_dispatcher.pipeline.actions.boot.u_boot import UBootAction, UBootRetry
 from lava_dispatcher.pipeline.power import ResetDevice, RebootDevice
 from lava_dispatcher.pipeline.utils.constants import SHUTDOWN_MESSAGE
 from lava_dispatcher.pipeline.utils.shell import infrastructure_error
-from lava_dispatcher.pipeline.action import InfrastructureError
+from lava_dispatcher.pipeline.action import InfrastructureError, JobError
+from lava_dispatcher.pipeline.actions.deploy.apply_overlay import ExtractRamdisk
 from lava_dispatcher.pipeline.utils import vcs
+from lava_dispatcher.pipeline.utils.cache import DownloadCache, fingerprint
+from lava_dispatcher.pipeline.utils.cpio import CpioReader, CpioWriter
+from lava_dispatcher.pipeline.utils.results import ResultsStore
+
+if sys.version_info[0] == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
+elif sys.version_info[0] == 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
 
 
 class TestGit(unittest.TestCase):  # pylint: disable=too-many-public-methods
@@ -125,6 +141,171 @@ class TestGit(unittest.TestCase):  # pylint: disable=too-many-public-methods
         git = vcs.GitHelper('git')
         self.assertEqual(git.clone('git.clone1', 'testing'), 'f2589a1b7f0cfc30ad6303433ba4d5db1a542c2d')
 
+    def test_pinned_revision_is_shallow(self):
+        git = vcs.GitHelper('git')
+        self.assertEqual(git.clone('git.clone1', 'testing'), 'f2589a1b7f0cfc30ad6303433ba4d5db1a542c2d')
+        self.assertTrue(os.path.exists(os.path.join('git.clone1', '.git', 'shallow')))
+        self.assertTrue(os.path.exists(os.path.join('git.clone1', 'third.txt')))
+
+    def test_mirror(self):
+        mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        git = vcs.GitHelper(os.path.join(self.tmpdir, 'git'), mirror_dir)
+        self.assertEqual(git.clone('git.clone1'), 'a7af835862da0e0592eeeac901b90e8de2cf5b67')
+        self.assertEqual(len(os.listdir(mirror_dir)), 1)
+        # clones do not depend on the mirror
+        self.assertFalse(os.path.exists(os.path.join('git.clone1', '.git', 'objects', 'info', 'alternates')))
+        self.assertEqual(git.clone('git.clone2', '2f83e6d8189025e356a9563b8d78bdc8e2e9a3ed'), '2f83e6d8189025e356a9563b8d78bdc8e2e9a3ed')
+        self.assertEqual(git.clone('git.clone3', 'testing'), 'f2589a1b7f0cfc30ad6303433ba4d5db1a542c2d')
+        self.assertRaises(InfrastructureError, git.clone, 'git.clone4', 'badhash')
+
+    def test_mirror_refs(self):
+        # refs other than branches and tags, such as pull requests, are not mirrored
+        subprocess.check_output(['git', '-C', 'git', 'update-ref', 'refs/pull/1/head',
+                                 '2f83e6d8189025e356a9563b8d78bdc8e2e9a3ed'])
+        mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        git = vcs.GitHelper(os.path.join(self.tmpdir, 'git'), mirror_dir)
+        self.assertEqual(git.clone('git.clone1'), 'a7af835862da0e0592eeeac901b90e8de2cf5b67')
+        mirror = os.path.join(mirror_dir, os.listdir(mirror_dir)[0], 'mirror.git')
+        refs = subprocess.check_output(['git', '--git-dir', mirror, 'for-each-ref',
+                                        '--format=%(refname)']).decode('utf-8').split()
+        self.assertIn('refs/heads/testing', refs)
+        self.assertEqual([ref for ref in refs if not ref.startswith(('refs/heads/', 'refs/tags/'))], [])
+
+    def test_mirror_fallback(self):
+        # a short commit ID cannot be fetched on its own, the clone is made from the mirror
+        mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        git = vcs.GitHelper(os.path.join(self.tmpdir, 'git'), mirror_dir)
+        calls = []
+        run = git._git  # pylint: disable=protected-access
+
+        def record(*args):
+            calls.append(args)
+            return run(*args)
+
+        git._git = record  # pylint: disable=protected-access
+        self.assertEqual(git.clone('git.clone1', '2f83e6d8'), '2f83e6d8189025e356a9563b8d78bdc8e2e9a3ed')
+        clones = [args for args in calls if args[0] == 'clone']
+        self.assertEqual(len(clones), 1)
+        self.assertTrue(clones[0][1].startswith('file://%s' % mirror_dir))
+        origin = subprocess.check_output(['git', '-C', 'git.clone1', 'config', 'remote.origin.url'])
+        self.assertEqual(origin.decode('utf-8').strip(), os.path.join(self.tmpdir, 'git'))
+
+    def test_mirror_update(self):
+        mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        git = vcs.GitHelper(os.path.join(self.tmpdir, 'git'), mirror_dir)
+        self.assertEqual(git.clone('git.clone1'), 'a7af835862da0e0592eeeac901b90e8de2cf5b67')
+        subprocess.check_output(['git', '-C', 'git', 'merge', '--ff-only', 'testing'])
+        self.assertEqual(git.clone('git.clone2'), 'f2589a1b7f0cfc30ad6303433ba4d5db1a542c2d')
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    """
+    Serves ETagHandler.content, replying 304 to a matching If-None-Match.
+    """
+    content = b''
+    etag = None
+    codes = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.headers.get('If-None-Match') == self.etag:
+            self.codes.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.codes.append(200)
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class RecordingURLHelper(vcs.URLHelper):
+    """ Keeps each response, to check that it has been closed """
+
+    def __init__(self, url, cache=None):
+        super(RecordingURLHelper, self).__init__(url, cache)
+        self.responses = []
+
+    def _get(self, headers=None):
+        res = super(RecordingURLHelper, self)._get(headers)
+        self.responses.append(res)
+        return res
+
+
+class TestURLHelper(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = DownloadCache(os.path.join(self.tmpdir, 'cache'))
+        ETagHandler.codes = []
+        self.server = HTTPServer(('127.0.0.1', 0), ETagHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/tests' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _tarball(self, content):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tar:
+            info = tarfile.TarInfo('smoke.yaml')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        return data.getvalue()
+
+    def test_url(self):
+        ETagHandler.content = b'metadata:\n  name: smoke\n'
+        ETagHandler.etag = '"1"'
+        helper = vcs.URLHelper(self.url + '/smoke.yaml', self.cache)
+        first = helper.clone(os.path.join(self.tmpdir, 'first'))
+        second = helper.clone(os.path.join(self.tmpdir, 'second'))
+        self.assertEqual(first, second)
+        self.assertEqual(ETagHandler.codes, [200, 304])
+        with open(os.path.join(self.tmpdir, 'second', 'smoke.yaml'), 'rb') as testdef:
+            self.assertEqual(testdef.read(), ETagHandler.content)
+
+    def test_responses_closed(self):
+        ETagHandler.content = b'metadata:\n  name: smoke\n'
+        ETagHandler.etag = '"1"'
+        helper = RecordingURLHelper(self.url + '/smoke.yaml', self.cache)
+        helper.clone(os.path.join(self.tmpdir, 'first'))
+        helper.clone(os.path.join(self.tmpdir, 'second'))
+        helper.cache = None
+        helper.clone(os.path.join(self.tmpdir, 'third'))
+        self.assertEqual(ETagHandler.codes, [200, 304, 200])
+        self.assertEqual([res.raw.closed for res in helper.responses], [True, True, True])
+
+    def test_tarball(self):
+        ETagHandler.content = self._tarball(b'metadata:\n  name: smoke\n')
+        ETagHandler.etag = '"1"'
+        helper = vcs.TarHelper(self.url + '/tests.tar.gz', self.cache)
+        first = helper.clone(os.path.join(self.tmpdir, 'first'))
+        self.assertEqual(helper.clone(os.path.join(self.tmpdir, 'second')), first)
+        with open(os.path.join(self.tmpdir, 'second', 'smoke.yaml'), 'rb') as testdef:
+            self.assertEqual(testdef.read(), b'metadata:\n  name: smoke\n')
+        # modified on the server
+        ETagHandler.content = self._tarball(b'metadata:\n  name: smoke-tests\n')
+        ETagHandler.etag = '"2"'
+        self.assertNotEqual(helper.clone(os.path.join(self.tmpdir, 'third')), first)
+        self.assertEqual(ETagHandler.codes, [200, 304, 200])
+        with open(os.path.join(self.tmpdir, 'third', 'smoke.yaml'), 'rb') as testdef:
+            self.assertEqual(testdef.read(), b'metadata:\n  name: smoke-tests\n')
+
+    def test_errors(self):
+        ETagHandler.content = b'not a tarball'
+        helper = vcs.TarHelper(self.url + '/tests.tar.gz', self.cache)
+        self.assertRaises(JobError, helper.clone, os.path.join(self.tmpdir, 'first'))
+        helper = vcs.URLHelper(os.path.join(self.tmpdir, 'missing.yaml'))
+        self.assertRaises(InfrastructureError, helper.clone, os.path.join(self.tmpdir, 'second'))
+
 
 @unittest.skipIf(infrastructure_error('bzr'), "bzr not installed")
 class TestBzr(unittest.TestCase):  # pylint: disable=too-many-public-methods
@@ -237,3 +418,180 @@ class TestConstants(unittest.TestCase):  # pylint: disable=too-many-public-metho
             "reboot: Restarting system",  # modified in the job yaml
             reboot.parameters['parameters'].get('shutdown-message', SHUTDOWN_MESSAGE)
         )
+
+
+class TestDownloadCache(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = DownloadCache(os.path.join(self.tmpdir, 'cache'), 10)
+        self.assertTrue(self.cache.available())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content):
+        fname = os.path.join(self.tmpdir, name)
+        with open(fname, 'w') as data:
+            data.write(content)
+        return fname
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint('url', {'a': 1, 'b': 2}), fingerprint('url', {'b': 2, 'a': 1}))
+        self.assertNotEqual(fingerprint('url', 'abc'), fingerprint('url', 'abd'))
+
+    def test_hit_is_hardlinked(self):
+        fname = self._write('kernel', '12345678')
+        with self.cache.lookup('http://example.com/kernel', md5sum='abc') as entry:
+            self.assertFalse(entry.hit)
+            entry.store(fname, {'md5': 'abc', 'sha256': 'def'})
+        dest = os.path.join(self.tmpdir, 'kernel.job')
+        with self.cache.lookup('http://example.com/kernel', md5sum='abc') as entry:
+            self.assertTrue(entry.hit)
+            self.assertEqual(entry.fetch(dest)['md5'], 'abc')
+        self.assertEqual(os.stat(dest).st_ino, os.stat(fname).st_ino)
+        # a different checksum is a different entry
+        with self.cache.lookup('http://example.com/kernel', md5sum='123') as entry:
+            self.assertFalse(entry.hit)
+
+    def test_copy(self):
+        fname = self._write('ramdisk', '12345678')
+        with self.cache.lookup('http://example.com/ramdisk', sha256sum='abc') as entry:
+            entry.store(fname, {'md5': 'abc', 'sha256': 'def'}, copy=True)
+        self.assertEqual(os.stat(fname).st_nlink, 1)
+
+    def test_lru_eviction(self):
+        old = self._write('old', '12345678')
+        new = self._write('new', '1234567')
+        with self.cache.lookup('http://example.com/old', md5sum='abc') as entry:
+            entry.store(old, {'md5': 'abc', 'sha256': 'def'})
+            os.utime(entry.meta, (0, 0))
+        with self.cache.lookup('http://example.com/new', md5sum='abc') as entry:
+            entry.store(new, {'md5': 'abc', 'sha256': 'def'})
+        self.cache.trim()
+        with self.cache.lookup('http://example.com/old', md5sum='abc') as entry:
+            self.assertFalse(entry.hit)
+        with self.cache.lookup('http://example.com/new', md5sum='abc') as entry:
+            self.assertTrue(entry.hit)
+
+
+class TestCpio(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'lava-1234', 'bin'))
+        with open(os.path.join(self.root, 'lava-1234', 'bin', 'lava-test-runner'), 'w') as runner:
+            runner.write('#!/bin/sh\n')
+        os.symlink('bin/lava-test-runner', os.path.join(self.root, 'lava-1234', 'runner'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        archive = io.BytesIO()
+        writer = CpioWriter(archive)
+        self.assertEqual(writer.add_tree(self.root), 4)
+        writer.close()
+        self.assertEqual(len(archive.getvalue()) % 4, 0)
+        archive.seek(0)
+        entries = [(entry.name, entry.read()) for entry in CpioReader(archive)]
+        # parents are always listed before their contents
+        self.assertEqual(entries, [
+            ('lava-1234', b''),
+            ('lava-1234/bin', b''),
+            ('lava-1234/runner', b'bin/lava-test-runner'),
+            ('lava-1234/bin/lava-test-runner', b'#!/bin/sh\n'),
+        ])
+
+    def test_appended_archive(self):
+        compressed = io.BytesIO()
+        for name in ['base', 'overlay']:
+            archive = io.BytesIO()
+            writer = CpioWriter(archive)
+            with open(os.path.join(self.root, name), 'w') as data:
+                data.write(name)
+            writer.add(os.path.join(self.root, name), name)
+            writer.close()
+            # each archive is compressed separately, as for a ramdisk
+            with gzip.GzipFile(fileobj=compressed, mode='ab') as member:
+                member.write(archive.getvalue())
+        compressed.seek(0)
+        stream = gzip.GzipFile(fileobj=compressed, mode='rb')
+        self.assertEqual([entry.name for entry in CpioReader(stream)], ['base'])
+        self.assertEqual([entry.name for entry in CpioReader(stream)], ['overlay'])
+
+    def test_concatenated(self):
+        compressed = io.BytesIO()
+        for name in ['base', 'overlay']:
+            archive = io.BytesIO()
+            writer = CpioWriter(archive)
+            os.mkdir(os.path.join(self.root, name))
+            writer.add(os.path.join(self.root, name), name)
+            writer.close()
+            # cpio pads each archive to 512 bytes
+            archive.write(b'\0' * (512 - len(archive.getvalue()) % 512))
+            with gzip.GzipFile(fileobj=compressed, mode='ab') as member:
+                member.write(archive.getvalue())
+        fname = os.path.join(self.root, 'ramdisk.cpio.gz')
+        with open(fname, 'wb') as ramdisk:
+            ramdisk.write(compressed.getvalue())
+        # pylint: disable=protected-access
+        self.assertEqual(ExtractRamdisk()._ramdisk_dirs(fname, 'gz'), ['base', 'overlay'])
+        self.assertRaises(JobError, ExtractRamdisk()._ramdisk_dirs, fname, None)
+        with gzip.GzipFile(fname, 'wb') as ramdisk:
+            ramdisk.write(b'not a cpio archive')
+        self.assertRaises(JobError, ExtractRamdisk()._ramdisk_dirs, fname, 'gz')
+
+    def test_existing_dirs(self):
+        archive = io.BytesIO()
+        writer = CpioWriter(archive)
+        self.assertEqual(writer.add_tree(self.root, ['lava-1234']), 3)
+        writer.close()
+        archive.seek(0)
+        entries = list(CpioReader(archive))
+        self.assertEqual([entry.name for entry in entries], [
+            'lava-1234/bin',
+            'lava-1234/runner',
+            'lava-1234/bin/lava-test-runner',
+        ])
+        self.assertEqual([(entry.uid, entry.gid) for entry in entries], [(0, 0)] * 3)
+
+
+class TestResultsStore(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_store(self):
+        store = ResultsStore(self.root)
+        for count in range(1000):
+            store.add({'definition': '0_smoke', 'case': 'case%d' % count,
+                       'result': 'pass' if count % 10 else 'fail'})
+        store.add({'definition': '0_smoke', 'case': 'case1', 'set': 'set1', 'result': 'skip',
+                   'measurement': decimal.Decimal('1.50'), 'units': 's'})
+        self.assertIn({'definition': '0_smoke', 'case': 'case999'}, store)
+        self.assertIn({'definition': '0_smoke', 'case': 'case1', 'set': 'set1'}, store)
+        self.assertNotIn({'definition': '1_smoke', 'case': 'case1'}, store)
+        self.assertEqual(len(store), 1001)
+        self.assertEqual(dict(store.summary['0_smoke']), {'pass': 900, 'fail': 100, 'skip': 1})
+        self.assertEqual(yaml.safe_load(yaml.safe_dump(store.totals())),
+                         {'0_smoke': {'pass': 900, 'fail': 100, 'skip': 1}})
+        results = list(store.results())
+        self.assertEqual(len(results), 1001)
+        self.assertEqual(results[-1]['set'], 'set1')
+        self.assertEqual(results[-1]['measurement'], '1.50')
+        store.close()
+        # a later test action appends to the same file
+        later = ResultsStore(self.root)
+        later.add({'definition': '1_smoke', 'case': 'case1', 'result': 'pass'})
+        self.assertEqual(len(list(later.results())), 1002)
+        later.close()
+
+    def test_no_output_dir(self):
+        store = ResultsStore()
+        store.add({'definition': '0_smoke', 'case': 'case1', 'result': 'pass'})
+        self.assertIn({'definition': '0_smoke', 'case': 'case1'}, store)
+        self.assertEqual(list(store.results()), [])
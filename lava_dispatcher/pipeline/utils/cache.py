@@ -0,0 +1,252 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+# Worker-wide cache of downloaded artifacts, shared by all pipeline jobs
+# running on the same dispatcher.
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import yaml
+
+from lava_dispatcher.pipeline.device import deploy_parameters
+from lava_dispatcher.pipeline.utils.constants import (
+    DOWNLOAD_CACHE_DIR,
+    DOWNLOAD_CACHE_SIZE,
+)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:  # directory may already exist and is okay
+            raise
+
+
+def _link_or_copy(src, dest):
+    """
+    Hardlink src to dest, falling back to a copy if the two paths
+    are on different filesystems or links are not permitted.
+    """
+    try:
+        os.link(src, dest)
+    except OSError as exc:
+        if exc.errno not in [errno.EXDEV, errno.EMLINK, errno.EPERM]:
+            raise
+        shutil.copyfile(src, dest)
+
+
+class CacheEntry(object):
+    """
+    One item in the DownloadCache. Only valid whilst the lock
+    on the entry is held, i.e. inside DownloadCache.lookup()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = os.path.join(path, 'data')
+        self.meta = os.path.join(path, 'meta.yaml')
+
+    @property
+    def metadata(self):
+        try:
+            with open(self.meta, 'r') as meta:
+                return yaml.safe_load(meta)
+        except (IOError, yaml.YAMLError):
+            return None
+
+    @property
+    def hit(self):
+        return os.path.exists(self.data) and self.metadata is not None
+
+    def fetch(self, dest, copy=False):
+        """
+        Makes the cached content available as dest. Hardlinks unless copy
+        is set, which is needed if a later action modifies the file in place.
+        Refreshes the last use time of the entry.
+        :return: the metadata of the entry
+        """
+        if os.path.exists(dest):
+            os.remove(dest)
+        if copy:
+            shutil.copyfile(self.data, dest)
+        else:
+            _link_or_copy(self.data, dest)
+        os.utime(self.meta, None)
+        return self.metadata
+
+    def store(self, fname, metadata, copy=False):
+        """
+        Adds fname to the cache, along with the checksums of the
+        content as downloaded.
+        """
+        tmp_data = self.data + '.tmp'
+        if os.path.exists(tmp_data):
+            os.remove(tmp_data)
+        if copy:
+            shutil.copyfile(fname, tmp_data)
+        else:
+            _link_or_copy(fname, tmp_data)
+        os.rename(tmp_data, self.data)
+        with open(self.meta + '.tmp', 'w') as meta:
+            meta.write(yaml.safe_dump(metadata, default_flow_style=False))
+        os.rename(self.meta + '.tmp', self.meta)
+
+    def evict(self):
+        for fname in [self.meta, self.data]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    @property
+    def size(self):
+        try:
+            return os.stat(self.data).st_size
+        except OSError:
+            return 0
+
+    @property
+    def last_used(self):
+        try:
+            return os.stat(self.meta).st_mtime
+        except OSError:
+            return 0
+
+
+class DownloadCache(object):
+    """
+    Content addressed cache of downloads, keyed by the URL, the checksums
+    supplied by the test writer and the compression used for the download.
+
+    Each entry has a lock file and flock is used so that two jobs fetching
+    the same URL share a single download: the second job waits for the lock
+    and then finds the content in the cache. Entries are evicted, least
+    recently used first, when the total size exceeds the configured limit.
+    """
+
+    config_name = 'download_cache'
+
+    def __init__(self, path=DOWNLOAD_CACHE_DIR, size=DOWNLOAD_CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self.logger = logging.getLogger('dispatcher')
+
+    @classmethod
+    def from_job(cls, job):
+        """
+        The cache is shared by all jobs on this worker. The location and
+        size can be set in the deploy parameters of the device dictionary,
+        using the config_name of the class, e.g. download_cache.
+        Returns None if the cache cannot be used.
+        """
+        config = deploy_parameters(job, cls.config_name)
+        cache = cls(**dict([(key, config[key]) for key in ['path', 'size'] if key in config]))
+        if not cache.available():
+            return None
+        return cache
+
+    @classmethod
+    def key(cls, url, md5sum=None, sha256sum=None, compression=None):
+        data = '\n'.join([url, md5sum or '', sha256sum or '', compression or ''])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def available(self):
+        """
+        The cache is only used if the directory exists or can be created.
+        """
+        try:
+            _makedirs(self.path)
+        except OSError as exc:
+            self.logger.debug("Download cache disabled: %s", exc)
+            return False
+        return os.access(self.path, os.W_OK)
+
+    @contextlib.contextmanager
+    def _locked(self, path, blocking=True):
+        lockfile = open(os.path.join(path, 'lock'), 'w')
+        try:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lockfile, flags)
+            except IOError as exc:
+                if exc.errno not in [errno.EAGAIN, errno.EACCES]:
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+        finally:
+            lockfile.close()
+
+    @contextlib.contextmanager
+    def lookup(self, url, md5sum=None, sha256sum=None, compression=None):
+        """
+        Locks and returns the CacheEntry for this download. Other jobs
+        looking up the same entry wait until the lock is released.
+        """
+        self.logger.debug("Acquiring download cache lock for %s", url)
+        with self.entry(self.key(url, md5sum, sha256sum, compression)) as entry:
+            yield entry
+
+    @contextlib.contextmanager
+    def entry(self, key):
+        path = os.path.join(self.path, key)
+        _makedirs(path)
+        with self._locked(path):
+            yield CacheEntry(path)
+
+    def entries(self):
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if os.path.isdir(path):
+                yield CacheEntry(path)
+
+    def trim(self):
+        """
+        Evicts the least recently used entries until the cache fits within
+        the size limit. Entries locked by other jobs are skipped.
+        """
+        entries = sorted(
+            [entry for entry in self.entries() if entry.size],
+            key=lambda entry: entry.last_used)
+        total = sum([entry.size for entry in entries])
+        for entry in entries:
+            if total <= self.size:
+                break
+            with self._locked(entry.path, blocking=False) as locked:
+                if not locked:
+                    continue
+                self.logger.debug("Evicting %s from the download cache", entry.path)
+                total -= entry.size
+                entry.evict()
+
+
+def fingerprint(*components):
+    """
+    A stable digest of the (JSON serialisable) components
+    which determine the content of a cache entry.
+    """
+    data = json.dumps(components, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
@@ -23,14 +23,19 @@
 # rootfs, always tar, comp: gz,xz,bzip2
 # android images: tar + xz,bz2,gz, or just gz,xz,bzip2
 
+import lzma
 import os
 import subprocess
 import tarfile
 
 from lava_dispatcher.pipeline.action import (
+    DeadlineManager,
     JobError
 )
 
+# pyliblzma raises lzma.error, the python3 module raises lzma.LZMAError
+LZMA_ERROR = getattr(lzma, 'LZMAError', None) or lzma.error  # pylint: disable=no-member
+
 # https://www.kernel.org/doc/Documentation/xz.txt
 compress_command_map = {'xz': 'xz --check=crc32', 'gz': 'gzip', 'bz2': 'bzip2'}
 decompress_command_map = {'xz': 'unxz', 'gz': 'gunzip', 'bz2': 'bunzip2'}
@@ -41,13 +46,10 @@ def compress_file(infile, compression):
         return infile
     if compression not in compress_command_map.keys():
         raise JobError("Cannot find shell command to compress: %s" % compression)
-    pwd = os.getcwd()
-    os.chdir(os.path.dirname(infile))
     cmd = "%s %s" % (compress_command_map[compression], infile)
     try:
         # safe to use shell=True here, no external arguments
-        log = subprocess.check_output(cmd, shell=True)
-        os.chdir(pwd)
+        log = DeadlineManager.check_output(cmd, shell=True, cwd=os.path.dirname(infile))
         return "%s.%s" % (infile, compression)
     except (OSError, subprocess.CalledProcessError) as exc:
         raise RuntimeError('unable to compress file %s: %s' % (infile, exc))
@@ -58,14 +60,13 @@ def decompress_file(infile, compression):
         return infile
     if compression not in decompress_command_map.keys():
         raise JobError("Cannot find shell command to decompress: %s" % compression)
-    os.chdir(os.path.dirname(infile))
     cmd = "%s %s" % (decompress_command_map[compression], infile)
     outfile = infile
     if infile.endswith(compression):
         outfile = infile[:-(len(compression) + 1)]
     try:
         # safe to use shell=True here, no external arguments
-        log = subprocess.check_output(cmd, shell=True)
+        log = DeadlineManager.check_output(cmd, shell=True, cwd=os.path.dirname(infile))
         return outfile
     except (OSError, subprocess.CalledProcessError) as exc:
         raise RuntimeError('unable to decompress file %s: %s' % (infile, exc))
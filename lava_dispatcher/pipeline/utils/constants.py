@@ -23,10 +23,65 @@
 
 # pylint: disable=anomalous-backslash-in-string
 
-# Delay between each character sent to the shell. This is required for some
+# Delay before each string sent to the shell. This is required for some
 # slow serial consoles.
 SHELL_SEND_DELAY = 0.05
 
+# Pacing of the characters sent to the device when a character delay
+# is requested, e.g. for bootloaders which drop input.
+# baud: the line speed, the rate of the bursts never exceeds this.
+# burst: number of bytes written at once, e.g. the size of the UART FIFO.
+#        The default of 1 keeps the delay between every character, devices
+#        which accept bursts can set a larger size in their send_profile.
+# latency: delay in seconds before each string is sent.
+# Override: set send_profile: baud, burst and latency in the device dictionary.
+SHELL_SEND_PROFILE = {
+    'baud': 115200,
+    'burst': 1,
+    'latency': SHELL_SEND_DELAY,
+}
+
+# Maximum time, in seconds, for which complete lines of output from the
+# device are held so that they can be logged in a single message.
+SHELL_LOG_INTERVAL = 0.2
+
+# Size, in bytes, of the tail of the output from the device which is
+# searched by each expect. None searches all the output since the last
+# match, which gets slower as a test prints more output without matching.
+# The window must be larger than the longest line which needs to match.
+# Override: set search_window in the device dictionary or in the
+# parameters of an action.
+SHELL_SEARCH_WINDOW = None
+
+# Log the number of bytes scanned by an expect above this size.
+SHELL_SCAN_REPORT = 1024 * 1024
+
+# Number of log records queued for the master before the policy for
+# a full queue applies: block, drop (debug records) or spill (to disk).
+LOG_QUEUE_SIZE = 10000
+LOG_QUEUE_POLICY = 'block'
+
+# Maximum number of queued log records sent to the master in one message.
+# Masters which do not use log_records() expect exactly one record per
+# message, so batching is only enabled with lava-dispatch --log-batch-size.
+LOG_BATCH_SIZE = 1
+
+# Compression of the batches of log records sent to the master: None,
+# zlib or zstd (if python-zstandard is installed). Batches smaller than
+# the minimum size, in bytes, are sent uncompressed.
+LOG_COMPRESSION = None
+LOG_COMPRESSION_MIN_SIZE = 1024
+
+# With lava-dispatch --log-spool, log records are written to disk until
+# the master has received them. The spool is split into segments, which
+# are removed once sent. Records are dropped if the spool reaches the
+# size limit, in bytes. At the end of the job, lava-dispatch waits for
+# the master for up to LOG_SPOOL_TIMEOUT seconds and then leaves the
+# remaining records for the slave to send.
+LOG_SPOOL_SIZE = 512 * 1024 * 1024  # 512Mb
+LOG_SPOOL_SEGMENT = 4 * 1024 * 1024
+LOG_SPOOL_TIMEOUT = 30
+
 # Default timeout for shell operations
 SHELL_DEFAULT_TIMEOUT = 60
 
@@ -49,11 +104,28 @@ RAMDISK_FNAME = 'ramdisk.cpio'
 FILE_DOWNLOAD_CHUNK_SIZE = 32768
 
 # Size of the chunks when downloading over http
+# Override: set http_download: chunk_size in the deploy
+# parameters of the device dictionary.
 HTTP_DOWNLOAD_CHUNK_SIZE = 32768
 
+# Number of connections used to download large files over http
+# when the server supports byte ranges. 1 disables segmented downloads.
+# Override: set http_download: connections in the deploy
+# parameters of the device dictionary.
+HTTP_DOWNLOAD_CONNECTIONS = 1
+
+# Size of each byte range of a segmented http download
+# Override: set http_download: segment_size in the deploy
+# parameters of the device dictionary.
+HTTP_DOWNLOAD_SEGMENT_SIZE = 16 * 1024 * 1024
+
 # Size of the chunks when downloading over scp
 SCP_DOWNLOAD_CHUNK_SIZE = 32768
 
+# Number of chunks queued between each stage of a download
+# (network, checksum, decompression and write)
+DOWNLOAD_QUEUE_DEPTH = 64
+
 # Clamp on the maximum timeout allowed for overrides
 OVERRIDE_CLAMP_DURATION = 300
 
@@ -65,6 +137,20 @@ AUTOLOGIN_DEFAULT_TIMEOUT = 120
 # Files here are for download using the Apache /tmp alias.
 DISPATCHER_DOWNLOAD_DIR = "/var/lib/lava/dispatcher/tmp"
 
+# Worker-wide cache of downloaded artifacts, shared between jobs.
+# Only used for downloads which specify an md5sum or sha256sum.
+# Override: set download_cache: path and size in the deploy
+# parameters of the device dictionary.
+DOWNLOAD_CACHE_DIR = "/var/lib/lava/dispatcher/cache"
+
+# Maximum size of the download cache, in bytes
+DOWNLOAD_CACHE_SIZE = 20 * 1024 * 1024 * 1024  # 20Gb
+
+# Worker-wide bare mirrors of git test definition repositories.
+# Override: set git_mirror: path in the deploy parameters of the
+# device dictionary, an empty path disables the mirrors.
+GIT_MIRROR_DIR = "/var/lib/lava/dispatcher/git-mirror"
+
 # OS shutdown message
 # Override: set as the shutdown-message parameter of an Action.
 SHUTDOWN_MESSAGE = 'The system is going down for reboot NOW'
@@ -85,6 +171,15 @@ LAVA_MULTINODE_SYSTEM_TIMEOUT = 90
 # Default Action timeout
 ACTION_TIMEOUT = 30
 
+# Maximum number of concurrent actions, like downloads, run at the same time.
+# Override: set concurrent_actions in the device dictionary. 1 disables.
+CONCURRENT_ACTIONS = 4
+
+# Schedule actions which declare the context keys they read and write
+# according to those dependencies, instead of in pipeline order.
+# Override: set dag_scheduler in the device dictionary
+DAG_SCHEDULER = False
+
 # Android tmp directory
 ANDROID_TMP_DIR = '/data/local/tmp'
 
@@ -0,0 +1,238 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+# Streaming reader and writer for the cpio "newc" format used by
+# initramfs, so that ramdisks can be inspected and extended without
+# calling cpio or changing the working directory.
+# https://www.kernel.org/doc/Documentation/early-userspace/buffer-format.txt
+
+import io
+import os
+import stat
+
+from lava_dispatcher.pipeline.action import JobError
+
+NEWC_MAGIC = b'070701'
+NEWC_CRC_MAGIC = b'070702'
+NEWC_HEADER_SIZE = 110
+NEWC_TRAILER = 'TRAILER!!!'
+NEWC_FIELDS = [
+    'ino', 'mode', 'uid', 'gid', 'nlink', 'mtime', 'size',
+    'devmajor', 'devminor', 'rdevmajor', 'rdevminor', 'namesize', 'check'
+]
+
+
+def _padding(size):
+    """ newc aligns each header and each file to four bytes """
+    return (4 - size % 4) % 4
+
+
+class CpioEntry(object):  # pylint: disable=too-many-instance-attributes
+    """
+    One member of a newc archive. When read from a CpioReader,
+    the content is only available until the next entry is read.
+    """
+
+    def __init__(self, name, mode, size=0, **kwargs):
+        self.name = name
+        self.mode = mode
+        self.size = size
+        for field in NEWC_FIELDS:
+            if field not in ['mode', 'size', 'namesize']:
+                setattr(self, field, kwargs.get(field, 0))
+        self.nlink = kwargs.get('nlink', 1)
+        self._stream = None
+        self._remaining = 0
+
+    def isdir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def isreg(self):
+        return stat.S_ISREG(self.mode)
+
+    def issym(self):
+        return stat.S_ISLNK(self.mode)
+
+    def read(self, size=-1):
+        if not self._stream or not self._remaining:
+            return b''
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def header(self):
+        name = self.name if isinstance(self.name, bytes) else self.name.encode('utf-8')
+        name += b'\0'
+        values = []
+        for field in NEWC_FIELDS:
+            if field == 'namesize':
+                values.append(len(name))
+            else:
+                values.append(getattr(self, field))
+        fields = ''.join(['%08X' % value for value in values]).encode('ascii')
+        header = NEWC_MAGIC + fields + name
+        return header + b'\0' * _padding(len(header))
+
+
+class CpioReader(object):
+    """
+    Iterates over the entries of a newc archive read from a file object,
+    without seeking and without holding any file content in memory.
+    Stops at the trailer, so data appended after the archive is not read,
+    unless concatenated is set, in which case the entries of each of the
+    following archives are read as well, as the kernel does for initramfs.
+    """
+
+    def __init__(self, fileobj, concatenated=False):
+        self.fileobj = fileobj
+        self.concatenated = concatenated
+        self.current = None
+
+    def _read(self, size):
+        data = self.fileobj.read(size)
+        if len(data) != size:
+            raise JobError("Truncated cpio archive")
+        return data
+
+    def _skip_current(self):
+        if not self.current:
+            return
+        while self.current.read(1024 * 1024):
+            pass
+        self._read(_padding(self.current.size))
+        self.current = None
+
+    def _header(self, trailer):
+        """
+        Reads the next header. After a trailer, skips the NUL padding
+        (commonly to 512 bytes) and returns an empty header at the end.
+        """
+        data = self.fileobj.read(4)
+        while trailer and data == b'\0' * 4:
+            data = self.fileobj.read(4)
+        if trailer and not data:
+            return data
+        return data + self._read(NEWC_HEADER_SIZE - len(data))
+
+    def __iter__(self):
+        trailer = False
+        while True:
+            self._skip_current()
+            header = self._header(trailer)
+            if not header:
+                return
+            if header[:6] not in [NEWC_MAGIC, NEWC_CRC_MAGIC]:
+                raise JobError("Not a newc cpio archive")
+            values = {}
+            for index, field in enumerate(NEWC_FIELDS):
+                offset = 6 + index * 8
+                values[field] = int(header[offset:offset + 8], 16)
+            namesize = values.pop('namesize')
+            name = self._read(namesize)[:-1].decode('utf-8')
+            self._read(_padding(NEWC_HEADER_SIZE + namesize))
+            if name == NEWC_TRAILER:
+                if not self.concatenated:
+                    return
+                trailer = True
+                continue
+            trailer = False
+            entry = CpioEntry(name, values.pop('mode'), values.pop('size'), **values)
+            entry._stream = self.fileobj  # pylint: disable=protected-access
+            entry._remaining = entry.size  # pylint: disable=protected-access
+            self.current = entry
+            yield entry
+
+
+class CpioWriter(object):
+    """
+    Writes a newc archive to a file object, streaming file content
+    in chunks. close() writes the trailer but does not close the file.
+    """
+
+    def __init__(self, fileobj, chunk_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.inode = 0
+
+    def _write_entry(self, entry, source=None):
+        self.inode += 1
+        entry.ino = self.inode
+        self.fileobj.write(entry.header())
+        written = 0
+        if source:
+            while written < entry.size:
+                data = source.read(min(self.chunk_size, entry.size - written))
+                if not data:
+                    raise JobError("%s changed size whilst writing cpio archive" % entry.name)
+                self.fileobj.write(data)
+                written += len(data)
+        self.fileobj.write(b'\0' * _padding(entry.size))
+
+    def add(self, path, arcname, owner=None):
+        """
+        Adds a single file, directory, symlink or device node. Hardlinks
+        are stored as separate copies of the content. If owner is set,
+        the (uid, gid) it contains replaces the ownership of path.
+        """
+        info = os.lstat(path)
+        uid, gid = owner if owner else (info.st_uid, info.st_gid)
+        kwargs = {
+            'uid': uid,
+            'gid': gid,
+            'mtime': int(info.st_mtime),
+        }
+        if stat.S_ISCHR(info.st_mode) or stat.S_ISBLK(info.st_mode):
+            kwargs['rdevmajor'] = os.major(info.st_rdev)
+            kwargs['rdevminor'] = os.minor(info.st_rdev)
+        if stat.S_ISREG(info.st_mode):
+            entry = CpioEntry(arcname, info.st_mode, info.st_size, **kwargs)
+            with open(path, 'rb') as source:
+                self._write_entry(entry, source)
+        elif stat.S_ISLNK(info.st_mode):
+            target = os.readlink(path).encode('utf-8')
+            entry = CpioEntry(arcname, info.st_mode, len(target), **kwargs)
+            self._write_entry(entry, io.BytesIO(target))
+        else:
+            self._write_entry(CpioEntry(arcname, info.st_mode, **kwargs))
+
+    def add_tree(self, root, existing=None, owner=(0, 0)):
+        """
+        Adds the contents of root, parents before children, with names
+        relative to root and owned by owner. The kernel applies the
+        ownership and mode of a directory entry even if the directory
+        already exists, so root itself and the directories named in
+        existing (e.g. those of the archive being extended) are not added.
+        :return: the number of entries added
+        """
+        existing = set(existing or [])
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                arcname = os.path.relpath(path, root)
+                if name in dirnames and arcname in existing:
+                    continue
+                self.add(path, arcname, owner)
+                count += 1
+        return count
+
+    def close(self):
+        self.fileobj.write(CpioEntry(NEWC_TRAILER, 0).header())
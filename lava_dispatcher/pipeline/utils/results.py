@@ -0,0 +1,177 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+# Append-only storage for the test case results of a job, so that
+# the memory used does not grow with the number of test cases, and
+# the listener for results posted by the device over the network.
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+from lava_dispatcher.pipeline.action import JobError, TestError
+
+if sys.version > '3':
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
+    from urllib.parse import parse_qsl  # pylint: disable=import-error,no-name-in-module
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error
+    from urlparse import parse_qsl  # pylint: disable=import-error
+
+
+class ResultsStore(object):
+    """
+    Writes each test case result as one line of JSON in the output directory
+    of the job. Only a digest of the definition, set and case of each result
+    is kept in memory, to detect duplicates, along with the running totals
+    of each result for each definition.
+    Without an output directory, only the digests and totals are kept.
+    """
+
+    filename = 'results.jsonl'
+
+    def __init__(self, output_dir=None):
+        self.path = os.path.join(output_dir, self.filename) if output_dir else None
+        self.index = set()
+        self.summary = OrderedDict()
+        self.count = 0
+        self._file = None
+
+    @staticmethod
+    def key(result):
+        data = '\0'.join(['%s' % (result.get(name) or '') for name in ['definition', 'set', 'case']])
+        return hashlib.sha1(data if isinstance(data, bytes) else data.encode('utf-8')).digest()
+
+    def __contains__(self, result):
+        return self.key(result) in self.index
+
+    def __len__(self):
+        return self.count
+
+    def add(self, result):
+        """
+        Appends a result, a dictionary with the definition, case and result
+        of the test case and optionally the set, measurement and units.
+        """
+        self.index.add(self.key(result))
+        totals = self.summary.setdefault(result['definition'], OrderedDict())
+        totals[result['result']] = totals.get(result['result'], 0) + 1
+        self.count += 1
+        if self.path:
+            if not self._file:
+                # append, as several test actions in a job share the store
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(result, sort_keys=True, default=str) + '\n')
+
+    def totals(self):
+        """ The totals of each result for each definition, as plain dictionaries """
+        return dict((definition, dict(totals)) for definition, totals in self.summary.items())
+
+    def results(self):
+        """ Reads back the stored results, one at a time """
+        if self._file:
+            self._file.flush()
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as stored:
+            for line in stored:
+                yield json.loads(line)
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class ResultsListener(object):
+    """
+    HTTP listener for the test case results which lava-test-case posts when
+    LAVA_RESULTS_URL is set, instead of sending a signal on the console.
+    Each result is passed to the callback, in the thread of the listener.
+    The device falls back to the console signal if the post is rejected.
+    """
+
+    def __init__(self, callback, address, port=0):
+        """
+        :param callback: called with a dictionary of the posted fields,
+            can raise JobError or TestError to reject the result.
+        :param address: the address of the dispatcher, as seen by the device
+        :param port: the port to listen on, any free port by default
+        """
+        self.callback = callback
+        self.address = address
+        self.path = '/results/%s' % uuid.uuid4().hex
+        self.received = 0
+        self.rejected = 0
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):  # pylint: disable=too-few-public-methods
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                if self.path != listener.path:
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                if not isinstance(body, str):
+                    body = body.decode('utf-8', 'replace')
+                if listener.handle(dict(parse_qsl(body))):
+                    self.send_response(200)
+                else:
+                    self.send_response(400)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = HTTPServer(('', port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.address, self.server.server_address[1], self.path)
+
+    def handle(self, data):
+        try:
+            self.callback(data)
+        except (JobError, TestError):
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.2})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
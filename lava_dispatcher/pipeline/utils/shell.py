@@ -25,12 +25,25 @@ from stat import S_IXUSR
 from lava_dispatcher.pipeline.action import InfrastructureError, TestError
 
 
+# Per-process memo of the results of _which_check, keyed by the command,
+# the match function and the PATH in use at the time of the lookup.
+# Tools are not expected to be installed or removed during a job.
+_WHICH_CACHE = {}
+
+
 def _which_check(path, match):
     """
     Simple replacement for the `which` command found on
     Debian based systems. Allows ordinary users to query
     the PATH used at runtime.
     """
+    key = (path, match, os.environ['PATH'])
+    if key not in _WHICH_CACHE:
+        _WHICH_CACHE[key] = _which_search(path, match)
+    return _WHICH_CACHE[key]
+
+
+def _which_search(path, match):
     paths = os.environ['PATH'].split(':')
     if os.getuid() != 0:
         # avoid sudo - it may ask for a password on developer systems.
@@ -19,11 +19,34 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import sys
+import fcntl
+import hashlib
 import logging
 import os
+import re
+import shutil
 import subprocess
+import tarfile
+import tempfile
+import requests
 
-from lava_dispatcher.pipeline.action import InfrastructureError
+from lava_dispatcher.pipeline.action import (
+    DeadlineManager,
+    InfrastructureError,
+    JobError,
+)
+from lava_dispatcher.pipeline.utils.cache import fingerprint
+from lava_dispatcher.pipeline.utils.constants import (
+    HTTP_DOWNLOAD_CHUNK_SIZE,
+    HTTP_DOWNLOAD_TIMEOUT,
+)
+
+if sys.version_info[0] == 2:
+    import urlparse as lavaurl
+elif sys.version_info[0] == 3:
+    import urllib.parse as lavaurl  # pylint: disable=no-name-in-module,import-error
+
+GIT_COMMIT_ID = re.compile(r'^[0-9a-f]{40}$')
 
 
 # pylint: disable=too-few-public-methods
@@ -45,7 +68,6 @@ class BzrHelper(VCSHelper):
         self.binary = '/usr/bin/bzr'
 
     def clone(self, dest_path, revision=None):
-        cwd = os.getcwd()
         logger = logging.getLogger('dispatcher')
         env = dict(os.environ)
         env.update({'BZR_HOME': '/dev/null', 'BZR_LOG': '/dev/null'})
@@ -53,19 +75,19 @@ class BzrHelper(VCSHelper):
         try:
             if revision is not None:
                 logger.debug("Running '%s branch -r %s %s'", self.binary, str(revision), self.url)
-                subprocess.check_output([self.binary, 'branch', '-r',
-                                         str(revision), self.url,
-                                         dest_path],
-                                        stderr=subprocess.STDOUT, env=env)
+                DeadlineManager.check_output([self.binary, 'branch', '-r',
+                                              str(revision), self.url,
+                                              dest_path],
+                                             stderr=subprocess.STDOUT, env=env)
                 commit_id = str(revision)
             else:
                 logger.debug("Running '%s branch %s'", self.binary, self.url)
-                subprocess.check_output([self.binary, 'branch', self.url,
-                                         dest_path],
-                                        stderr=subprocess.STDOUT, env=env)
-                os.chdir(dest_path)
-                commit_id = subprocess.check_output(['bzr', 'revno'],
-                                                    env=env).strip().decode('utf-8')
+                DeadlineManager.check_output([self.binary, 'branch', self.url,
+                                              dest_path],
+                                             stderr=subprocess.STDOUT, env=env)
+                # no chdir as repositories may be fetched in other threads
+                commit_id = DeadlineManager.check_output(['bzr', 'revno'], cwd=dest_path,
+                                                         env=env).strip().decode('utf-8')
 
         except subprocess.CalledProcessError as exc:
             if sys.version > '3':
@@ -82,8 +104,6 @@ class BzrHelper(VCSHelper):
                     'output': exc.output.split('\n')})
             raise InfrastructureError("Unable to fetch bzr repository '%s'"
                                       % (self.url))
-        finally:
-            os.chdir(cwd)
 
         return commit_id
 
@@ -97,32 +117,135 @@ class GitHelper(VCSHelper):
       commit_id = git.clone('destination')
       commit_id = git.clone('destination2, 'hash')
 
+    If mirror_dir is set, a bare mirror of the branches and tags of each
+    repository is kept in that directory and updated with fetch, under a
+    lock, so that only new objects are transferred. Other refs, such as
+    pull requests, are not mirrored. Clones are then made from the mirror.
+    A pinned commit which is already in the mirror needs no fetch at all.
+
+    When a revision is specified, only that revision is fetched, without
+    any history, falling back to a full clone if the server refuses, or
+    if the revision is not a complete commit ID, branch or tag name.
+
     This helper will raise a InfrastructureError for any error encountered.
     """
 
-    def __init__(self, url):
+    def __init__(self, url, mirror_dir=None):
         super(GitHelper, self).__init__(url)
         self.binary = '/usr/bin/git'
+        self.mirror_dir = mirror_dir
+
+    def _git(self, *args):
+        return DeadlineManager.check_output((self.binary,) + args,
+                                            stderr=subprocess.STDOUT)
+
+    def _mirror(self, revision):
+        """
+        Creates or updates the mirror of this repository and
+        returns the file:// URL to fetch from.
+        Returns None if the mirror directory cannot be used.
+        """
+        logger = logging.getLogger('dispatcher')
+        key = hashlib.sha256(self.url.encode('utf-8')).hexdigest()
+        path = os.path.join(self.mirror_dir, key)
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError as exc:
+            logger.debug("Git mirror disabled: %s", exc)
+            return None
+        mirror = os.path.join(path, 'mirror.git')
+        with open(os.path.join(path, 'lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(mirror):
+                    logger.debug("Creating git mirror of %s in %s", self.url, mirror)
+                    self._git('init', '--quiet', '--bare', mirror)
+                    self._git('--git-dir', mirror, 'remote', 'add', 'origin', self.url)
+                    # allows fetching a pinned commit which is not at the tip of a branch
+                    self._git('--git-dir', mirror, 'config', 'uploadpack.allowAnySHA1InWant', 'true')
+                    self._update_mirror(mirror)
+                    self._set_head(mirror)
+                elif revision and GIT_COMMIT_ID.match(revision) and self._has_commit(mirror, revision):
+                    logger.debug("Commit %s is already in the git mirror", revision)
+                else:
+                    logger.debug("Updating git mirror of %s", self.url)
+                    self._update_mirror(mirror)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+        return 'file://%s' % os.path.abspath(mirror)
+
+    def _update_mirror(self, mirror):
+        # only branches and tags, also for mirrors made with clone --mirror
+        self._git('--git-dir', mirror, 'config', '--replace-all',
+                  'remote.origin.fetch', '+refs/heads/*:refs/heads/*')
+        self._git('--git-dir', mirror, 'config', '--add',
+                  'remote.origin.fetch', '+refs/tags/*:refs/tags/*')
+        self._git('--git-dir', mirror, 'fetch', '--quiet', '--prune', 'origin')
+
+    def _set_head(self, mirror):
+        """
+        Points HEAD of the mirror at the default branch of the repository,
+        as clone would.
+        """
+        output = self._git('ls-remote', '--symref', self.url, 'HEAD').decode('utf-8')
+        for line in output.splitlines():
+            if line.startswith('ref: ') and line.endswith('\tHEAD'):
+                self._git('--git-dir', mirror, 'symbolic-ref', 'HEAD', line[len('ref: '):].split('\t')[0])
+
+    def _has_commit(self, mirror, revision):
+        try:
+            self._git('--git-dir', mirror, 'cat-file', '-e', '%s^{commit}' % revision)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def _fetch(self, source, dest_path, revision):
+        """
+        Creates dest_path with a checkout of only the requested revision.
+        """
+        if os.path.isdir(source):
+            # local paths would otherwise be relative to dest_path
+            source = os.path.abspath(source)
+        self._git('init', '--quiet', dest_path)
+        self._git('-C', dest_path, 'fetch', '--quiet', '--depth', '1', source,
+                  revision or 'HEAD')
+        self._git('-C', dest_path, 'checkout', '--quiet', 'FETCH_HEAD')
+        self._git('-C', dest_path, 'remote', 'add', 'origin', self.url)
+
+    def _clone(self, dest_path, revision, source=None):
+        logger = logging.getLogger('dispatcher')
+        logger.debug("Running '%s clone %s %s'", self.binary, source or self.url,
+                     dest_path)
+        self._git('clone', source or self.url, dest_path)
+        if source:
+            self._git('-C', dest_path, 'remote', 'set-url', 'origin', self.url)
+        if revision is not None:
+            logger.debug("Running '%s checkout %s", self.binary,
+                         str(revision))
+            self._git('-C', dest_path, 'checkout', str(revision))
 
     def clone(self, dest_path, revision=None):
         logger = logging.getLogger('dispatcher')
+        if revision is not None:
+            revision = str(revision)
         try:
-            logger.debug("Running '%s clone %s %s'", self.binary, self.url,
-                         dest_path)
-            subprocess.check_output([self.binary, 'clone', self.url,
-                                     dest_path],
-                                    stderr=subprocess.STDOUT)
+            if os.path.exists(dest_path) and os.listdir(dest_path):
+                raise InfrastructureError("Destination path '%s' already exists and is not empty" % dest_path)
+            source = self._mirror(revision) if self.mirror_dir else None
+            if source or revision is not None:
+                try:
+                    logger.debug("Fetching %s from %s into %s", revision or 'HEAD',
+                                 source or self.url, dest_path)
+                    self._fetch(source or self.url, dest_path, revision)
+                except subprocess.CalledProcessError as exc:
+                    logger.debug("Shallow fetch failed, falling back to clone: %s", exc.output)
+                    shutil.rmtree(dest_path, ignore_errors=True)
+                    self._clone(dest_path, revision, source)
+            else:
+                self._clone(dest_path, revision)
 
-            if revision is not None:
-                logger.debug("Running '%s checkout %s", self.binary,
-                             str(revision))
-                subprocess.check_output([self.binary, '-C', dest_path,
-                                         'checkout', str(revision)],
-                                        stderr=subprocess.STDOUT)
-
-            commit_id = subprocess.check_output([self.binary, '-C', dest_path,
-                                                 'log', '-1', '--pretty=%H'],
-                                                stderr=subprocess.STDOUT).strip()
+            commit_id = self._git('-C', dest_path, 'log', '-1', '--pretty=%H').strip()
         except subprocess.CalledProcessError as exc:
             logger = logging.getLogger('dispatcher')
             if sys.version > '3':
@@ -143,17 +266,165 @@ class GitHelper(VCSHelper):
         return commit_id.decode('utf-8')
 
 
-class TarHelper(VCSHelper):
-    # TODO: implement TarHelper
+class _StreamReader(object):
+    """
+    File object over an iterator of chunks which hashes the content
+    and, optionally, copies it to another file as it is read.
+    """
 
-    def __init__(self, url):
-        super(TarHelper, self).__init__(url)
-        self.binary = None
+    def __init__(self, chunks, copy=None):
+        self.chunks = chunks
+        self.copy = copy
+        self.buffer = b''
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            self.sha256.update(chunk)
+            if self.copy:
+                self.copy.write(chunk)
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        """ Reads any content not used by the consumer """
+        while self.read(HTTP_DOWNLOAD_CHUNK_SIZE):
+            pass
 
 
 class URLHelper(VCSHelper):
-    # TODO: implement URLHelper
+    """
+    Helper to fetch a single file, over http(s) or from a local path.
 
-    def __init__(self, url):
+    If a DownloadCache is set, a copy of the content is kept along with
+    the ETag and Last-Modified headers of the response. The next fetch
+    of the same URL is a conditional request and the cached copy is used
+    if the server replies that the content has not been modified.
+
+    The content is passed to the consumer as it is downloaded, so that
+    nothing needs to be written to a temporary file first.
+    The return value of clone() is the sha256 of the content, as the
+    URL identifies the content, the revision is not used.
+    """
+
+    def __init__(self, url, cache=None):
         super(URLHelper, self).__init__(url)
         self.binary = None
+        self.cache = cache
+
+    def _get(self, headers=None):
+        try:
+            res = requests.get(self.url, headers=headers, allow_redirects=True,
+                               stream=True, timeout=HTTP_DOWNLOAD_TIMEOUT)
+        except requests.RequestException as exc:
+            raise InfrastructureError("Unable to fetch '%s': %s" % (self.url, exc))
+        if res.status_code not in [requests.codes.ok, requests.codes.not_modified]:  # pylint: disable=no-member
+            res.close()
+            raise InfrastructureError("Unable to fetch '%s': HTTP %s" % (self.url, res.status_code))
+        return res
+
+    def _fetch(self, consume):
+        """
+        Calls consume with a file object for the content.
+        :return: the sha256 of the content
+        """
+        logger = logging.getLogger('dispatcher')
+        url = lavaurl.urlparse(self.url)
+        if url.scheme in ['', 'file']:
+            try:
+                with open(url.path, 'rb') as source:
+                    reader = _StreamReader(iter(lambda: source.read(HTTP_DOWNLOAD_CHUNK_SIZE), b''))
+                    consume(reader)
+                    reader.drain()
+            except IOError as exc:
+                raise InfrastructureError("Unable to fetch '%s': %s" % (self.url, exc))
+            return reader.sha256.hexdigest()
+        if not self.cache:
+            res = self._get()
+            try:
+                reader = _StreamReader(res.iter_content(HTTP_DOWNLOAD_CHUNK_SIZE))
+                consume(reader)
+                reader.drain()
+            finally:
+                res.close()
+            return reader.sha256.hexdigest()
+
+        with self.cache.entry(fingerprint('url', self.url)) as entry:
+            metadata = entry.metadata if entry.hit else None
+            headers = {}
+            if metadata and metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata and metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+            res = self._get(headers)
+            try:
+                if metadata and res.status_code == requests.codes.not_modified:  # pylint: disable=no-member
+                    logger.debug("%s has not been modified, using the cached copy", self.url)
+                    # release the connection before the consumer reads the cached copy
+                    res.close()
+                    os.utime(entry.meta, None)
+                    with open(entry.data, 'rb') as cached:
+                        consume(cached)
+                    return metadata['sha256']
+                handle, fname = tempfile.mkstemp(dir=entry.path)
+                try:
+                    with os.fdopen(handle, 'wb') as copy:
+                        reader = _StreamReader(res.iter_content(HTTP_DOWNLOAD_CHUNK_SIZE), copy)
+                        consume(reader)
+                        reader.drain()
+                    digest = reader.sha256.hexdigest()
+                    entry.store(fname, {
+                        'url': self.url,
+                        'etag': res.headers.get('ETag'),
+                        'last_modified': res.headers.get('Last-Modified'),
+                        'sha256': digest,
+                    })
+                finally:
+                    os.unlink(fname)
+            finally:
+                res.close()
+        self.cache.trim()
+        return digest
+
+    def clone(self, dest_path, revision=None):
+        """
+        Fetches the file into dest_path, using the name of the file in the URL.
+        """
+        if not os.path.isdir(dest_path):
+            os.makedirs(dest_path)
+        fname = os.path.join(dest_path, os.path.basename(lavaurl.urlparse(self.url).path))
+
+        def write(source):
+            with open(fname, 'wb') as dest:
+                shutil.copyfileobj(source, dest, HTTP_DOWNLOAD_CHUNK_SIZE)
+
+        return self._fetch(write)
+
+
+class TarHelper(URLHelper):
+    """
+    Helper to fetch a tarball, optionally compressed, and extract it.
+    The tarball is extracted as it is downloaded, see URLHelper.
+    """
+
+    def clone(self, dest_path, revision=None):
+        """
+        Extracts the tarball into dest_path.
+        """
+
+        def extract(source):
+            try:
+                with tarfile.open(fileobj=source, mode='r|*') as tar:
+                    tar.extractall(path=dest_path)
+            except tarfile.TarError as exc:
+                raise JobError("Unable to extract '%s': %s" % (self.url, exc))
+
+        return self._fetch(extract)
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+from lava_dispatcher.pipeline.log import YAMLLogger, LOG_CODECS, pack_log_frame
+
+import datetime
+import logging
+import optparse
+import sys
+import time
+import yaml
+
+
+MESSAGES = [
+    "start: 1.1 download_retry (max 300s)",
+    "Linux version 4.4.0-1-armmp (debian-kernel@lists.debian.org) (gcc version 5.3.1 20160101)",
+    'Setting "bootargs" to "console=ttyO0,115200n8 root=/dev/ram0 ip=dhcp"',
+    "\tcolumn\tseparated\toutput\r\n",
+]
+
+
+def yaml_dump(level_name, message):
+    """ The encoder used before yaml_record, for comparison """
+    data = {'dt': datetime.datetime.utcnow().isoformat(),
+            'lvl': level_name, 'msg': message}
+    return yaml.dump(data, default_flow_style=True, default_style='"',
+                     width=sys.maxsize)[:-1]
+
+
+def measure_compression(records, codec, batch_size):
+    """ Compresses batches of records as ZMQPushHandler would """
+    items = [('1.1', 'download_retry',
+              YAMLLogger.yaml_record('2016-01-01T00:00:00', 'target', MESSAGES[count % len(MESSAGES)]))
+             for count in range(records)]
+    size = wire = 0
+    start = time.time()
+    for index in range(0, records, batch_size):
+        batch = items[index:index + batch_size]
+        size += sum([len(field) for item in batch for field in item])
+        wire += sum([len(part) for part in pack_log_frame(batch, codec)])
+    return records / (time.time() - start), float(size) / wire
+
+
+def measure(records, encode):
+    start = time.time()
+    for count in range(records):
+        encode('target', MESSAGES[count % len(MESSAGES)])
+    return records / (time.time() - start)
+
+
+if __name__ == '__main__':
+    usage = "Usage: %prog [-n RECORDS] [-b BATCH_SIZE]"
+    description = "LAVA dispatcher pipeline helper. Measure the number of log " \
+                  "records per second which the YAMLLogger formats can encode " \
+                  "and the log compression codecs can compress"
+
+    parser = optparse.OptionParser(usage=usage, description=description)
+    parser.add_option("-n", dest="records", type="int", default=20000,
+                      help="number of records to encode for each format")
+    parser.add_option("-b", dest="batch_size", type="int", default=100,
+                      help="number of records in each compressed batch, "
+                           "as set with lava-dispatch --log-batch-size")
+    (options, args) = parser.parse_args()
+
+    logger = YAMLLogger('benchmark')
+    logger.addHandler(logging.NullHandler())
+
+    def log_message(log_format):
+        logger.set_format(log_format)
+        return lambda level_name, message: logger.log_message(logging.INFO, level_name, message)
+
+    for name, encode in [('yaml.dump', yaml_dump),
+                         ('yaml', log_message('yaml')),
+                         ('json', log_message('json'))]:
+        print("%-10s %10d records/s" % (name, measure(options.records, encode)))
+
+    for codec in sorted(LOG_CODECS.keys()):
+        rate, ratio = measure_compression(options.records, codec, options.batch_size)
+        print("%-10s %10d records/s, compression ratio %.1f" % (codec, rate, ratio))